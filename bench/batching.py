@@ -0,0 +1,102 @@
+#Measure txt2img throughput with and without micro-batching, and check that each
+#job of a batch gets back its own images and seed. Runs both with a webui taking a
+#prompt and seed per image, and like stock webui, with one prompt and seed per call
+#(where the jobs share a prompt, and some pick random seeds).
+#
+#Runs the job queue in-process against the stub webui in this directory. The stub
+#takes the same time per sampler call whatever the batch size, which is roughly
+#how a GPU behaves until it is saturated:
+#
+#    STUB_STEP_DELAY=0.01 python bench/batching.py --jobs 32
+import os
+import sys
+import time
+import zlib
+import argparse
+import threading
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(bench_dir))
+sys.path.insert(0, bench_dir)
+
+import rest_api_job_queue
+
+
+#The stub shades each image by its seed; read the shade back out of the PNG.
+def png_shade(png):
+    idat = png.index(b"IDAT")
+    length = int.from_bytes(png[idat - 4:idat], "big")
+    return zlib.decompress(png[idat + 4:idat + 4 + length])[1]
+
+
+#The jobs to submit, as (prompt, seed, batch size). With one seed per call, the
+#fixed seeds follow on from each other, as a client asking for a run of seeds would.
+def make_jobs(jobs, prompt_lists):
+    made = []
+    next_seed = 1000
+    for i in range(jobs):
+        batch_size = 1 + i % 2
+        if prompt_lists:
+            made.append((f"job {i}", 1000 + 10 * i, batch_size))
+        else:
+            made.append(("job", -1 if i % 3 == 2 else next_seed, batch_size))
+        next_seed += batch_size
+    return made
+
+
+def run(jobs, steps, prompt_lists):
+    made = make_jobs(jobs, prompt_lists)
+    ids = []
+    start = time.perf_counter()
+    for prompt, seed, batch_size in made:
+        #Each run submits the same jobs, so keep them out of the result cache.
+        request = rest_api_job_queue.add_request({"done": False, "key": "", "model": "", "include_logs": False,
+                                                     "cache": False, "type": "txt2img", "retval": None, "status": {},
+                                                     "params": {"prompt": prompt, "ddim_steps": steps,
+                                                                "seed": seed, "batch_size": batch_size}})
+        ids.append(request["id"])
+    for i in ids:
+        while not rest_api_job_queue.get_request(i)["done"]:
+            time.sleep(0.005)
+    seconds = time.perf_counter() - start
+
+    for i, (prompt, seed, batch_size) in zip(ids, made):
+        request = rest_api_job_queue.get_request(i)
+        images = rest_api_job_queue.get_result(i) or []
+        shades = [png_shade(bytes(png)) for png in images]
+        got = request["retval"][1] if request["success"] else None
+        if got is None or seed not in (-1, got) or shades != [(got + j) & 0xff for j in range(batch_size)]:
+            print(f"Job {i} got the wrong results: {request['retval'][1:]}, shades {shades}")
+            return None
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark txt2img micro-batching.")
+    parser.add_argument("--jobs", type=int, default=32, help="number of jobs to submit at once")
+    parser.add_argument("--steps", type=int, default=10, help="sampler steps per job")
+    args = parser.parse_args()
+
+    rest_api_job_queue.models = rest_api_job_queue.default_models
+    threading.Thread(target=rest_api_job_queue.process_queue, daemon=True).start()
+    while rest_api_job_queue.loaded_model is None:
+        time.sleep(0.01)
+    webui = sys.modules["webui"]
+
+    batch_images = rest_api_job_queue.max_batch_images
+    for prompt_lists in (True, False):
+        webui.supports_prompt_batches = prompt_lists
+        print("Prompt and seed per image:" if prompt_lists else "One prompt and seed per call, like stock webui:")
+        for label, limit in (("unbatched", 1), (f"batches of up to {batch_images}", batch_images)):
+            rest_api_job_queue.max_batch_images = limit
+            calls = webui.calls
+            seconds = run(args.jobs, args.steps, prompt_lists)
+            if seconds is None:
+                return 1
+            print(f"  {label}: {args.jobs} jobs in {seconds:.3f} s ({args.jobs / seconds:.1f} jobs/s), "
+                  f"{webui.calls - calls} sampler calls")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,128 @@
+#Measure how a fast sampler's progress reports contend with heavy status polling for
+#the job queue's lock: a worker reporting every step under the lock, against one
+#writing every step to its progress block and reporting every PROGRESS_INTERVAL.
+#Each is run with status polls answered from snapshots without the lock, and with
+#the snapshots off (every poll takes the lock). Starts the job queue and a worker
+#process with the stub webui in this directory for each run, and polls from threads
+#with a connection each. Besides the poll latency, reports from the queue's metrics
+#how often polls and progress reports found the lock held, and how long they waited:
+#
+#    python bench/contention.py --pollers 16 --steps 2000
+import os
+import sys
+import time
+import argparse
+import threading
+import subprocess
+import statistics
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, repo_dir)
+
+
+#Parse the queue's metrics (the Prometheus text format) into a dict of sample values.
+def read_metrics(text):
+    values = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            values[name] = float(value)
+    return values
+
+
+#Run one job while the pollers query its status as fast as they can.
+def run(label, args, env):
+    import rest_api_job_queue
+    rest_api_job_queue.port = int(env["JOBQUEUE_PORT"])
+    log = open(os.devnull, "w")
+    processes = []
+    try:
+        #Start the worker once the queue is listening, and wait until it has joined.
+        for extra in ([], ["--worker"]):
+            processes.append(subprocess.Popen([sys.executable, os.path.join(repo_dir, "rest_api_job_queue.py")] + extra,
+                                              cwd=repo_dir, env=env, stdout=log, stderr=log))
+            for _ in range(300):
+                try:
+                    queue = rest_api_job_queue.connect_queue()
+                    if extra == [] or len(queue.get_workers()["workers"]) > 0:
+                        break
+                except (EOFError, OSError):
+                    pass
+                time.sleep(0.1)
+            else:
+                print("The job queue never started." if extra == [] else "The worker never joined the job queue.")
+                return False
+
+        proxies = [rest_api_job_queue.connect_queue() for _ in range(args.pollers)]
+        start = time.perf_counter()
+        request_id = queue.add_request({"done": False, "key": "bench", "model": "", "include_logs": False, "cache": False,
+                                        "type": "txt2img", "retval": None, "status": {},
+                                        "params": {"prompt": "contention", "ddim_steps": args.steps}})["id"]
+        latencies = []
+        seen = set()
+        def poll(proxy):
+            while True:
+                polled = time.perf_counter()
+                status = proxy.get_status(request_id)
+                latencies.append(time.perf_counter() - polled)
+                if status["done"]:
+                    return
+                seen.add(status["status"].get("step"))
+
+        pollers = [threading.Thread(target=poll, args=(p,)) for p in proxies]
+        for t in pollers:
+            t.start()
+        for t in pollers:
+            t.join()
+        seconds = time.perf_counter() - start
+
+        latencies.sort()
+        values = read_metrics(queue.get_metrics())
+        print(f"{label}: {args.steps / seconds:.0f} steps/s, {len(latencies)} polls "
+              f"(mean {statistics.mean(latencies) * 1e6:.0f} us, p99 {latencies[len(latencies) * 99 // 100] * 1e6:.0f} us), "
+              f"{len(seen)} distinct steps seen")
+        snapshots = values.get('sdapi_status_reads_total{source="snapshot"}', 0)
+        locked = values.get('sdapi_status_reads_total{source="lock"}', 0)
+        print(f"    polls answered from a snapshot: {snapshots:.0f}, under the lock: {locked:.0f}")
+        for call in ("get_status", "report_progress"):
+            free = values.get(f'sdapi_queue_lock_acquires_total{{call="{call}",contended="no"}}', 0)
+            held = values.get(f'sdapi_queue_lock_acquires_total{{call="{call}",contended="yes"}}', 0)
+            waited = values.get(f'sdapi_queue_lock_wait_seconds_sum{{call="{call}"}}', 0)
+            print(f"    {call}: {free + held:.0f} lock acquires, {held:.0f} found it held, "
+                  f"waiting {waited * 1000:.1f} ms in all ({waited / max(held, 1) * 1e6:.0f} us each)")
+        return queue.get_status(request_id).get("success") is True
+    finally:
+        for p in processes:
+            p.terminate()
+            p.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure lock contention between progress reports and status polls.")
+    parser.add_argument("--pollers", type=int, default=16, help="threads polling the job's status")
+    parser.add_argument("--steps", type=int, default=2000, help="sampler steps of the job")
+    parser.add_argument("--step-delay", type=float, default=0.0005, help="seconds per stub sampler step")
+    parser.add_argument("--interval", type=float, default=0.2, help="seconds between coalesced reports")
+    parser.add_argument("--snapshot-age", type=float, default=0.1, help="STATUS_SNAPSHOT_AGE when polling from snapshots")
+    parser.add_argument("--port", type=int, default=37990, help="job queue port (and the next three)")
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=bench_dir, JOBQUEUE_PORT=str(args.port), LOCAL_WORKER="0", STUB_STEP_DELAY=str(args.step_delay))
+    os.environ.update(env)
+
+    #Without the image spool, the worker can't share a progress block with the queue.
+    ok = True
+    modes = (("Report every step", dict(PROGRESS_INTERVAL="0", IMAGE_SPOOL_DIR="")),
+             (f"Progress block, report every {args.interval} s", dict(PROGRESS_INTERVAL=str(args.interval))))
+    runs = 0
+    for label, mode in modes:
+        for snapshots, age in (("polls under the lock", "0"), ("polls from snapshots", str(args.snapshot_age))):
+            run_env = dict(env, STATUS_SNAPSHOT_AGE=age, JOBQUEUE_PORT=str(args.port + runs), **mode)
+            ok = run(f"{label}, {snapshots}", args, run_env) and ok
+            runs += 1
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
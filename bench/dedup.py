@@ -0,0 +1,98 @@
+#Check that identical fixed-seed requests only run once: several clients submit the
+#same few requests, which wait for the first of each to run, then submit them again,
+#which copies the cached results. Also checks that requests with a random seed or
+#"cache": false still run, and that cancelling a request hands its place to an
+#identical one. Runs the job queue in-process against the stub webui in this
+#directory:
+#
+#    STUB_STEP_DELAY=0.002 python bench/dedup.py --clients 8 --distinct 4
+import os
+import sys
+import time
+import zlib
+import argparse
+import threading
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(bench_dir))
+sys.path.insert(0, bench_dir)
+
+import rest_api_job_queue
+
+
+#The stub shades each image by its seed; read the shade back out of the PNG.
+def png_shade(png):
+    idat = png.index(b"IDAT")
+    length = int.from_bytes(png[idat - 4:idat], "big")
+    return zlib.decompress(png[idat + 4:idat + 4 + length])[1]
+
+
+def submit(key, n, seed, cache=True):
+    return rest_api_job_queue.add_request({"done": False, "key": key, "model": "", "include_logs": False, "cache": cache,
+                                           "type": "txt2img", "retval": None, "status": {},
+                                           "params": {"prompt": f"prompt {n}", "ddim_steps": 10, "seed": seed}})["id"]
+
+
+def wait(ids):
+    while not all(rest_api_job_queue.get_status(i)["done"] for i in ids):
+        time.sleep(0.005)
+
+
+#Check that each job succeeded with the image of its seed.
+def check(ids, seeds):
+    for i, seed in zip(ids, seeds):
+        request = rest_api_job_queue.get_request(i)
+        images = rest_api_job_queue.get_result(i) or []
+        if not request["success"] or [png_shade(bytes(png)) for png in images] != [seed & 0xff]:
+            print(f"Job {i} got the wrong result: success {request['success']}, {len(images)} images")
+            return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check deduplication of identical requests.")
+    parser.add_argument("--clients", type=int, default=8, help="clients submitting the same requests")
+    parser.add_argument("--distinct", type=int, default=4, help="distinct requests each client submits")
+    args = parser.parse_args()
+
+    rest_api_job_queue.models = rest_api_job_queue.default_models
+    rest_api_job_queue.max_batch_images = 1
+    threading.Thread(target=rest_api_job_queue.process_queue, daemon=True).start()
+    while rest_api_job_queue.loaded_model is None:
+        time.sleep(0.01)
+    webui = sys.modules["webui"]
+    seeds = [100 + n for n in range(args.distinct)] * args.clients
+    ok = True
+
+    for label in ("while running", "after finishing"):
+        calls = webui.calls
+        start = time.perf_counter()
+        ids = [submit(f"client{c}", n, 100 + n) for c in range(args.clients) for n in range(args.distinct)]
+        wait(ids)
+        seconds = time.perf_counter() - start
+        ok = check(ids, seeds) and ok
+        print(f"Identical requests {label}: {len(ids)} jobs in {seconds:.3f} s, {webui.calls - calls} sampler calls")
+
+    #Random seeds and requests that opt out must run every time.
+    calls = webui.calls
+    ids = [submit("random", 0, -1) for _ in range(3)] + [submit("nocache", 0, 100, cache=False) for _ in range(3)]
+    wait(ids)
+    print(f"Random seeds and opted out: {len(ids)} jobs, {webui.calls - calls} sampler calls")
+    ok = ok and webui.calls - calls == len(ids)
+
+    #Cancelling the request that runs for the others leaves one of them to run instead.
+    holder = submit("holder", 0, 1, cache=False)
+    first = submit("a", 99, 500)
+    second = submit("b", 99, 500)
+    rest_api_job_queue.cancel(first)
+    wait([holder, first, second])
+    ok = check([second], [500]) and ok
+    print(f"Cancelled request: {rest_api_job_queue.get_status(first)['cancel']}, identical one succeeded: "
+          f"{rest_api_job_queue.get_status(second)['success']}")
+
+    print("All jobs got the right results." if ok else "Some jobs got the wrong results.")
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
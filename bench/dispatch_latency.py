@@ -0,0 +1,59 @@
+#Measure how long a job waits between add_request and the start of generation.
+#
+#Runs the job queue in-process against the stub webui in this directory, so it
+#needs neither a GPU nor the API server:
+#
+#    python bench/dispatch_latency.py --jobs 200 --max-ms 5
+import os
+import sys
+import time
+import argparse
+import threading
+import statistics
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(bench_dir))
+sys.path.insert(0, bench_dir)
+
+import rest_api_job_queue
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--jobs", type=int, default=100, help="number of jobs to submit")
+    parser.add_argument("--idle", type=float, default=0.02, help="seconds to leave the queue idle between jobs")
+    parser.add_argument("--max-ms", type=float, default=None, help="fail if the median latency exceeds this")
+    args = parser.parse_args()
+
+    rest_api_job_queue.models = rest_api_job_queue.default_models
+    threading.Thread(target=rest_api_job_queue.process_queue, daemon=True).start()
+    while rest_api_job_queue.loaded_model is None:
+        time.sleep(0.01)
+    webui = sys.modules["webui"]
+
+    latencies = []
+    for i in range(args.jobs):
+        #Let the worker go idle so every job arrives on an empty queue.
+        time.sleep(args.idle)
+        webui.job_started.clear()
+        submitted = time.perf_counter()
+        rest_api_job_queue.add_request({"done": False, "key": "", "model": "", "include_logs": False, "type": "txt2img",
+                                        "params": {"prompt": f"job {i}", "ddim_steps": 1}, "retval": None, "status": {}})
+        if not webui.job_started.wait(5):
+            print(f"Job {i} never started.")
+            return 1
+        latencies.append((webui.job_started_at - submitted) * 1000)
+
+    latencies.sort()
+    median = statistics.median(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"jobs: {len(latencies)}, median: {median:.3f} ms, p99: {p99:.3f} ms, max: {latencies[-1]:.3f} ms")
+
+    if args.max_ms is not None and median > args.max_ms:
+        print(f"Median submit-to-start latency {median:.3f} ms exceeds {args.max_ms} ms")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,74 @@
+#Check how well the queue's estimated finish times match reality. Runs a warm-up
+#round so the queue learns the stub's speed, then submits a backlog of jobs with
+#varied step counts and compares each job's estimated_finish, as reported right
+#after submission, with when it actually finished. Runs the job queue in-process
+#against the stub webui in this directory:
+#
+#    STUB_STEP_DELAY=0.01 python bench/eta.py --jobs 20
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+import statistics
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(bench_dir))
+sys.path.insert(0, bench_dir)
+
+import rest_api_job_queue
+
+
+def submit(steps, size):
+    return rest_api_job_queue.add_request({"done": False, "key": "", "model": "", "include_logs": False, "type": "txt2img",
+                                           "retval": None, "status": {},
+                                           "params": {"prompt": "eta", "ddim_steps": steps, "width": size, "height": size}})["id"]
+
+
+def wait(ids):
+    finished = {}
+    while len(finished) < len(ids):
+        for i in ids:
+            if i not in finished and rest_api_job_queue.get_status(i)["done"]:
+                finished[i] = time.time()
+        time.sleep(0.002)
+    return finished
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the accuracy of the estimated finish times.")
+    parser.add_argument("--jobs", type=int, default=20, help="jobs in the measured backlog")
+    parser.add_argument("--max-error", type=float, default=None, help="fail if the mean error exceeds this fraction")
+    args = parser.parse_args()
+
+    rest_api_job_queue.models = rest_api_job_queue.default_models
+    rest_api_job_queue.max_batch_images = 1
+    threading.Thread(target=rest_api_job_queue.process_queue, daemon=True).start()
+    while rest_api_job_queue.loaded_model is None:
+        time.sleep(0.01)
+
+    rng = random.Random(0)
+    sizes = (64, 128)
+    wait([submit(10, size) for size in sizes for _ in range(2)])
+
+    start = time.time()
+    ids = [submit(rng.randrange(5, 40), rng.choice(sizes)) for _ in range(args.jobs)]
+    estimated = {i: rest_api_job_queue.get_status(i)["status"].get("estimated_finish") for i in ids}
+    finished = wait(ids)
+
+    errors = []
+    for i in ids:
+        if estimated[i] is None:
+            print(f"Request {i} had no estimate.")
+            return 1
+        errors.append(abs(estimated[i] - finished[i]) / (finished[i] - start))
+    mean_error = statistics.mean(errors)
+    print(f"jobs: {len(ids)}, mean error: {mean_error * 100:.1f}% of the wait, max: {max(errors) * 100:.1f}%")
+    if args.max_error is not None and mean_error > args.max_error:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
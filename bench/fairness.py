@@ -0,0 +1,66 @@
+#Check the fair queuing between API keys: one key floods the queue, then other
+#keys (and a batch job) submit a few jobs each. Reports where each key's jobs ran,
+#and checks that the jobs ran in the order jobs_ahead predicted when they were
+#submitted. Runs the job queue in-process against the stub webui in this directory:
+#
+#    STUB_STEP_DELAY=0.002 python bench/fairness.py --flood 50
+import os
+import sys
+import time
+import argparse
+import threading
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(bench_dir))
+sys.path.insert(0, bench_dir)
+
+import rest_api_job_queue
+
+
+def submit(key, i, priority="interactive"):
+    return rest_api_job_queue.add_request({"done": False, "key": key, "model": "", "include_logs": False,
+                                           "priority": priority, "type": "txt2img", "retval": None, "status": {},
+                                           "params": {"prompt": f"{key} {i}", "ddim_steps": 5, "n_iter": 2}})["id"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check fair queuing between API keys.")
+    parser.add_argument("--flood", type=int, default=50, help="jobs submitted by the flooding key")
+    parser.add_argument("--others", type=int, default=3, help="jobs submitted by each other key")
+    args = parser.parse_args()
+
+    rest_api_job_queue.models = rest_api_job_queue.default_models
+    rest_api_job_queue.max_batch_images = 1
+
+    #Queue the whole backlog before starting the worker.
+    ids = {"flood": [submit("flood", i) for i in range(args.flood)]}
+    ids["batch"] = [submit("batch", 0, "batch")]
+    for key in ("alice", "bob"):
+        ids[key] = [submit(key, i) for i in range(args.others)]
+    submitted = sum(ids.values(), [])
+    predicted = {i: rest_api_job_queue.get_status(i)["status"]["jobs_ahead"] for i in submitted}
+
+    threading.Thread(target=rest_api_job_queue.process_queue, daemon=True).start()
+
+    while not all(rest_api_job_queue.get_status(i)["done"] for i in submitted):
+        time.sleep(0.01)
+
+    #With a single worker, jobs finish in the order they run.
+    ran = [i for i in rest_api_job_queue.finished if i in submitted]
+    expected = sorted(submitted, key=lambda i: predicted[i])
+    for key, key_ids in ids.items():
+        positions = [ran.index(i) for i in key_ids]
+        print(f"{key}: {len(key_ids)} jobs, ran at positions {positions[:5]}{'...' if len(positions) > 5 else ''}")
+
+    if ran != expected:
+        print(f"Jobs ran in a different order than jobs_ahead predicted: {ran} vs {expected}")
+        return 1
+    if ran[-1] != ids["batch"][0]:
+        print("The batch job ran before interactive jobs.")
+        return 1
+    print("Jobs ran in the order jobs_ahead predicted.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
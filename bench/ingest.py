@@ -0,0 +1,81 @@
+#Check how the API servers take in uploaded images: the size is read from the image
+#header, images over MAX_RESOLUTION are refused without being decoded, and the
+#compressed bytes are what gets pickled to the job queue. Uses the stub webui's PNG
+#encoder, so it needs no PIL:
+#
+#    python bench/ingest.py --size 1024
+import os
+import sys
+import time
+import pickle
+import struct
+import argparse
+from base64 import b64encode
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(bench_dir))
+sys.path.insert(0, bench_dir)
+
+import webui
+import rest_api_common
+
+
+#Minimal headers of the other formats, enough for image_header.
+def headers(width, height):
+    gif = b"GIF89a" + struct.pack("<HH", width, height)
+    jpeg = (b"\xff\xd8" + b"\xff\xe0" + struct.pack(">H", 16) + b"JFIF\x00" + bytes(9) +
+            b"\xff\xc0" + struct.pack(">HBHHB", 17, 8, height, width, 3) + bytes(9))
+    vp8 = b"RIFF" + bytes(4) + b"WEBP" + b"VP8 " + bytes(7) + b"\x9d\x01\x2a" + struct.pack("<HH", width, height)
+    bits = (width - 1) | (height - 1) << 14
+    vp8l = b"RIFF" + bytes(4) + b"WEBP" + b"VP8L" + bytes(4) + b"\x2f" + bits.to_bytes(4, "little")
+    vp8x = b"RIFF" + bytes(4) + b"WEBP" + b"VP8X" + bytes(8) + (width - 1).to_bytes(3, "little") + (height - 1).to_bytes(3, "little")
+    return {"gif": gif, "jpeg": jpeg, "webp (VP8)": vp8, "webp (VP8L)": vp8l, "webp (VP8X)": vp8x}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the image ingest path of the API servers.")
+    parser.add_argument("--size", type=int, default=768, help="width and height of the uploaded image")
+    parser.add_argument("--repeat", type=int, default=1000, help="uploads to time")
+    args = parser.parse_args()
+    ok = True
+
+    png = webui.encode_png(args.size, args.size, 7)
+    url = f"data:image/png;base64,{b64encode(png).decode('ascii')}"
+    rest_api_common.max_resolution = args.size * args.size
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        data = rest_api_common.get_param_image(url)
+    seconds = (time.perf_counter() - start) / args.repeat
+    ok = ok and data == png
+    print(f"{args.size}x{args.size} PNG upload: {seconds * 1e6:.1f} us to check, {len(pickle.dumps(data))} bytes to the "
+          f"job queue (decoded RGB would be {args.size * args.size * 3})")
+
+    #A small file claiming to be huge is refused from its header.
+    bomb = png[:16] + struct.pack(">II", 50000, 50000) + png[24:]
+    start = time.perf_counter()
+    try:
+        rest_api_common.load_param_image(bomb)
+        refused = False
+    except AssertionError as err:
+        refused = True
+        print(f"50000x50000 PNG refused in {(time.perf_counter() - start) * 1e6:.1f} us: {err}")
+    ok = ok and refused
+
+    for name, data in headers(640, 480).items():
+        found = rest_api_common.image_header(data)
+        print(f"{name} header: {found[0]} {found[1]}x{found[2]}")
+        ok = ok and found[1:] == (640, 480)
+
+    try:
+        rest_api_common.get_param_image("data:text/plain;base64,aGVsbG8=")
+        ok = False
+    except AssertionError:
+        pass
+
+    print("Ingest works." if ok else "Ingest is broken.")
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,306 @@
+#End-to-end load test: runs the job queue with the stub webui in this directory
+#behind the real Flask app, drives it with a mix of POST and polling GET traffic,
+#and reports submit and poll latency, jobs per second and the CPU time and peak
+#memory of the job queue and API server. No GPU needed, but Flask (and uwsgi for
+#--server uwsgi) must be installed:
+#
+#    python bench/load.py --clients 16 --jobs 400 --step-delay 0.01 --out load.json
+#    python bench/load.py ... --out new.json --compare load.json
+#
+#The JSON keeps the same keys across commits, so two runs can be compared.
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import subprocess
+import statistics
+import urllib.error
+import urllib.request
+from base64 import b64encode
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, bench_dir)
+
+#Only for its PNG encoder; the stub's delays are read from the environment, which
+#is only set for the job queue.
+import webui as stub
+
+
+#CPU seconds used so far by a process and its children (e.g. uwsgi workers).
+def cpu_seconds(pid):
+    total = 0
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += int(fields[11]) + int(fields[12])
+        except OSError:
+            pass
+    return total / os.sysconf("SC_CLK_TCK")
+
+
+#Peak resident memory, in bytes, of a process and its children, summed.
+def peak_rss(pid):
+    total = 0
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+def process_tree(pid):
+    pids = [pid]
+    for p in pids:
+        try:
+            for tid in os.listdir(f"/proc/{p}/task"):
+                with open(f"/proc/{p}/task/{tid}/children") as f:
+                    pids += [int(c) for c in f.read().split()]
+        except OSError:
+            pass
+    return pids
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(len(values) * q))]
+    return {"count": len(values), "mean_ms": statistics.mean(values) * 1000, "p50_ms": pick(0.5) * 1000,
+            "p90_ms": pick(0.9) * 1000, "p99_ms": pick(0.99) * 1000, "max_ms": values[-1] * 1000}
+
+
+#Make an HTTP request, returning the status, headers and decoded JSON body (or raw bytes).
+def http(method, url, body=None):
+    data = None if body is None else json.dumps(body).encode()
+    req = urllib.request.Request(url, data=data, method=method, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(req, timeout=120) as response:
+            status, headers, raw = response.status, response.headers, response.read()
+    except urllib.error.HTTPError as err:
+        status, headers, raw = err.code, err.headers, err.read()
+    try:
+        return status, headers, json.loads(raw)
+    except ValueError:
+        return status, headers, raw
+
+
+class Client(threading.Thread):
+    def __init__(self, args, base, jobs, stats):
+        super().__init__(daemon=True)
+        self.args = args
+        self.base = base
+        self.jobs = jobs
+        self.stats = stats
+        self.key = f'client{len(stats["clients"])}'
+        self.random = random.Random(len(stats["clients"]))
+        stats["clients"].append(self)
+
+        png = stub.encode_png(args.image_size, args.image_size, 1)
+        self.image = f"data:image/png;base64,{b64encode(png).decode('ascii')}"
+
+
+    def record(self, name, seconds):
+        with self.stats["lock"]:
+            self.stats[name].append(seconds)
+
+
+    def params(self, request_type):
+        params = {"prompt": "load test", "ddim_steps": self.args.steps, "seed": self.random.randrange(2 ** 32),
+                  "width": self.args.image_size, "height": self.args.image_size}
+        if request_type == "img2img":
+            params["init_info_mask"] = {"image": self.image, "mask": self.image}
+        if request_type == "imgproc":
+            params = {"image": self.image}
+        return params
+
+
+    def run(self):
+        key = self.key
+        while True:
+            with self.stats["lock"]:
+                if self.jobs[0] <= 0:
+                    return
+                self.jobs[0] -= 1
+            request_type = self.random.choices(list(self.args.mix), weights=list(self.args.mix.values()))[0]
+
+            #Submit, waiting as told whenever admission control turns us away.
+            while True:
+                start = time.perf_counter()
+                status, headers, body = http("POST", f"{self.base}/{request_type}?key={key}", self.params(request_type))
+                self.record("submit", time.perf_counter() - start)
+                if status != 429:
+                    break
+                with self.stats["lock"]:
+                    self.stats["rejected"] += 1
+                time.sleep(float(headers.get("Retry-After", 1)))
+            if not isinstance(body, dict) or "id" not in body:
+                with self.stats["lock"]:
+                    self.stats["errors"].append(str(body)[:200])
+                continue
+            request_id = body["id"]
+
+            #Poll until done, in the configured style.
+            version = None
+            while True:
+                start = time.perf_counter()
+                if self.args.poll == "long":
+                    url = f"{self.base}/{request_type}/{request_id}/status?key={key}&wait=30"
+                    if version is not None:
+                        url += f"&version={version}"
+                elif self.args.poll == "status":
+                    url = f"{self.base}/{request_type}/{request_id}/status?key={key}"
+                else:
+                    url = f"{self.base}/{request_type}/{request_id}?key={key}"
+                status, headers, body = http("GET", url)
+                self.record("poll", time.perf_counter() - start)
+                if not isinstance(body, dict) or "done" not in body:
+                    with self.stats["lock"]:
+                        self.stats["errors"].append(str(body)[:200])
+                    break
+                if body["done"]:
+                    break
+                version = body.get("version")
+                if self.args.poll != "long":
+                    time.sleep(self.args.poll_interval)
+
+            #Fetch the result.
+            start = time.perf_counter()
+            status, headers, body = http("GET", f"{self.base}/{request_type}/{request_id}?key={key}&images={self.args.images}")
+            self.record("fetch", time.perf_counter() - start)
+            with self.stats["lock"]:
+                if isinstance(body, dict) and body.get("success"):
+                    self.stats["completed"] += 1
+                else:
+                    self.stats["errors"].append(str(body)[:200])
+
+
+#Parse "txt2img=8,img2img=1" into {"txt2img": 8, "img2img": 1}.
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def wait_for(url, seconds):
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        try:
+            if http("GET", url)[0] == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+#Print how each number in the new report changed from the old one.
+def compare(old, new, path=""):
+    for k, v in new.items():
+        if isinstance(v, dict) and isinstance(old.get(k), dict):
+            compare(old[k], v, f"{path}{k}.")
+        elif isinstance(v, (int, float)) and isinstance(old.get(k), (int, float)) and old[k]:
+            print(f"{path}{k}: {old[k]:.4g} -> {v:.4g} ({(v - old[k]) / old[k] * 100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load test with a stub webui.")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent clients, each running one job at a time")
+    parser.add_argument("--jobs", type=int, default=100, help="total jobs to run")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("txt2img=8,img2img=1,imgproc=1"),
+                        help="relative frequency of each request type")
+    parser.add_argument("--poll", choices=["full", "status", "long"], default="status",
+                        help="poll the full request, the status endpoint, or long-poll the status")
+    parser.add_argument("--poll-interval", type=float, default=0.1, help="seconds between polls (not long-polls)")
+    parser.add_argument("--images", choices=["data", "links"], default="data", help="how the results are fetched")
+    parser.add_argument("--steps", type=int, default=20, help="sampling steps per job")
+    parser.add_argument("--step-delay", type=float, default=0.005, help="seconds per stub sampling step")
+    parser.add_argument("--image-size", type=int, default=64, help="width and height of the images")
+    parser.add_argument("--load-delay", type=float, default=0, help="seconds the stub takes to load a model")
+    parser.add_argument("--workers", type=int, default=1, help="queue workers (stub webui processes)")
+    parser.add_argument("--server", choices=["werkzeug", "uwsgi"], default="werkzeug", help="how to serve the Flask app")
+    parser.add_argument("--port", type=int, default=5099, help="API port")
+    parser.add_argument("--queue-port", type=int, default=37998, help="job queue port")
+    parser.add_argument("--out", default=None, help="write the results to this JSON file")
+    parser.add_argument("--compare", default=None, help="compare the results with an earlier JSON file")
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=bench_dir, JOBQUEUE_PORT=str(args.queue_port), STUB_STEP_DELAY=str(args.step_delay),
+               STUB_IMAGE_SIZE=str(args.image_size), STUB_LOAD_DELAY=str(args.load_delay))
+    log = open(os.devnull, "w")
+    script = os.path.join(repo_dir, "rest_api_job_queue.py")
+    processes = [subprocess.Popen([sys.executable, script], cwd=repo_dir, env=env, stdout=log, stderr=log)]
+    processes += [subprocess.Popen([sys.executable, script, "--worker"], cwd=repo_dir, env=env, stdout=log, stderr=log)
+                  for _ in range(args.workers - 1)]
+    if args.server == "uwsgi":
+        api_cmd = ["uwsgi", "--http", f"127.0.0.1:{args.port}", "--master", "-p", "4", "--threads", "8",
+                   "-w", "rest_api_server:api", "--enable-threads"]
+    else:
+        api_cmd = [sys.executable, "-c", f"import rest_api_server; rest_api_server.api.run('127.0.0.1', {args.port}, threaded=True)"]
+    api = subprocess.Popen(api_cmd, cwd=repo_dir, env=env, stdout=log, stderr=log)
+    processes.append(api)
+
+    try:
+        base = f"http://127.0.0.1:{args.port}"
+        if not wait_for(f"{base}/info", 60):
+            print("The API server never came up.")
+            return 1
+        #Let the workers load their stub models before timing anything.
+        time.sleep(1 + args.load_delay)
+
+        stats = {"lock": threading.Lock(), "clients": [], "submit": [], "poll": [], "fetch": [],
+                 "completed": 0, "rejected": 0, "errors": []}
+        jobs = [args.jobs]
+        manager_cpu = cpu_seconds(processes[0].pid)
+        api_cpu = cpu_seconds(api.pid)
+        start = time.perf_counter()
+        clients = [Client(args, base, jobs, stats) for _ in range(args.clients)]
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join()
+        seconds = time.perf_counter() - start
+
+        report = {
+            "commit": subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=repo_dir, capture_output=True, text=True).stdout.strip(),
+            "config": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+            "seconds": seconds,
+            "jobs_completed": stats["completed"],
+            "jobs_per_second": stats["completed"] / seconds,
+            "rejected_429": stats["rejected"],
+            "errors": len(stats["errors"]),
+            "submit_latency": percentiles(stats["submit"]),
+            "poll_latency": percentiles(stats["poll"]),
+            "fetch_latency": percentiles(stats["fetch"]),
+            "polls_per_job": len(stats["poll"]) / max(1, stats["completed"]),
+            "manager": {"cpu_seconds": cpu_seconds(processes[0].pid) - manager_cpu, "peak_rss_bytes": peak_rss(processes[0].pid)},
+            "api_server": {"cpu_seconds": cpu_seconds(api.pid) - api_cpu, "peak_rss_bytes": peak_rss(api.pid)},
+        }
+        print(json.dumps(report, indent=4))
+        for error in stats["errors"][:5]:
+            print(f"Error: {error}")
+
+        if args.out is not None:
+            with open(args.out, "w") as f:
+                json.dump(report, f, indent=4)
+        if args.compare is not None:
+            with open(args.compare) as f:
+                compare(json.load(f), report)
+        return 1 if stats["errors"] else 0
+    finally:
+        for p in processes:
+            p.terminate()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,284 @@
+#Compare the time and peak memory of generate_mixed_model against the original
+#(load everything, then mix) implementation, and check that both write exactly
+#the same checkpoint. Each implementation runs in its own process so that peak
+#memory is measured separately. Peak RSS counts the pages of the memory-mapped
+#checkpoints, which are clean and can be dropped at any time, so the peak of
+#anonymous memory (RssAnon) is what the mix really needs. Also compares mixes
+#applied in memory incrementally against the same mixes applied from scratch.
+#Needs PyTorch, but no GPU:
+#
+#    python bench/mix_checkpoints.py --models 4 --model-mb 1024 --out bench_mix.json
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import threading
+import tempfile
+import traceback
+import subprocess
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(bench_dir))
+
+import rest_api_job_queue
+
+
+#The implementation generate_mixed_model replaced, kept verbatim (apart from the
+#error handling) as the reference for correctness and performance.
+def legacy_mix(in_mix, path):
+    models = rest_api_job_queue.models
+    import torch
+    mix = []
+    models_to_mix = []
+    theta = []
+
+    magnitude = sum([x for x in in_mix])
+    for i in range(0, len(in_mix)):
+        in_mix[i] /= magnitude
+
+    j = 0
+    for i in range(0, len(models)):
+        if in_mix[i] != 0:
+            models_to_mix.append(torch.load(models[i]["path"]))
+            theta.append(models_to_mix[j]['state_dict'])
+            mix.append(in_mix[i])
+            j += 1
+
+    def isFloatingType(tensor):
+        return tensor.dtype in [
+                torch.float, torch.float32,
+                torch.float64, torch.double,
+                torch.float16, torch.half,
+                torch.bfloat16,
+                torch.cfloat,
+                torch.cdouble]
+
+    allkeys = []
+    for i in range(0, len(models_to_mix)):
+        allkeys.extend(theta[i].keys())
+    allkeys = list(dict.fromkeys(allkeys))
+
+    for k in allkeys:
+        if 'model' in k:
+            count = 0
+            total = 0
+            temptheta = 0
+            for i in range(0, len(models_to_mix)):
+                if k in theta[i]:
+                    if k in theta[0] and isFloatingType(theta[0][k]) != isFloatingType(theta[i][k]):
+                        continue
+                    count += 1
+                    total += mix[i]
+                    temptheta += mix[i] * theta[i][k]
+
+            if count > 0:
+                assert total != 0, "Invalid total"
+                theta[0][k] = temptheta / total
+
+    torch.save(models_to_mix[0], path)
+
+
+#Write synthetic checkpoints shaped like SD ones: mostly large float tensors under
+#"model." keys, some keys missing from some models, an integer buffer and a few
+#non-model entries.
+def make_checkpoints(directory, count, model_mb, tensor_mb):
+    import torch
+    torch.manual_seed(0)
+    elements = tensor_mb * 1024 * 1024 // 4
+    tensors = max(1, model_mb // tensor_mb)
+    paths = []
+    for n in range(count):
+        state_dict = {f"model.diffusion_model.block{t}.weight": torch.randn(elements) for t in range(tensors)}
+        state_dict["model.diffusion_model.position_ids"] = torch.arange(77)
+        state_dict[f"model.diffusion_model.only_in_{n}.bias"] = torch.randn(1024)
+        state_dict["cond_stage_model.logit_scale"] = torch.tensor(float(n))
+        path = os.path.join(directory, f"model_{n}.ckpt")
+        torch.save({"state_dict": state_dict, "global_step": n}, path)
+        paths.append(path)
+    return paths
+
+
+#Sample this process's anonymous memory until stopped, keeping the peak in bytes.
+#The kernel only reports the peak of the total RSS.
+def sample_anon(peak, stop):
+    while not stop.is_set():
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("RssAnon:"):
+                    peak[0] = max(peak[0], int(line.split()[1]) * 1024)
+        stop.wait(0.005)
+
+
+#Run one implementation in this process and print its measurements as JSON.
+def run_one(implementation, paths, mix, out):
+    rest_api_job_queue.models = [{"name": f"model_{n}", "path": p} for n, p in enumerate(paths)]
+    mix_fn = legacy_mix if implementation == "legacy" else rest_api_job_queue.generate_mixed_model
+    peak_anon = [0]
+    stop = threading.Event()
+    sampler = threading.Thread(target=sample_anon, args=(peak_anon, stop), daemon=True)
+    if os.path.exists("/proc/self/status"):
+        sampler.start()
+    start = time.perf_counter()
+    mix_fn(list(mix), out)
+    seconds = time.perf_counter() - start
+    stop.set()
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    print(json.dumps({"implementation": implementation, "seconds": seconds, "peak_rss_bytes": peak_rss,
+                      "peak_anon_bytes": peak_anon[0] or None}))
+
+
+#Stands in for webui's model, whose weights apply_mix_in_memory mixes into.
+class BenchModel:
+    def __init__(self, state_dict):
+        self.weights = {k: v.clone() for k, v in state_dict.items()}
+
+
+    def state_dict(self):
+        return self.weights
+
+
+    def load_state_dict(self, state_dict, strict=True):
+        for k, v in state_dict.items():
+            self.weights[k].copy_(v)
+
+
+#Apply a series of mixes in memory, each one incrementally from the last, and compare
+#the weights after each with the same mix applied from scratch. Prints the results
+#as JSON.
+def run_remix(paths, mixes):
+    import types
+    import torch
+    rest_api_job_queue.models = [{"name": f"model_{n}", "path": p} for n, p in enumerate(paths)]
+    first = torch.load(paths[0], map_location="cpu")["state_dict"]
+    incremental_model = BenchModel(first)
+    full_model = BenchModel(first)
+    del first
+
+    peak_anon = [0]
+    stop = threading.Event()
+    if os.path.exists("/proc/self/status"):
+        threading.Thread(target=sample_anon, args=(peak_anon, stop), daemon=True).start()
+
+    results = []
+    incremental_state = None
+    for mix in mixes:
+        sys.modules["webui"] = types.SimpleNamespace(model=full_model)
+        rest_api_job_queue.applied_mix = None
+        start = time.perf_counter()
+        rest_api_job_queue.apply_mix_in_memory(list(mix), False)
+        full_seconds = time.perf_counter() - start
+
+        sys.modules["webui"] = types.SimpleNamespace(model=incremental_model)
+        rest_api_job_queue.applied_mix = incremental_state
+        start = time.perf_counter()
+        rest_api_job_queue.apply_mix_in_memory(list(mix), False)
+        incremental_seconds = time.perf_counter() - start
+        incremental_state = rest_api_job_queue.applied_mix
+
+        identical = True
+        max_error = 0.0
+        for k, full in full_model.weights.items():
+            mixed = incremental_model.weights[k]
+            if not torch.equal(full, mixed):
+                identical = False
+                if full.is_floating_point():
+                    max_error = max(max_error, ((mixed - full).abs().max() / full.abs().max()).item())
+        results.append({"mix": mix, "deltas": incremental_state["deltas"], "identical": identical, "max_relative_error": max_error,
+                        "full_seconds": full_seconds, "incremental_seconds": incremental_seconds})
+    stop.set()
+    print(json.dumps({"remixes": results, "peak_anon_bytes": peak_anon[0] or None}))
+
+
+#Check two checkpoints hold exactly the same tensors and other entries.
+def compare(a_path, b_path):
+    import torch
+    a = torch.load(a_path, map_location="cpu")
+    b = torch.load(b_path, map_location="cpu")
+    a_sd = a.pop("state_dict")
+    b_sd = b.pop("state_dict")
+    if a != b or list(a_sd) != list(b_sd):
+        return False
+    for k in a_sd:
+        if a_sd[k].dtype != b_sd[k].dtype or not torch.equal(a_sd[k], b_sd[k]):
+            print(f"Mismatch in {k}")
+            return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark checkpoint mixing.")
+    parser.add_argument("--models", type=int, default=4, help="number of checkpoints to mix")
+    parser.add_argument("--model-mb", type=int, default=512, help="size of each checkpoint")
+    parser.add_argument("--tensor-mb", type=int, default=64, help="size of each tensor in a checkpoint")
+    parser.add_argument("--remixes", type=int, default=10, help="mixes to apply in memory, one weight changing each time")
+    parser.add_argument("--out", default=None, help="write the results to this JSON file")
+    parser.add_argument("--run", choices=["legacy", "streaming", "remix"], help=argparse.SUPPRESS)
+    parser.add_argument("--paths", nargs="*", help=argparse.SUPPRESS)
+    parser.add_argument("--mix", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--output", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run == "remix":
+        run_remix(args.paths, json.loads(args.mix))
+        return 0
+    if args.run is not None:
+        run_one(args.run, args.paths, json.loads(args.mix), args.output)
+        return 0
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_checkpoints(directory, args.models, args.model_mb, args.tensor_mb)
+        mix = [n + 1 for n in range(args.models)]
+        report = {"models": args.models, "model_mb": args.model_mb, "mix": mix, "runs": []}
+
+        outputs = {}
+        for implementation in ("legacy", "streaming"):
+            outputs[implementation] = os.path.join(directory, f"{implementation}.ckpt")
+            cmd = [sys.executable, os.path.abspath(__file__), "--run", implementation, "--paths", *paths,
+                   "--mix", json.dumps(mix), "--output", outputs[implementation]]
+            proc = subprocess.run(cmd, capture_output=True, text=True)
+            if proc.returncode != 0:
+                print(proc.stdout, proc.stderr)
+                return 1
+            run = json.loads(proc.stdout.strip().splitlines()[-1])
+            report["runs"].append(run)
+            anon = "unknown" if run["peak_anon_bytes"] is None else f'{run["peak_anon_bytes"] / 2**20:.0f} MiB'
+            print(f'{implementation}: {run["seconds"]:.2f} s, peak RSS {run["peak_rss_bytes"] / 2**20:.0f} MiB, '
+                  f'peak anonymous memory {anon}')
+
+        try:
+            report["identical"] = compare(outputs["legacy"], outputs["streaming"])
+        except Exception:
+            print(traceback.format_exc())
+            report["identical"] = False
+        print(f'Outputs identical: {report["identical"]}')
+
+        #Slide the weight of the second model, as an interpolation animation would.
+        remixes = [[n + 1.0 + (step / 4 if n == 1 else 0) for n in range(args.models)] for step in range(args.remixes)]
+        cmd = [sys.executable, os.path.abspath(__file__), "--run", "remix", "--paths", *paths, "--mix", json.dumps(remixes)]
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(proc.stdout, proc.stderr)
+            return 1
+        remix_run = json.loads(proc.stdout.strip().splitlines()[-1])
+        report["remixes"] = remix_run["remixes"]
+        report["remix_peak_anon_bytes"] = remix_run["peak_anon_bytes"]
+        for remix in report["remixes"]:
+            print(f'Mix {remix["mix"]} in memory: {remix["full_seconds"]:.2f} s from scratch, '
+                  f'{remix["incremental_seconds"]:.2f} s after {remix["deltas"]} deltas, '
+                  f'identical: {remix["identical"]}, max relative error {remix["max_relative_error"]:.1e}')
+        if report["remix_peak_anon_bytes"] is not None:
+            print(f'In-memory mixes: peak anonymous memory {report["remix_peak_anon_bytes"] / 2**20:.0f} MiB, '
+                  f'holding two copies of the model (mixed incrementally and from scratch)')
+        #Incremental mixes round differently; REMIX_REFRESH bounds how far they drift.
+        report["remix_close"] = all(r["max_relative_error"] < 1e-5 for r in report["remixes"])
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=4)
+    return 0 if report["identical"] and report["remix_close"] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
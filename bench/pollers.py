@@ -0,0 +1,255 @@
+#Hold thousands of long-polling clients in one ASGI server process and measure how
+#quickly they all see their jobs finish, compared with one blocking thread per
+#client (as the Flask server under uwsgi needs). Starts the job queue with the stub
+#webui in this directory and calls the ASGI app in-process, so it needs neither an
+#ASGI server nor a GPU. Also checks the other routes once, and the image download
+#routes of the Flask app with its test client:
+#
+#    python bench/pollers.py --pollers 2000 --jobs 20
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import threading
+import subprocess
+import statistics
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, repo_dir)
+
+
+#Call the ASGI app like a server would. Returns the status, headers and body.
+async def call(app, method, path, query="", body=b"", headers=()):
+    scope = {"type": "http", "method": method, "path": path, "query_string": query.encode(),
+             "headers": [(k.encode(), v.encode()) for k, v in headers]}
+    received = []
+    response = {"chunks": []}
+
+    async def receive():
+        if not received:
+            received.append(True)
+            return {"type": "http.request", "body": body, "more_body": False}
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = {k.decode(): v.decode() for k, v in message["headers"]}
+        else:
+            response["chunks"].append(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return response["status"], response["headers"], b"".join(response["chunks"])
+
+
+#Submit the jobs to poll, behind one that takes a couple of seconds so that every
+#poller is waiting before the first of them finishes.
+def submit_jobs(queue, args):
+    submit(queue, "holder", int(2 / args.step_delay))
+    return [submit(queue, n, args.steps) for n in range(args.jobs)]
+
+
+def submit(queue, n, steps):
+    return queue.add_request({"done": False, "key": "bench", "model": "", "include_logs": False, "cache": False,
+                              "type": "txt2img", "retval": None, "status": {},
+                              "params": {"prompt": f"job {n}", "ddim_steps": steps}})["id"]
+
+
+#Check each route of the ASGI app once.
+async def check_routes(app):
+    ok = True
+    def expect(what, condition):
+        nonlocal ok
+        if not condition:
+            print(f"Route check failed: {what}")
+            ok = False
+
+    status, _, body = await call(app, "GET", "/info")
+    expect("/info", status == 200 and "samplers" in json.loads(body))
+
+    status, _, body = await call(app, "POST", "/txt2img", "key=bench&cache=false", json.dumps({"prompt": "route check", "ddim_steps": 5}).encode(),
+                                 [("content-type", "application/json")])
+    request_id = json.loads(body)["id"]
+    expect("POST /txt2img", status == 200 and request_id > 0)
+
+    status, headers, body = await call(app, "GET", f"/txt2img/{request_id}/events", "key=bench")
+    events = [json.loads(line[len("data: "):]) for line in body.decode().split("\n") if line.startswith("data: ")]
+    expect("/events", headers["content-type"] == "text/event-stream" and events and events[-1]["done"])
+
+    status, _, body = await call(app, "GET", f"/txt2img/{request_id}", "key=bench")
+    expect("GET /txt2img/<id>", json.loads(body)["retval"][0][0].startswith("data:image/png;base64,"))
+    status, _, body = await call(app, "GET", f"/txt2img/{request_id}", "key=other")
+    expect("key check", "Authorization denied" in json.loads(body)["error"])
+    status, _, body = await call(app, "GET", f"/txt2img/{request_id}", "key=bench&images=links")
+    expect("links", json.loads(body)["retval"][0] == [f"/txt2img/{request_id}/image/0"])
+
+    status, headers, png = await call(app, "GET", f"/txt2img/{request_id}/image/0", "key=bench")
+    expect("image", status == 200 and png.startswith(b"\x89PNG"))
+    status, _, part = await call(app, "GET", f"/txt2img/{request_id}/image/0", "key=bench", headers=[("range", "bytes=8-15")])
+    expect("image range", status == 206 and part == png[8:16])
+    status, _, _ = await call(app, "GET", f"/txt2img/{request_id}/image/0", "key=bench", headers=[("if-none-match", headers["etag"])])
+    expect("image etag", status == 304)
+
+    status, _, body = await call(app, "GET", f"/imgproc/{request_id}/status", "key=bench")
+    expect("type check", "is txt2img" in json.loads(body)["error"])
+    status, _, body = await call(app, "GET", "/weights", "key=admin")
+    expect("/weights", status == 200 and "weights" in json.loads(body))
+    status, _, body = await call(app, "GET", "/metrics")
+    expect("/metrics", status == 200 and b"sdapi_http_request_seconds" in body)
+    status, _, _ = await call(app, "GET", "/nowhere")
+    expect("404", status == 404)
+    status, _, _ = await call(app, "POST", "/info")
+    expect("405", status == 405)
+    return ok
+
+
+#Check the image download routes of the Flask app once.
+def check_flask_routes(api):
+    ok = True
+    def expect(what, condition):
+        nonlocal ok
+        if not condition:
+            print(f"Flask route check failed: {what}")
+            ok = False
+
+    client = api.test_client()
+    response = client.post("/txt2img?key=bench&cache=false", json={"prompt": "flask route check", "ddim_steps": 5})
+    request_id = json.loads(response.data)["id"]
+    expect("POST /txt2img", response.status_code == 200 and request_id > 0)
+    while not json.loads(client.get(f"/txt2img/{request_id}/status?key=bench&wait=30").data)["done"]:
+        pass
+
+    response = client.get(f"/txt2img/{request_id}/image/0?key=bench")
+    png = response.data
+    expect("image", response.status_code == 200 and png.startswith(b"\x89PNG"))
+    response = client.get(f"/txt2img/{request_id}/image/0?key=bench", headers={"Range": "bytes=8-15"})
+    expect("image range", response.status_code == 206 and response.data == png[8:16])
+    etag = client.get(f"/txt2img/{request_id}/image/0?key=bench").headers.get("ETag")
+    response = client.get(f"/txt2img/{request_id}/image/0?key=bench", headers={"If-None-Match": etag})
+    expect("image etag", etag is not None and response.status_code == 304)
+    return ok
+
+
+#Long-poll one job until it is done, returning when the poller saw it finish.
+async def long_poll(app, request_id):
+    version = None
+    polls = 0
+    while True:
+        query = "key=bench&wait=30" + ("" if version is None else f"&version={version}")
+        status, _, body = await call(app, "GET", f"/txt2img/{request_id}/status", query)
+        polls += 1
+        status = json.loads(body)
+        if status["done"]:
+            return time.perf_counter(), polls
+        version = status["version"]
+
+
+#Run the pollers of the ASGI app; returns when each saw its job finish.
+def run_asgi(app, queue, args):
+    async def main():
+        ids = submit_jobs(queue, args)
+        tasks = [long_poll(app, ids[n % len(ids)]) for n in range(args.pollers)]
+        start = time.perf_counter()
+        peak = [threading.active_count()]
+        async def sample_threads():
+            while True:
+                peak[0] = max(peak[0], threading.active_count())
+                await asyncio.sleep(0.05)
+        sampler = asyncio.ensure_future(sample_threads())
+        results = await asyncio.gather(*tasks)
+        sampler.cancel()
+        return ids, start, results, peak[0]
+    return asyncio.run(main())
+
+
+#Run the pollers with a blocking thread each, as the Flask server does.
+def run_threads(queue_module, queue, args):
+    ids = submit_jobs(queue, args)
+    results = [None] * args.pollers
+    #The job queue's listener has a short backlog, so don't connect all at once.
+    connecting = threading.Semaphore(8)
+    def poll(n):
+        with connecting:
+            proxy = queue_module.connect_queue()
+            proxy.get_info()
+        request_id = ids[n % len(ids)]
+        version, polls = None, 0
+        while True:
+            status = proxy.wait_for_status(request_id, version, 30) if version is not None else proxy.get_status(request_id)
+            polls += 1
+            if status["done"]:
+                results[n] = (time.perf_counter(), polls)
+                return
+            version = status["version"]
+    start = time.perf_counter()
+    threads = [threading.Thread(target=poll, args=(n,), daemon=True) for n in range(args.pollers)]
+    for t in threads:
+        t.start()
+    peak = threading.active_count()
+    for t in threads:
+        t.join()
+    return ids, start, results, peak
+
+
+#How long after the first poller of a job saw it finish the last one did.
+def report(label, queue, args, ids, start, results, peak):
+    seen = {}
+    for n, (at, polls) in enumerate(results):
+        seen.setdefault(ids[n % len(ids)], []).append(at)
+    spread = [max(times) - min(times) for times in seen.values()]
+    polls = sum(p for _, p in results)
+    print(f"{label}: {args.pollers} pollers of {args.jobs} jobs done in {max(at for at, _ in results) - start:.2f} s, "
+          f"{polls / args.pollers:.1f} polls each, peak {peak} threads, "
+          f"fan-out spread mean {statistics.mean(spread) * 1000:.1f} ms, max {max(spread) * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure long-polling with the ASGI server.")
+    parser.add_argument("--pollers", type=int, default=2000, help="concurrent long-polling clients")
+    parser.add_argument("--jobs", type=int, default=20, help="jobs the pollers are spread over")
+    parser.add_argument("--steps", type=int, default=10, help="sampler steps per job")
+    parser.add_argument("--step-delay", type=float, default=0.01, help="seconds per stub sampler step")
+    parser.add_argument("--threads", action="store_true", help="also run one blocking thread per poller, for comparison")
+    parser.add_argument("--port", type=int, default=37997, help="job queue port")
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=bench_dir, JOBQUEUE_PORT=str(args.port), STUB_STEP_DELAY=str(args.step_delay),
+               MAX_BATCH_IMAGES="1")
+    os.environ.update(env)
+    import rest_api_job_queue
+    import rest_api_asgi
+    import rest_api_server
+
+    log = open(os.devnull, "w")
+    manager = subprocess.Popen([sys.executable, os.path.join(repo_dir, "rest_api_job_queue.py")], cwd=repo_dir, env=env,
+                               stdout=log, stderr=log)
+    try:
+        for _ in range(300):
+            try:
+                queue = rest_api_job_queue.connect_queue()
+                if len(queue.get_workers()["workers"]) > 0:
+                    break
+            except (EOFError, OSError):
+                pass
+            time.sleep(0.1)
+        else:
+            print("The job queue never started.")
+            return 1
+
+        if not asyncio.run(check_routes(rest_api_asgi.app)) or not check_flask_routes(rest_api_server.api):
+            return 1
+        print("All routes work.")
+
+        report("ASGI", queue, args, *run_asgi(rest_api_asgi.app, queue, args))
+        if args.threads:
+            report("Thread per poller", queue, args, *run_threads(rest_api_job_queue, queue, args))
+        return 0
+    finally:
+        manager.kill()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+#Measure what per-step progress reports cost a worker: the delta of the fields that
+#changed, sent once for a whole batch, against the full status dict per job that
+#workers used to send. Starts the job queue with the stub webui in this directory,
+#without a worker, and reports progress on jobs it claims itself:
+#
+#    python bench/progress.py --steps 2000 --batch 4
+import os
+import sys
+import time
+import pickle
+import argparse
+import subprocess
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, repo_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the cost of progress reports.")
+    parser.add_argument("--steps", type=int, default=2000, help="sampler steps to report")
+    parser.add_argument("--batch", type=int, default=4, help="jobs in the batch being reported on")
+    parser.add_argument("--port", type=int, default=37995, help="job queue port")
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=bench_dir, JOBQUEUE_PORT=str(args.port), LOCAL_WORKER="0", IMAGE_SPOOL_DIR="",
+               MAX_BATCH_IMAGES=str(args.batch), BATCH_WAIT="0.5")
+    os.environ.update(env)
+    import rest_api_job_queue
+    from rest_api_job_progress import JobProgress
+
+    log = open(os.devnull, "w")
+    manager = subprocess.Popen([sys.executable, os.path.join(repo_dir, "rest_api_job_queue.py")], cwd=repo_dir, env=env,
+                               stdout=log, stderr=log)
+    try:
+        for _ in range(300):
+            try:
+                queue = rest_api_job_queue.connect_queue()
+                queue.get_info()
+                break
+            except (EOFError, OSError):
+                time.sleep(0.1)
+        else:
+            print("The job queue never started.")
+            return 1
+
+        for n in range(args.batch):
+            queue.add_request({"done": False, "key": "bench", "model": "", "include_logs": False, "cache": False,
+                               "type": "txt2img", "retval": None, "status": {},
+                               "params": {"prompt": f"job {n}", "ddim_steps": args.steps}})
+        ids = [r["id"] for r in queue.claim_jobs("bench", rest_api_job_queue.default_models[0]["name"], True, 5)]
+
+        progress = JobProgress()
+        queue.report_progress("bench", ids, progress.update(cur_task="model_eval", step=0, iter=0, total_steps=args.steps, total_iters=1))
+        start = time.perf_counter()
+        for step in range(args.steps):
+            delta = progress.update(step=step)
+            queue.report_progress("bench", ids, delta)
+        delta_seconds = (time.perf_counter() - start) / args.steps
+        status = queue.get_status(ids[-1])["status"]
+        ok = status["step"] == args.steps - 1 and status["total_steps"] == args.steps
+
+        #What each step cost before: the whole status dict, sent for every job of the batch.
+        start = time.perf_counter()
+        for step in range(args.steps):
+            status = {"jobs_ahead": 0, "cur_task": "model_eval", "step": step, "iter": 0, "total_steps": args.steps, "total_iters": 1}
+            for i in ids:
+                queue.update_request({"id": i, "status": status})
+        full_seconds = (time.perf_counter() - start) / args.steps
+
+        print(f"Batch of {len(ids)} jobs, per sampler step: delta {len(pickle.dumps(delta))} bytes in one call, "
+              f"{delta_seconds * 1e6:.0f} us; full status {len(pickle.dumps(status))} bytes in {len(ids)} calls, "
+              f"{full_seconds * 1e6:.0f} us")
+        print("Progress arrives." if ok else "Progress was lost.")
+        return 0 if ok else 1
+    finally:
+        manager.kill()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
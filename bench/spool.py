@@ -0,0 +1,120 @@
+#Check that images pass between the API server, the job queue and a worker on the
+#same host as files in the image spool, with only handles going through the queue,
+#and compare fetching results that way with fetching them through the queue. Starts
+#the job queue and a separate worker process with the stub webui in this directory:
+#
+#    python bench/spool.py --jobs 20 --size 512
+import os
+import sys
+import json
+import time
+import pickle
+import argparse
+import tempfile
+import subprocess
+from base64 import b64encode
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, repo_dir)
+sys.path.insert(0, bench_dir)
+
+
+def wait(common, ids):
+    while not all(common.call_queue("get_status", i)["done"] for i in ids):
+        time.sleep(0.01)
+
+
+#Time fetching the results of the jobs n times each; returns seconds per fetch and the images.
+def fetch(n, ids, get):
+    images = []
+    start = time.perf_counter()
+    for _ in range(n):
+        images = [get(i) for i in ids]
+    return (time.perf_counter() - start) / (n * len(ids)), images
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check image transfer through the image spool.")
+    parser.add_argument("--jobs", type=int, default=20, help="txt2img jobs to fetch the results of")
+    parser.add_argument("--size", type=int, default=512, help="width and height of the generated images")
+    parser.add_argument("--repeat", type=int, default=10, help="times to fetch each result")
+    parser.add_argument("--port", type=int, default=37996, help="job queue port")
+    args = parser.parse_args()
+
+    spool_dir = os.path.join(tempfile.mkdtemp(), "spool")
+    env = dict(os.environ, PYTHONPATH=bench_dir, JOBQUEUE_PORT=str(args.port), IMAGE_SPOOL_DIR=spool_dir,
+               LOCAL_WORKER="0", STUB_IMAGE_SIZE=str(args.size), STUB_IMAGE_NOISE="1", STUB_STEP_DELAY="0.01")
+    os.environ.update(env)
+    import webui
+    import rest_api_common
+    from rest_api_image_spool import SpooledImages
+
+    log = open(os.devnull, "w")
+    processes = [subprocess.Popen([sys.executable, os.path.join(repo_dir, "rest_api_job_queue.py")] + extra, cwd=repo_dir,
+                                  env=env, stdout=log, stderr=log) for extra in ([], ["--worker"])]
+    ok = True
+    try:
+        for _ in range(300):
+            try:
+                if len(rest_api_common.call_queue("get_workers")["workers"]) > 0:
+                    break
+            except (EOFError, OSError):
+                pass
+            time.sleep(0.1)
+        else:
+            print("The job queue never started.")
+            return 1
+        ok = ok and rest_api_common.get_spool() is not None
+
+        #Results: the worker spools them, and the API server reads them from the files.
+        ids = []
+        for n in range(args.jobs):
+            body = rest_api_common.add_job("txt2img", "bench", False, "", "batch", False,
+                                           {"prompt": f"job {n}", "ddim_steps": 5, "seed": n}, {})
+            ids.append(json.loads(body)["id"])
+        wait(rest_api_common, ids)
+        handle = rest_api_common.call_queue("get_result", ids[0], True)
+        ok = ok and isinstance(handle, SpooledImages)
+        print(f"Results held as spool files: {isinstance(handle, SpooledImages)}, "
+              f"{len(pickle.dumps(handle))} bytes through the queue for a {handle.size} byte result")
+
+        spooled, from_spool = fetch(args.repeat, ids, rest_api_common.get_result_images)
+        sent, from_queue = fetch(args.repeat, ids, lambda i: rest_api_common.call_queue("get_result", i))
+        ok = ok and from_spool == from_queue and [bytes(i[0]) for i in from_spool] == [webui.encode_png(args.size, args.size, n) for n in range(args.jobs)]
+        print(f"Fetching a result: {spooled * 1000:.2f} ms from the spool, {sent * 1000:.2f} ms through the queue")
+
+        #Uploads: the API server spools them, and the queue removes them when the job is done.
+        holder = rest_api_common.add_job("txt2img", "bench", False, "", "batch", False, {"prompt": "holder", "ddim_steps": 200}, {})
+        png = webui.encode_png(args.size, args.size, 1)
+        url = f"data:image/png;base64,{b64encode(png).decode('ascii')}"
+        body = rest_api_common.add_job("imgproc", "bench", False, "", "batch", False, {"image": url}, {})
+        upload = json.loads(body)["id"]
+        image = rest_api_common.call_queue("get_request", upload)["params"]["image"]
+        uploaded = isinstance(image, SpooledImages) and os.path.exists(image.path) and rest_api_common.read_images(image, 0) == png
+        rest_api_common.call_queue("cancel", upload)
+        rest_api_common.call_queue("cancel", json.loads(holder)["id"])
+        removed = not os.path.exists(image.path)
+        print(f"Upload spooled: {uploaded}, removed once done: {removed}")
+        ok = ok and uploaded and removed
+
+        #The worker decodes spooled uploads, so webui gets PIL images.
+        ids = [json.loads(rest_api_common.add_job(request_type, "bench", False, "", "batch", False, params, {}))["id"]
+               for request_type, params in (("img2img", {"prompt": "decode", "ddim_steps": 5, "init_info_mask": {"image": url, "mask": url}}),
+                                            ("imgproc", {"image": url}))]
+        wait(rest_api_common, ids)
+        img2img, imgproc = [rest_api_common.call_queue("get_request", i) for i in ids]
+        info = img2img["retval"][2] if img2img["retval"] is not None else img2img["status"]
+        decoded = imgproc["retval"] is not None and str(info).endswith("inputs: {'image': 'PngImageFile', 'mask': 'PngImageFile'}")
+        print(f"Uploads decoded for webui: {decoded} ({info})")
+        ok = ok and decoded
+    finally:
+        for p in processes:
+            p.terminate()
+
+    print("The image spool works." if ok else "The image spool is broken.")
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+#Deterministic stand-in for sd-webui so the job queue can be exercised
+#without a GPU. Put this directory first on sys.path (or PYTHONPATH) and
+#rest_api_job_queue will import it in place of the real webui.
+import os
+import time
+import struct
+import zlib
+import random
+import threading
+
+#Tunables, read once at import (and again on every importlib.reload).
+step_delay = float(os.getenv("STUB_STEP_DELAY", 0))
+load_delay = float(os.getenv("STUB_LOAD_DELAY", 0))
+image_size = int(os.getenv("STUB_IMAGE_SIZE", 64))
+image_noise = os.getenv("STUB_IMAGE_NOISE", "0") != "0" #Incompressible pixels, so PNGs are as big as real ones.
+
+#Set at the start of every generation call so benchmarks can measure dispatch latency.
+job_started = threading.Event()
+job_started_at = 0.0
+calls = 0
+
+#txt2img takes a list of prompts and a list of seeds (one per image), so the
+#queue may batch jobs with different prompts into a single call. Set to 0 to
+#behave like stock webui, which takes one prompt and seed per call.
+supports_prompt_batches = os.getenv("STUB_PROMPT_BATCHES", "1") != "0"
+
+time.sleep(load_delay)
+
+
+#Just enough of PIL.Image's interface for the queue and the API server.
+class StubImage:
+    def __init__(self, width, height, shade=0):
+        self.size = (width, height)
+        self.width = width
+        self.height = height
+        self.mode = "RGB"
+        self.shade = shade
+
+    def save(self, fp, format="PNG", **kwargs):
+        fp.write(encode_png(self.width, self.height, self.shade))
+
+
+#Build a solid-colour RGB PNG by hand so the stub does not depend on PIL.
+def encode_png(width, height, shade):
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+    row = b"\x00" + bytes([shade & 0xff, (shade * 7) & 0xff, (shade * 13) & 0xff]) * width
+    pixels = row * height
+    if image_noise:
+        noise = random.Random(shade)
+        pixels = b"".join(row[:4] + noise.randbytes(3 * width - 3) for _ in range(height))
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(pixels)) + chunk(b"IEND", b"")
+
+
+def mark_started():
+    global job_started_at
+    global calls
+    job_started_at = time.perf_counter()
+    calls += 1
+    job_started.set()
+
+
+#Pretend to sample, reporting progress the same way webui does.
+def run_steps(steps, iters, job_info, callback):
+    for it in range(iters):
+        for step in range(steps):
+            if job_info is not None and job_info.should_stop.is_set():
+                return
+            if callback is not None:
+                callback({"i": step, "iter": it, "total_steps": steps, "total_iters": iters})
+            if step_delay:
+                time.sleep(step_delay)
+
+
+#Each image is shaded by its seed, so results split from a batch can be checked.
+def image_seeds(seed, count):
+    if isinstance(seed, list):
+        return seed
+    try:
+        return [int(seed) + i for i in range(count)]
+    except (TypeError, ValueError):
+        return list(range(count))
+
+
+def txt2img(prompt="", ddim_steps=1, n_iter=1, batch_size=1, width=None, height=None, seed=0, job_info=None, callback=None, **kwargs):
+    if not supports_prompt_batches and (isinstance(prompt, list) or isinstance(seed, list)):
+        raise TypeError("Stock webui takes one prompt and seed per call.")
+    mark_started()
+    width = width or image_size
+    height = height or image_size
+    run_steps(ddim_steps, n_iter, job_info, callback)
+    images = [StubImage(width, height, s) for s in image_seeds(seed, n_iter * batch_size)]
+    return images, seed, f"stub txt2img: {prompt}"
+
+
+#webui works on decoded images; fail like it would on anything else. Returns the
+#type of the image, for benchmarks to check.
+def check_input(image):
+    if not (hasattr(image, "size") and hasattr(image, "mode")):
+        raise TypeError(f"Expected a decoded image, got {type(image).__name__}.")
+    return type(image).__name__
+
+
+def img2img(prompt="", init_info_mask=None, ddim_steps=1, n_iter=1, batch_size=1, width=None, height=None, seed=0, job_info=None, callback=None, **kwargs):
+    mark_started()
+    inputs = {k: check_input(v) for k, v in (init_info_mask or {}).items() if k in ("image", "mask")}
+    width = width or image_size
+    height = height or image_size
+    run_steps(ddim_steps, n_iter, job_info, callback)
+    images = [StubImage(width, height, i) for i in range(n_iter * batch_size)]
+    return images, seed, f"stub img2img: {prompt}; inputs: {inputs}"
+
+
+def imgproc(image=None, callback=None, **kwargs):
+    mark_started()
+    check_input(image)
+    run_steps(1, 1, None, callback)
+    return [StubImage(image_size, image_size)]
@@ -0,0 +1,103 @@
+#Run the job queue with several worker processes on this machine, each with the
+#stub webui in this directory, and check that every job completes. With --kill,
+#one worker is killed mid-job to check that its job is requeued once its lease
+#expires. Needs neither a GPU nor the API server:
+#
+#    python bench/workers.py --workers 4 --jobs 40 --kill
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import subprocess
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, repo_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exercise the job queue with several workers.")
+    parser.add_argument("--workers", type=int, default=4, help="number of worker processes")
+    parser.add_argument("--jobs", type=int, default=40, help="number of jobs to submit")
+    parser.add_argument("--steps", type=int, default=10, help="sampler steps per job")
+    parser.add_argument("--step-delay", type=float, default=0.02, help="seconds per stub sampler step")
+    parser.add_argument("--lease", type=float, default=2, help="worker lease in seconds")
+    parser.add_argument("--port", type=int, default=37999, help="job queue port")
+    parser.add_argument("--kill", action="store_true", help="kill one worker while it runs a job")
+    parser.add_argument("--out", default=None, help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=bench_dir, JOBQUEUE_PORT=str(args.port), WORKER_LEASE=str(args.lease),
+               LOCAL_WORKER="0", STUB_STEP_DELAY=str(args.step_delay), MAX_BATCH_IMAGES="1")
+    os.environ.update(env)
+    import rest_api_job_queue
+
+    script = os.path.join(repo_dir, "rest_api_job_queue.py")
+    log = open(os.devnull, "w")
+    manager = subprocess.Popen([sys.executable, script], cwd=repo_dir, env=env, stdout=log, stderr=log)
+    workers = [subprocess.Popen([sys.executable, script, "--worker"], cwd=repo_dir, env=env, stdout=log, stderr=log)
+               for _ in range(args.workers)]
+    try:
+        queue = None
+        for _ in range(300):
+            try:
+                queue = rest_api_job_queue.connect_queue()
+                if len(queue.get_workers()["workers"]) == args.workers:
+                    break
+            except (EOFError, OSError):
+                pass
+            time.sleep(0.1)
+        else:
+            print("Workers never joined the job queue.")
+            return 1
+
+        start = time.perf_counter()
+        ids = []
+        for i in range(args.jobs):
+            request = queue.add_request({"done": False, "key": "", "model": "", "include_logs": False, "type": "txt2img",
+                                         "params": {"prompt": f"job {i}", "ddim_steps": args.steps, "seed": i},
+                                         "retval": None, "status": {}})
+            ids.append(request["id"])
+
+        killed = None
+        if args.kill:
+            #Kill the worker running the first job, once it's under way.
+            while killed is None:
+                for worker_id, worker in queue.get_workers()["workers"].items():
+                    if ids[0] in worker["jobs"]:
+                        killed = int(worker_id.rsplit(":", 1)[1])
+                time.sleep(0.01)
+            os.kill(killed, signal.SIGKILL)
+
+        timeout = time.perf_counter() + 60 + args.jobs * args.steps * args.step_delay
+        while not all(queue.get_status(i)["done"] for i in ids):
+            if time.perf_counter() > timeout:
+                print("Timed out waiting for the jobs to finish.")
+                return 1
+            time.sleep(0.05)
+        seconds = time.perf_counter() - start
+
+        failed = [i for i in ids if not queue.get_status(i).get("success") or queue.get_result_count(i) != 1]
+        stats = queue.get_workers()
+
+        #The workers send their metrics with their next heartbeat.
+        time.sleep(args.lease / 2)
+        sampled = [l for l in queue.get_metrics().splitlines() if l.startswith("sdapi_sampling_steps_per_second_count")]
+        report = {"workers": args.workers, "jobs": args.jobs, "seconds": seconds, "jobs_per_second": args.jobs / seconds,
+                  "failed": failed, "killed_worker": killed, "expired_workers": stats["expired"],
+                  "claimed": {i: w["claimed"] for i, w in stats["workers"].items()},
+                  "sampling_metrics": sampled}
+        print(json.dumps(report, indent=4))
+        if args.out is not None:
+            with open(args.out, "w") as f:
+                json.dump(report, f, indent=4)
+        return 1 if failed or (args.kill and stats["expired"] != 1) else 0
+    finally:
+        for p in workers + [manager]:
+            p.kill()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
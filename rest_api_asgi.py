@@ -0,0 +1,529 @@
+#An asyncio (ASGI) version of the API server in rest_api_server, with the same routes
+#and responses, for serving many slow or waiting clients from each process. Run it
+#with any ASGI server, for example:
+#
+#    uvicorn rest_api_asgi:app --host 0.0.0.0 --port 5000 --workers 4
+#
+#Handlers never block the event loop on the job queue. Calls to it (and the image
+#conversions around them) run on a small pool of threads, each keeping its own
+#connection. Long-polls and event streams don't hold a thread each: one thread per
+#process waits for the status changes of every request (wait_for_changes) and wakes
+#the clients waiting on the ones that changed.
+
+#For environment variables
+import os
+
+#For timing requests
+import time
+
+#For the event loop and the threads it hands blocking calls to
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+#For image download ETags
+import hashlib
+
+#For parsing requests
+import json
+from urllib.parse import parse_qs
+from email.parser import BytesParser
+from email.policy import HTTP
+
+#For the job queue connection, settings and handlers shared with the Flask server
+from rest_api_common import admin_key, max_status_wait, request_types, image_mimetypes, \
+    call_queue, check_status, add_job, handle_get, get_image
+
+#For the /metrics endpoint. The job queue keeps the metrics of the whole service.
+from rest_api_metrics import metrics
+
+#Job queue calls run on this many threads per process. They are short, except for
+#adding a job with images to decode and fetching results to encode.
+rpc_threads = int(os.getenv("RPC_THREADS", 16))
+rpc_pool = ThreadPoolExecutor(rpc_threads, thread_name_prefix="job_queue")
+
+
+#Run a blocking function, like a job queue call, on the job queue threads.
+async def run_sync(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(rpc_pool, fn, *args)
+
+
+#Call a job queue function without blocking the event loop.
+async def rpc(name, *args):
+    return await run_sync(call_queue, name, *args)
+
+
+#Waits for status changes on behalf of every long-polling or streaming client of
+#this process, with a single thread calling wait_for_changes. A client registers the
+#version of the status it has and is woken with the new status once that differs
+#(or the job is done). While a request has clients waiting, its latest status is
+#kept, so more clients can start waiting on it without asking the job queue.
+class StatusWatcher:
+    def __init__(self):
+        self.waiters = {} #Request id -> {future: version}. Only changed on the event loop.
+        self.latest = {} #Request id -> latest status, while it has waiters.
+        self.lock = threading.Lock() #Held while changing waiters, and by the thread to read it.
+        self.loop = None
+        self.pid = None
+
+
+    #Wait up to timeout seconds for the status of a request to move past version.
+    #Returns the new status, or None if it didn't change in time.
+    async def wait(self, request_id, version, timeout):
+        self.start()
+        future = self.loop.create_future()
+        with self.lock:
+            self.waiters.setdefault(request_id, {})[future] = version
+        try:
+            #Check only once registered, so a change right before can't be missed.
+            status = self.latest.get(request_id)
+            if status is None:
+                status = await rpc("get_status", request_id)
+            if isinstance(status, str) or status["version"] != version or status["done"]:
+                return dict(status) if isinstance(status, dict) else status
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            with self.lock:
+                waiting = self.waiters[request_id]
+                del waiting[future]
+                if not waiting:
+                    del self.waiters[request_id]
+                    self.latest.pop(request_id, None)
+
+
+    #Start the thread, once per process, as threads don't survive a fork. Clients are
+    #woken on the loop that last waited.
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            threading.Thread(target=self.run, daemon=True).start()
+
+
+    def run(self):
+        seq = None
+        while True:
+            try:
+                previous = seq
+                seq, ids = call_queue("wait_for_changes", seq, max_status_wait)
+                with self.lock:
+                    #Without a previous sequence number, changes may have been missed.
+                    watched = list(self.waiters) if previous is None else [i for i in ids if i in self.waiters]
+                if watched:
+                    statuses = call_queue("get_statuses", watched)
+                    self.loop.call_soon_threadsafe(self.deliver, statuses)
+            except Exception as err:
+                print(f"Unable to wait for status changes: {err}")
+                seq = None
+                time.sleep(1)
+
+
+    #Wake the clients whose status changed. Runs on the event loop.
+    def deliver(self, statuses):
+        for request_id, status in statuses.items():
+            if request_id in self.waiters:
+                self.latest[request_id] = status
+            for future, version in list(self.waiters.get(request_id, {}).items()):
+                if not future.done() and (status["version"] != version or status["done"]):
+                    future.set_result(dict(status))
+
+
+watcher = StatusWatcher()
+
+
+#The parts of an HTTP request the handlers need.
+class Request:
+    def __init__(self, scope, body):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+        query = parse_qs(scope["query_string"].decode("latin-1"), keep_blank_values=True)
+        self.args = {k: v[-1] for k, v in query.items()}
+        self.body = body
+
+
+    #Get a query argument converted by type, or the default if it is missing or
+    #can't be converted, like Flask's request.args.get.
+    def arg(self, name, default=None, type=str):
+        try:
+            return type(self.args[name])
+        except (KeyError, ValueError):
+            return default
+
+
+#A response to send. body is bytes or a string, or an async iterator of them to
+#stream.
+class Response:
+    def __init__(self, body, status=200, headers=None, mimetype="application/json"):
+        self.body = body
+        self.status = status
+        self.headers = dict(headers or {})
+        self.mimetype = mimetype
+
+
+    #Turn a handler's return value (a body, or a body and status, and maybe headers,
+    #as Flask accepts) into a Response.
+    @staticmethod
+    def of(value):
+        if isinstance(value, Response):
+            return value
+        if isinstance(value, tuple):
+            return Response(*value)
+        return Response(value)
+
+
+    async def send(self, send, receive):
+        headers = [(b"content-type", self.mimetype.encode("latin-1"))]
+        headers += [(k.lower().encode("latin-1"), str(v).encode("latin-1")) for k, v in self.headers.items()]
+        if isinstance(self.body, (str, bytes)):
+            body = self.body.encode() if isinstance(self.body, str) else self.body
+            headers.append((b"content-length", str(len(body)).encode()))
+            await send({"type": "http.response.start", "status": self.status, "headers": headers})
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        await send({"type": "http.response.start", "status": self.status, "headers": headers})
+        #Stop streaming as soon as the client goes away.
+        async def stream():
+            async for chunk in self.body:
+                await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+
+        async def disconnected():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+
+        tasks = [asyncio.ensure_future(stream()), asyncio.ensure_future(disconnected())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+#Get the JSON params and the uploaded images (by name) of a POST request. Multipart
+#uploads carry the JSON params in a form field and the images as raw files.
+def parse_body(request):
+    content_type = request.headers.get("content-type", "")
+    if not content_type.startswith("multipart/form-data"):
+        return json.loads(request.body), {}
+
+    message = BytesParser(policy=HTTP).parsebytes(b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + request.body)
+    params = {}
+    files = {}
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        if part.get_filename() is not None:
+            files[name] = part.get_payload(decode=True)
+        elif name == "params":
+            params = json.loads(part.get_payload(decode=True))
+    return params, files
+
+
+#Allocate the request and start the process
+async def post_job(request, request_type):
+    key = request.arg('key', "")
+    model = request.arg('model', "")
+    try:
+        model = json.loads(model)
+    except ValueError:
+        pass
+    include_logs = request.arg('include_logs', False, bool)
+    priority = request.arg('priority', "interactive")
+    cache = request.arg('cache', "true").lower() not in ("0", "false", "no")
+
+    try:
+        params, files = await run_sync(parse_body, request)
+    except Exception as err:
+        msg = f'{{"error": "Could not add request {request_type} to queue: {err}"}}'
+        print(msg)
+        return msg
+    return await run_sync(add_job, request_type, key, include_logs, model, priority, cache, params, files)
+
+
+#Get the request containing the status and/or the generated images
+async def get_job(request, request_type, path):
+    key = request.arg('key', "")
+    images = request.arg('images', "data")
+    return await run_sync(handle_get, request_type, path, key, images)
+
+
+async def cancel_job(request, path):
+    key = request.arg('key', "")
+    return await run_sync(handle_get, "cancel", path, key)
+
+
+#Get only the progress of a request. If a version is given, wait up to `wait`
+#seconds for the status to move past it first (long-polling).
+async def get_status(request, request_type, path):
+    if request_type not in request_types:
+        return f'{{"error": "Unknown request type {request_type}."}}', 404
+    key = request.arg('key', "")
+    wait = request.arg('wait', 0, float)
+    version = request.arg('version', None, int)
+    try:
+        request_id = int(path)
+        status = None
+        if wait > 0 and version is not None:
+            status = await watcher.wait(request_id, version, min(wait, max_status_wait))
+        if status is None:
+            status = await rpc("get_status", request_id)
+
+        error = check_status(status, request_type, request_id, key)
+        if error is not None:
+            return error
+        return json.dumps(status)
+
+    except Exception as err:
+        msg = f'{{"error": "Could not get status of {request_type}/{path}: {err}"}}'
+        print(msg)
+        return msg
+
+
+#Stream the progress of a request as Server-Sent Events until it is done.
+#Each event carries the status version as its id, so a reconnecting client
+#that sends Last-Event-ID only receives changes it hasn't seen.
+async def get_events(request, request_type, path):
+    if request_type not in request_types:
+        return f'{{"error": "Unknown request type {request_type}."}}', 404
+    key = request.arg('key', "")
+    try:
+        version = int(request.headers["last-event-id"])
+    except (KeyError, ValueError):
+        version = None
+    try:
+        request_id = int(path)
+        status = await rpc("get_status", request_id)
+        error = check_status(status, request_type, request_id, key)
+        if error is not None:
+            return error
+    except Exception as err:
+        msg = f'{{"error": "Could not get status of {request_type}/{path}: {err}"}}'
+        print(msg)
+        return msg
+
+    async def stream(status, last):
+        while True:
+            if status["version"] != last:
+                last = status["version"]
+                yield f'id: {last}\ndata: {json.dumps(status)}\n\n'
+            else:
+                #Nothing changed before the timeout; keep the connection alive.
+                yield ': keep-alive\n\n'
+
+            if status["done"]:
+                return
+
+            try:
+                status = await watcher.wait(request_id, last, max_status_wait)
+                if status is None:
+                    status = await rpc("get_status", request_id)
+                error = check_status(status, request_type, request_id, key)
+            except Exception as err:
+                error = f'{{"error": "Lost status of {request_type}/{path}: {err}"}}'
+            if error is not None:
+                yield f'event: error\ndata: {error}\n\n'
+                return
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream(status, version), headers=headers, mimetype="text/event-stream")
+
+
+#Parse a Range header for a single range of a body of the given length. Returns
+#(start, end) with end exclusive, or None for no range, or False if it can't be met.
+def parse_range(header, length):
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    try:
+        if first == "":
+            start, end = max(0, length - int(last)), length
+        else:
+            start, end = int(first), length if last == "" else min(length, int(last) + 1)
+    except ValueError:
+        return None
+    if start >= end:
+        return False
+    return start, end
+
+
+#Return one generated image as raw bytes (PNG as stored, or converted to WebP).
+#Supports If-None-Match and single Range requests so large downloads can be resumed.
+async def get_image_file(request, request_type, path, index):
+    if request_type not in request_types:
+        return f'{{"error": "Unknown request type {request_type}."}}', 404
+    key = request.arg('key', "")
+    image_format = request.arg('format', "png").lower()
+    quality = request.arg('quality', None, int)
+    data, error_status = await run_sync(get_image, request_type, path, index, key, image_format, quality)
+    if error_status is not None:
+        return data, error_status
+
+    etag = f'"{hashlib.sha1(data).hexdigest()}"'
+    headers = {"Content-Disposition": f'inline; filename="{request_type}_{int(path)}_{index}.{image_format}"',
+               "ETag": etag, "Accept-Ranges": "bytes"}
+    mimetype = image_mimetypes[image_format]
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(b"", 304, headers, mimetype)
+
+    byte_range = parse_range(request.headers.get("range"), len(data))
+    if byte_range is False:
+        return Response(b"", 416, dict(headers, **{"Content-Range": f"bytes */{len(data)}"}), mimetype)
+    if byte_range is not None:
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{len(data)}"
+        return Response(data[start:end], 206, headers, mimetype)
+    return Response(data, 200, headers, mimetype)
+
+
+#Get or set the fair queuing weights of the API keys. Only the admin key may.
+async def weights(request):
+    key = request.arg('key', "")
+    try:
+        if key != admin_key:
+            msg = '{"error": "Authorization denied -- admin key required"}'
+            print(msg)
+            return msg
+
+        if request.method == "POST":
+            body = json.loads(request.body)
+            weights = await rpc("set_weight", body["key"], body["weight"])
+        else:
+            weights = await rpc("get_weights")
+        if isinstance(weights, str):
+            return weights
+        return json.dumps({"weights": weights})
+
+    except Exception as err:
+        msg = f'{{"error": "Could not access weights: {err}"}}'
+        print(msg)
+        return msg
+
+
+#Metrics of the whole service, in the Prometheus text format.
+async def get_metrics(request):
+    try:
+        #Include what this process recorded since it last sent its metrics.
+        await rpc("record_metrics", metrics.take_pending())
+        return Response(await rpc("get_metrics"), mimetype="text/plain; version=0.0.4")
+    except Exception as err:
+        msg = f'{{"error": "Could not get metrics: {err}"}}'
+        print(msg)
+        return msg, 500
+
+
+async def get_info(request):
+    return await rpc("get_info")
+
+
+#The routes, as in rest_api_server: (rule, methods, handler, fixed handler arguments).
+#Variable parts of a rule are passed to the handler by name.
+routes = []
+for t in request_types:
+    routes.append((f'/{t}', ('POST',), post_job, {"request_type": t}))
+    routes.append((f'/{t}/<path>', ('GET',), get_job, {"request_type": t}))
+routes += [
+    ('/<request_type>/<path>/status', ('GET',), get_status, {}),
+    ('/<request_type>/<path>/events', ('GET',), get_events, {}),
+    ('/<request_type>/<path>/image/<int:index>', ('GET',), get_image_file, {}),
+    ('/cancel/<path>', ('GET',), cancel_job, {}),
+    ('/weights', ('GET', 'POST'), weights, {}),
+    ('/metrics', ('GET',), get_metrics, {}),
+    ('/info', ('GET',), get_info, {}),
+]
+#Fixed rules are tried first, as Flask does.
+routes.sort(key=lambda r: r[0].count("<"))
+
+#The routes grouped by their number of path segments, with each rule split into
+#segments up front, as the rules are matched on every request.
+split_routes = {}
+for rule, methods, handler, fixed in routes:
+    parts = rule.strip("/").split("/")
+    split_routes.setdefault(len(parts), []).append((rule, parts, methods, handler, fixed))
+
+
+#Match the segments of a path against those of a rule, returning the values of its
+#variable parts, or None.
+def match_rule(rule_parts, path_parts):
+    values = {}
+    for r, p in zip(rule_parts, path_parts):
+        if r[0] != "<":
+            if r != p:
+                return None
+        elif r.startswith("<int:"):
+            if not p.isdigit():
+                return None
+            values[r[len("<int:"):-1]] = int(p)
+        else:
+            values[r[1:-1]] = p
+    return values
+
+
+#Find the route of a request. Returns the rule (or "unmatched"), the handler and
+#its arguments.
+def find_route(request):
+    path_parts = request.path.strip("/").split("/")
+    allowed = False
+    for rule, rule_parts, methods, handler, fixed in split_routes.get(len(path_parts), ()):
+        values = match_rule(rule_parts, path_parts)
+        if values is None:
+            continue
+        if request.method not in methods:
+            allowed = True
+            continue
+        return rule, handler, dict(fixed, **values)
+
+    return "unmatched", method_not_allowed if allowed else not_found, {}
+
+
+async def not_found(request):
+    return '{"error": "Not found."}', 404
+
+
+async def method_not_allowed(request):
+    return '{"error": "Method not allowed."}', 405
+
+
+#The ASGI application.
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+
+    start = time.perf_counter()
+    chunks = []
+    if scope["method"] == "POST":
+        while True:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+    request = Request(scope, b"".join(chunks))
+
+    rule, handler, args = find_route(request)
+    try:
+        response = Response.of(await handler(request, **args))
+    except Exception as err:
+        msg = f'{{"error": "Could not handle {request.method} {request.path}: {err}"}}'
+        print(msg)
+        response = Response(msg, 500)
+
+    #Time every request, labelled by its route rather than its URL to keep the
+    #number of label values small.
+    metrics.observe("sdapi_http_request_seconds", time.perf_counter() - start, endpoint=rule, method=request.method)
+    metrics.inc("sdapi_http_responses_total", endpoint=rule, status=response.status)
+    await response.send(send, receive)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host=os.getenv("API_URL", "0.0.0.0"), port=int(os.getenv("API_PORT", 5000)))
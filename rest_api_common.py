@@ -0,0 +1,403 @@
+#Settings and helpers shared by the API servers: the Flask app in rest_api_server
+#and the asyncio one in rest_api_asgi. Both talk to the job queue through call_queue.
+#Uploaded images are checked from their headers and passed on still compressed, so
+#PIL is only needed to convert downloads, and is imported by the function that does.
+import os
+import io
+import json
+import time
+import struct
+import threading
+from base64 import b64encode, b64decode
+
+#For the multiprocessing shared state
+import rest_api_job_queue
+
+#Metrics recorded by the API servers are forwarded to the job queue.
+from rest_api_metrics import metrics
+from rest_api_image_spool import ImageSpool, SpooledImages, read_images, remove_images
+
+max_resolution = int(os.getenv("MAX_RESOLUTION", 720896))
+print(f"Using max resolution: {max_resolution}")
+
+admin_key = os.getenv("API_ADMIN_KEY", "admin")
+print(f"Using admin key: {admin_key}")
+
+#The longest a long-poll or event stream waits on the job queue in a single call.
+max_status_wait = float(os.getenv("MAX_STATUS_WAIT", 30))
+
+request_types = ("txt2img", "img2img", "imgproc")
+
+#Metrics recorded here are sent to the job queue every metrics_interval seconds.
+metrics_interval = float(os.getenv("METRICS_INTERVAL", 5))
+metrics.forward = True
+metrics_pid = None
+
+
+#Each server process keeps a single proxy to the job queue. The proxy holds
+#one persistent connection per thread, so handlers skip the TCP connect and auth
+#handshake that a fresh manager.connect() costs on every request.
+queue_proxy = None
+queue_pid = None
+queue_lock = threading.Lock()
+
+
+#Get this process's job queue proxy, connecting to the manager if needed.
+def get_queue():
+    global queue_proxy
+    global queue_pid
+    global metrics_pid
+    with queue_lock:
+        #Threads don't survive uwsgi's fork, so each process starts its own sender.
+        if metrics_pid != os.getpid():
+            metrics_pid = os.getpid()
+            threading.Thread(target=forward_metrics, daemon=True).start()
+
+        #Never reuse a proxy inherited across a fork; its sockets belong to the parent.
+        if queue_proxy is None or queue_pid != os.getpid():
+            manager = rest_api_job_queue.get_manager()
+            manager.connect()
+            queue_proxy = manager.get_queue()
+            queue_pid = os.getpid()
+        return queue_proxy
+
+
+#The job queue's image spool, if this process shares it, and the proxy it was
+#looked up through. A new proxy may mean a restarted queue, with a new spool.
+image_spool = None
+spool_proxy = None
+
+
+#Get the job queue's image spool, or None if it has none or is on another host.
+def get_spool():
+    global image_spool
+    global spool_proxy
+    proxy = get_queue()
+    if spool_proxy is not proxy:
+        spool = call_queue("get_spool")
+        image_spool = None if spool is None else ImageSpool.attach(*spool)
+        spool_proxy = proxy
+    return image_spool
+
+
+#Get the encoded images of a finished request, or one of them (index), or None.
+#When this process shares the image spool they are read straight from the file
+#the job queue holds them in, so only its handle passes through the job queue.
+def get_result_images(request_id, index=None):
+    if get_spool() is not None:
+        images = call_queue("get_result", request_id, True) if index is None else call_queue("get_result_image", request_id, index, True)
+        if not isinstance(images, SpooledImages):
+            return images
+        try:
+            return read_images(images, index)
+        except OSError:
+            pass #It was evicted or spilled meanwhile; ask for the images themselves.
+    if index is None:
+        return call_queue("get_result", request_id)
+    return call_queue("get_result_image", request_id, index)
+
+
+#Call a job queue function, reconnecting once if the job queue has restarted.
+def call_queue(name, *args):
+    global queue_proxy
+    for attempt in range(2):
+        proxy = get_queue()
+        try:
+            start = time.perf_counter()
+            ret = getattr(proxy, name)(*args)
+            metrics.observe("sdapi_rpc_seconds", time.perf_counter() - start, method=name)
+            return ret
+        except (EOFError, OSError) as err:
+            print(f"Lost connection to job queue ({err}). Reconnecting.")
+            with queue_lock:
+                if queue_proxy is proxy:
+                    queue_proxy = None
+            if attempt > 0:
+                raise
+
+
+#Send the metrics recorded by this process to the job queue.
+def forward_metrics():
+    while True:
+        time.sleep(metrics_interval)
+        samples = metrics.take_pending()
+        if samples:
+            try:
+                call_queue("record_metrics", samples)
+            except Exception as err:
+                print(f"Unable to send metrics to the job queue: {err}")
+
+
+#Convert the PNG bytes into a base64 encoding for transmission via JSON.
+#The job queue already encoded the image as PNG when the job finished.
+def get_response_image(png):
+    start = time.perf_counter()
+    encoded_img = b64encode(png).decode('ascii') # encode as base64
+    metrics.observe("sdapi_encode_seconds", time.perf_counter() - start, stage="base64")
+    return f'data:image/png;base64,{encoded_img}'
+
+
+#Decode a base64 data URL into the image bytes for img2img or imgproc.
+def get_param_image(image):
+    assert isinstance(image, str) and image.startswith("data:image/"), "Image data not recognized."
+    header, _, image = image.partition(",")
+    assert header.endswith(";base64"), "Image data not recognized."
+    return load_param_image(b64decode(image))
+
+
+#Check uploaded image bytes for img2img or imgproc from the image header alone and
+#pass them on as they are. The worker decodes them once, when the job runs.
+def load_param_image(data):
+    image_format, width, height = image_header(data)
+    assert width > 0 and height > 0, f"The {image_format} image is empty."
+    assert width * height <= max_resolution, f"The {image_format} image is {width}x{height}, more than {max_resolution} pixels."
+    return data
+
+
+#Read the format and size of an image from its header, without decoding it.
+def image_header(data):
+    if data.startswith(b"\x89PNG\r\n\x1a\n") and data[12:16] == b"IHDR":
+        width, height = struct.unpack(">II", data[16:24])
+        return "png", width, height
+
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        width, height = struct.unpack("<HH", data[6:10])
+        return "gif", width, height
+
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        chunk = data[12:16]
+        if chunk == b"VP8 " and data[23:26] == b"\x9d\x01\x2a":
+            width, height = struct.unpack("<HH", data[26:30])
+            return "webp", width & 0x3fff, height & 0x3fff
+        if chunk == b"VP8L" and data[20:21] == b"\x2f":
+            bits = int.from_bytes(data[21:25], "little")
+            return "webp", (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+        if chunk == b"VP8X":
+            return "webp", int.from_bytes(data[24:27], "little") + 1, int.from_bytes(data[27:30], "little") + 1
+
+    if data.startswith(b"\xff\xd8"):
+        #Walk the JPEG segments to the start of frame, which holds the size.
+        i = 2
+        while i + 9 <= len(data):
+            assert data[i] == 0xff, "Image data not recognized."
+            marker = data[i + 1]
+            if marker == 0xff:
+                i += 1
+                continue
+            if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+                height, width = struct.unpack(">HH", data[i + 5:i + 9])
+                return "jpeg", width, height
+            i += 2 + struct.unpack(">H", data[i + 2:i + 4])[0]
+
+    raise AssertionError("Image data not recognized; upload a PNG, JPEG, WebP or GIF image.")
+
+
+#Formats the binary image endpoint can serve. PNG is served as stored.
+image_mimetypes = {"png": "image/png", "webp": "image/webp"}
+
+
+#Convert stored PNG bytes into another format for download.
+def convert_image(png, image_format, quality):
+    if image_format == "png":
+        return png
+    from PIL import Image
+    byte_arr = io.BytesIO()
+    image = Image.open(io.BytesIO(png))
+    if quality is None:
+        image.save(byte_arr, format=image_format.upper(), lossless=True)
+    else:
+        image.save(byte_arr, format=image_format.upper(), quality=quality)
+    return byte_arr.getvalue()
+
+
+#Check that a status returned by the job queue can be shown to this key.
+#Returns an error message, or None if it's fine. Strips the owner's key.
+def check_status(status, request_type, request_id, key):
+    if isinstance(status, str):
+        return status
+
+    if key != status.pop("key") and key != admin_key:
+        msg = '{"error": "Authorization denied -- key does not match"}'
+        print(msg)
+        return msg
+
+    if status["type"] != request_type:
+        msg = f'{{"error": "Request type {request_id} is {status["type"]}, not {request_type}."}}'
+        print(msg)
+        return msg
+
+    return None
+
+
+#Add a job to the queue. params are the JSON params of the request, and files the
+#raw images of a multipart upload, by name. Returns the response body, or the body,
+#status and headers if the job was turned away by admission control.
+def add_job(request_type, key, include_logs, model, priority, cache, params, files):
+    spooled = []
+    try:
+        for k in params:
+            if params[k] == "null":
+                params[k] = None
+
+
+        if "width" in params and "height" in params:
+            if params["width"] * params["height"] > max_resolution:
+                return '{"error": "Not enough VRAM to process request."}'
+
+        #Check any uploaded or base64 images before sending them to the manager, still compressed
+        if request_type == "img2img":
+            init_info_mask = params.setdefault("init_info_mask", {})
+            for k in ("image", "mask"):
+                if k in files:
+                    init_info_mask[k] = load_param_image(files[k])
+                else:
+                    init_info_mask[k] = get_param_image(init_info_mask[k])
+        
+        if request_type == "imgproc":
+            if "image" in files:
+                params["image"] = load_param_image(files["image"])
+            else:
+                params["image"] = get_param_image(params["image"])
+
+        #On the job queue's host, only a handle to the images goes through the queue,
+        #which then owns the files. Until it has accepted them, they are ours.
+        spool = get_spool()
+        if spool is not None:
+            images = params["init_info_mask"] if request_type == "img2img" else params
+            for k in ("image", "mask"):
+                if isinstance(images.get(k), bytes):
+                    images[k] = spool.write([images[k]], digest=True)
+                    spooled.append(images[k])
+
+        ret = call_queue("add_request", {"done": False, "key": key, "model": model, "include_logs": include_logs, "priority": priority, "cache": cache, "type": request_type, "params": params, "retval": None, "status": {}})
+        if isinstance(ret, str):
+            for handle in spooled:
+                remove_images(handle)
+            #Tell clients turned away by admission control or a full job queue when to come back.
+            try:
+                retry_after = json.loads(ret).get("retry_after")
+            except ValueError:
+                retry_after = None
+            if retry_after is not None:
+                return ret, 429, {"Retry-After": str(retry_after)}
+            return ret
+        spooled = []
+
+        #Remove the rather large images from the request object before sending it back.
+        if request_type == "img2img":
+            del ret["params"]["init_info_mask"]
+        if request_type == "imgproc":
+            del ret["params"]["image"]
+
+        return json.dumps(ret)
+    except Exception as err:
+        for handle in spooled:
+            remove_images(handle)
+        msg = f'{{"error": "Could not add request {request_type} to queue: {err}"}}'
+        print(msg)
+        return msg
+
+
+#Get the request containing the status and/or the generated images
+def handle_get(request_type, path, key, image_mode="data"):
+    try:         
+        request_id = int(path)
+
+        if request_id == 0 and key == admin_key:
+            call_queue("cancel_all")
+            return '{"status" : "All requests cancelled."}'
+
+        #Most polls are for unfinished jobs, so fetch just the small status first.
+        status = call_queue("get_status", request_id)
+        if isinstance(status, str):
+            return status
+
+
+        r_key = status.pop("key")
+        if key != r_key and key != admin_key:
+            msg = '{"error": "Authorization denied -- key does not match"}'
+            print(msg)
+            return msg
+
+        
+        if request_type == "cancel":
+            status = call_queue("cancel", request_id)
+            if not isinstance(status, str):
+                del status["key"]
+            return json.dumps(status)
+
+
+
+
+        if status["type"] != request_type:
+            msg = f'{{"error": "Request type {request_id} is {status["type"]}, not {request_type}."}}'
+            print(msg)
+            return msg
+
+
+        #Only fetch the full request, with its params and results, once it is done.
+        if not status["done"]:
+            return json.dumps(status)
+
+        request = call_queue("get_request", request_id)
+        if isinstance(request, str):
+            return request
+
+
+        #Fill in the images, which were encoded once when the job finished.
+        #In "links" mode, list the binary download URLs instead of embedding the images.
+        if request["done"] and request["retval"] is not None:
+            if image_mode == "links":
+                count = call_queue("get_result_count", request_id)
+                images = None if count is None else [f'/{request_type}/{request_id}/image/{n}' for n in range(count)]
+            else:
+                images = get_result_images(request_id)
+                images = None if images is None else [get_response_image(i) for i in images]
+
+            if images is None:
+                msg = f'{{"error": "The results of request {request_id} are no longer available."}}'
+                print(msg)
+                return msg
+            request["retval"] = [images] + list(request["retval"][1:])
+
+        #Remove the rather large images from the request object before sending it back.
+        if request_type == "img2img":
+            del request["params"]["init_info_mask"]
+
+        if request_type == "imgproc":
+            del request["params"]["image"]
+
+        return json.dumps(request)
+
+    except Exception as err:
+        msg = f'{{"error": "Could not get request {request_type}/{path} from queue: {err}"}}'
+        print(msg)
+        return msg
+
+
+#Get one generated image as raw bytes (PNG as stored, or converted to WebP).
+#Returns the bytes and None, or an error message and its HTTP status.
+def get_image(request_type, path, index, key, image_format, quality):
+    try:
+        request_id = int(path)
+        if image_format not in image_mimetypes:
+            return f'{{"error": "Unsupported image format {image_format}."}}', 400
+
+        status = call_queue("get_status", request_id)
+        error = check_status(status, request_type, request_id, key)
+        if error is not None:
+            return error, 404
+
+        if not status["done"]:
+            return f'{{"error": "Request {request_id} is not done yet."}}', 409
+
+        png = get_result_images(request_id, index)
+        if png is None:
+            return f'{{"error": "Request {request_id} has no image {index}."}}', 404
+
+        return convert_image(png, image_format, quality), None
+
+    except Exception as err:
+        msg = f'{{"error": "Could not get image {index} of {request_type}/{path}: {err}"}}'
+        print(msg)
+        return msg, 500
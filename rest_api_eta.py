@@ -0,0 +1,53 @@
+#Learns how long jobs take, to estimate when queued jobs will start and finish.
+#
+#Sampling time is learned per (model, sampler, width, height) as seconds per step
+#of one image, and model switches as seconds per model, both as exponentially
+#weighted moving averages so the estimates follow changes (e.g. another job
+#sharing the GPU). Jobs without a sampler, like imgproc, are learned per type as
+#seconds per job.
+#
+#This isn't thread-safe on its own; the job queue calls it with its lock held.
+class EtaModel:
+    def __init__(self, smoothing=0.3):
+        self.smoothing = smoothing
+        self.step_seconds = {} #(model, sampler, width, height) -> seconds per image step.
+        self.switch_seconds = {} #Model -> seconds to switch to it.
+        self.job_seconds = {} #Request type -> seconds per job.
+
+
+    def _update(self, table, key, value):
+        old = table.get(key)
+        table[key] = value if old is None else old + self.smoothing * (value - old)
+
+
+    #Record that a job sampled `steps` steps of `images` images each in `seconds`.
+    def record_sampling(self, key, steps, images, seconds):
+        if steps > 0 and images > 0 and seconds > 0:
+            self._update(self.step_seconds, key, seconds / (steps * images))
+
+
+    def record_switch(self, model, seconds):
+        self._update(self.switch_seconds, model, seconds)
+
+
+    def record_job(self, request_type, seconds):
+        self._update(self.job_seconds, request_type, seconds)
+
+
+    #Learned seconds per image step for a key, or None.
+    def step_time(self, key):
+        return self.step_seconds.get(key)
+
+
+    #Learned seconds to switch to a model, falling back on the average of all
+    #models, or None if no switch was seen yet.
+    def switch_time(self, model):
+        if model in self.switch_seconds:
+            return self.switch_seconds[model]
+        if self.switch_seconds:
+            return sum(self.switch_seconds.values()) / len(self.switch_seconds)
+        return None
+
+
+    def job_time(self, request_type):
+        return self.job_seconds.get(request_type)
@@ -0,0 +1,169 @@
+import os
+import mmap
+import shutil
+import struct
+import secrets
+import hashlib
+
+
+#A file of encoded images in the image spool (or the result store's spill directory).
+#Only this small handle passes through the job queue; processes on the queue's host
+#read the images straight from the file. Uploads also carry a digest of their bytes,
+#so identical requests can be recognized without reading the file.
+class SpooledImages:
+    def __init__(self, path, lengths, digest=None):
+        self.path = path
+        self.lengths = tuple(lengths)
+        self.digest = digest
+
+
+    def __len__(self):
+        return len(self.lengths)
+
+
+    #The size of the file.
+    @property
+    def size(self):
+        return 4 + 8 * len(self.lengths) + sum(self.lengths)
+
+
+#A directory, shared by the processes on the job queue's host, that encoded images
+#are written to instead of being sent through the job queue. The job queue creates
+#it on start, with a marker holding a random id. Other processes attach to it only
+#if they find the same marker, i.e. if they run on the same host as the queue.
+#By default it is on /dev/shm, so the files never leave memory.
+class ImageSpool:
+    def __init__(self, directory, spool_id):
+        self.directory = directory
+        self.spool_id = spool_id
+
+
+    #Create the spool for the job queue. Anything left over from an earlier run is
+    #removed, as request ids restart with the queue. The id of the queue's process is
+    #kept next to the marker, so sweep can tell when the spool was left behind.
+    @staticmethod
+    def create(directory):
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        spool_id = secrets.token_hex(16)
+        with open(os.path.join(directory, ".pid"), "w") as f:
+            f.write(str(os.getpid()))
+        with open(os.path.join(directory, ".spool"), "w") as f:
+            f.write(spool_id)
+        return ImageSpool(directory, spool_id)
+
+
+    #Remove the spool and every file in it, when the job queue stops.
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+    #Remove the spools in a directory (with names starting with prefix) that were
+    #left behind by job queues that are no longer running, e.g. ones that were
+    #killed, or ran on another port.
+    @staticmethod
+    def sweep(directory, prefix):
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(directory, name)
+            if not name.startswith(prefix) or not os.path.exists(os.path.join(path, ".spool")):
+                continue
+            try:
+                with open(os.path.join(path, ".pid")) as f:
+                    os.kill(int(f.read()), 0)
+                continue
+            except PermissionError:
+                #The process exists, but belongs to someone else.
+                continue
+            except (OSError, ValueError):
+                pass
+            print(f"Removing the image spool {path} left by an earlier job queue.")
+            shutil.rmtree(path, ignore_errors=True)
+
+
+    #Attach to the job queue's spool, or return None if it isn't on this host.
+    @staticmethod
+    def attach(directory, spool_id):
+        try:
+            with open(os.path.join(directory, ".spool")) as f:
+                if f.read() == spool_id:
+                    return ImageSpool(directory, spool_id)
+        except OSError:
+            pass
+        return None
+
+
+    #Write encoded images to a new file of the spool, returning its handle. The
+    #process the handle is given to owns the file, and removes it when done.
+    def write(self, images, digest=False):
+        path = os.path.join(self.directory, f"{os.getpid()}-{secrets.token_hex(8)}.images")
+        write_images(path, images)
+        if digest:
+            h = hashlib.sha256()
+            for i in images:
+                h.update(b"%d:" % len(i))
+                h.update(i)
+            digest = h.hexdigest()
+        return SpooledImages(path, [len(i) for i in images], digest or None)
+
+
+    #Whether a handle refers to a file of this spool.
+    def contains(self, handle):
+        return os.path.dirname(handle.path) == self.directory
+
+
+#File layout: image count, each image's length, then the images back to back.
+def write_images(path, images):
+    header = struct.pack(f"<I{len(images)}Q", len(images), *[len(i) for i in images])
+    with open(path, "wb") as f:
+        f.write(header)
+        for i in images:
+            f.write(i)
+    return len(header) + sum(len(i) for i in images)
+
+
+#Read all images (index None) or a single image (or None) from a file of images.
+#The file is memory-mapped, so reading one image only pages in that image.
+def read_images(handle, index=None):
+    path = handle.path if isinstance(handle, SpooledImages) else handle
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            count = struct.unpack_from("<I", m, 0)[0]
+            lengths = struct.unpack_from(f"<{count}Q", m, 4)
+            offset = 4 + 8 * count
+            images = []
+            for i, length in enumerate(lengths):
+                if index is None or index == i:
+                    images.append(m[offset:offset + length])
+                offset += length
+
+    if index is None:
+        return images
+    return images[0] if images else None
+
+
+#Give the images of a handle a second file name, for another owner. The images are
+#shared, not copied, unless the file system can't link them.
+def link_images(handle):
+    path = f"{os.path.splitext(handle.path)[0]}-{secrets.token_hex(4)}.images"
+    try:
+        os.link(handle.path, path)
+    except OSError:
+        shutil.copyfile(handle.path, path)
+    return SpooledImages(path, handle.lengths, handle.digest)
+
+
+#Move the images of a handle to another file, returning the new handle.
+def move_images(handle, path):
+    shutil.move(handle.path, path)
+    return SpooledImages(path, handle.lengths, handle.digest)
+
+
+def remove_images(handle):
+    try:
+        os.remove(handle.path)
+    except OSError as err:
+        print(f"Unable to remove spooled images {handle.path}: {err}")
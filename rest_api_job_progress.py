@@ -0,0 +1,86 @@
+#The status fields a worker reports for a running job, in the order used on the wire.
+progress_fields = ("cur_task", "step", "iter", "total_steps", "total_iters")
+
+#The fields of a request a worker needs to run it, and the fields it sets.
+job_fields = ("id", "type", "key", "model", "params", "include_logs")
+result_fields = ("id", "success", "status", "retval", "cancel", "log_out", "log_err", "timings")
+
+
+#A job as a worker holds it. The queue keeps its requests as dicts, which the API
+#servers read, but a claimed job goes to its worker as this slotted record, with
+#only the fields the worker needs: nothing of the queue's bookkeeping, and the input
+#images as they are held (spool handles, for uploads). It supports the item access
+#of a request dict, a field being "in" the job once it's set, so the helpers the
+#worker shares with the queue (like batch_key) take either.
+class Job:
+    __slots__ = job_fields + result_fields[1:]
+
+    def __init__(self, request):
+        for name in job_fields:
+            if name in request:
+                setattr(self, name, request[name])
+
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+
+    def __setitem__(self, name, value):
+        setattr(self, name, value)
+
+
+    def __contains__(self, name):
+        return hasattr(self, name)
+
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+
+#The progress of a running job, as its worker tracks it. Only the fields that changed
+#since the last report go to the job queue, as a flat tuple of (field number, value)
+#pairs, so a sampler step usually costs one pair of small integers instead of a
+#pickled status dict.
+class JobProgress:
+    __slots__ = progress_fields + ("sent",)
+
+    def __init__(self):
+        for name in progress_fields:
+            setattr(self, name, None)
+        self.sent = [None] * len(progress_fields)
+
+
+    #Set some fields without reporting them yet.
+    def set(self, **fields):
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+
+    #Set some fields, returning the changes since the last report to send.
+    def update(self, **fields):
+        self.set(**fields)
+        delta = []
+        for n, name in enumerate(progress_fields):
+            value = getattr(self, name)
+            if value != self.sent[n]:
+                delta += (n, value)
+                self.sent[n] = value
+        return tuple(delta)
+
+
+    #Send every field with the next report, e.g. after one failed to arrive.
+    def resend(self):
+        self.sent = [None] * len(progress_fields)
+
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in progress_fields if getattr(self, name) is not None}
+
+
+#Apply a delta from JobProgress.update to a status dict.
+def apply_progress(status, delta):
+    for n in range(0, len(delta), 2):
+        status[progress_fields[delta[n]]] = delta[n + 1]
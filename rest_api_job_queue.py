@@ -4,22 +4,40 @@ import sys
 import threading
 import copy
 import json
+import math
+import random
+import hashlib
+import socket
+import signal
+import atexit
+from collections import OrderedDict
 
 from multiprocessing import Lock
 from multiprocessing.managers import BaseManager
 
 
 import io
-from contextlib import redirect_stdout, redirect_stderr
+from contextlib import redirect_stdout, redirect_stderr, contextmanager
 
 import traceback
 
 import importlib
 
+from rest_api_result_store import ResultStore
+from rest_api_model_cache import ModelCache, MixCache, checkpoint_key
+from rest_api_scheduler import Scheduler, priorities
+from rest_api_workers import WorkerPool
+from rest_api_metrics import metrics
+from rest_api_eta import EtaModel
+from rest_api_result_cache import ResultCache, request_digest
+from rest_api_image_spool import ImageSpool, SpooledImages, read_images, link_images, remove_images
+from rest_api_job_progress import JobProgress, Job, apply_progress, result_fields
+from rest_api_progress_block import ProgressBlock
+
 #Job queue parameters. These should be fine unless the queue is
 #split between different servers.
 url = os.getenv("JOBQUEUE_URL", '127.0.0.1')
-port = os.getenv("JOBQUEUE_PORT", 37844)
+port = int(os.getenv("JOBQUEUE_PORT", 37844))
 auth = os.getenv("JOBQUEUE_AUTH", b"this_is_insecure.")
 print(f"Using URL: {url}, port: {port}, auth: {auth}")
 
@@ -27,18 +45,125 @@ print(f"Using URL: {url}, port: {port}, auth: {auth}")
 #Queue state
 max_requests = 1000
 lock = Lock()
-processing_id = 1
+job_added = threading.Condition(lock) #Wakes idle workers when a job arrives.
+status_changed = threading.Condition(lock) #Wakes clients waiting for a status update.
 next_id = 1
 requests = {}
 
+#Workers claim jobs from the queue, either in this process (unless LOCAL_WORKER is 0)
+#or in other processes started with --worker. A worker that misses its heartbeat
+#for worker_lease seconds is dropped and its jobs are requeued.
+local_worker = os.getenv("LOCAL_WORKER", "1") != "0"
+worker_lease = float(os.getenv("WORKER_LEASE", 30))
+heartbeat_interval = worker_lease / 4
+workers = WorkerPool(worker_lease)
+
+#Workers report sampling progress at most every progress_interval seconds (0 for
+#every step). Workers in this process or on this host also write every step to a
+#progress block in shared memory, without a lock, which status queries read.
+progress_interval = float(os.getenv("PROGRESS_INTERVAL", 0.2))
+progress_blocks = {} #Worker id -> its ProgressBlock.
+progress_block = None #This worker's progress block, if the queue reads it.
+
+#Pending jobs, ordered by priority class and weighted fair queuing between API keys,
+#then to run jobs for the already loaded model back to back.
+#max_reorder caps how many later jobs may overtake any one job.
+max_reorder = int(os.getenv("MAX_REORDER", 4))
+scheduler = Scheduler(max_reorder)
+
+#Compatible txt2img jobs are run as one batch of up to max_batch_images images (and
+#max_batch_pixels pixels, to bound VRAM use), through webui's batch_size.
+#After taking a batchable job, the worker waits up to batch_wait seconds for more.
+max_batch_images = int(os.getenv("MAX_BATCH_IMAGES", 4))
+max_batch_pixels = int(os.getenv("MAX_BATCH_PIXELS", 4 * 512 * 512))
+batch_wait = float(os.getenv("BATCH_WAIT", 0))
+
+#Admission control. Each job's cost is estimated in units of one sampling step of a
+#512x512 image, plus model_switch_cost if no worker has its model loaded. New jobs
+#are refused (with a hint of when to retry) while the cost of the queued and running
+#jobs would exceed max_queued_cost, or max_key_queued_cost for the job's API key.
+#0 disables a limit. How fast queued work drains is learned from finished jobs,
+#starting from cost_rate units per second per worker.
+max_queued_cost = float(os.getenv("QUEUE_COST_BUDGET", 50000))
+max_key_queued_cost = float(os.getenv("KEY_COST_BUDGET", 10000))
+model_switch_cost = float(os.getenv("MODEL_SWITCH_COST", 100))
+imgproc_cost = float(os.getenv("IMGPROC_COST", 20))
+cost_rate = float(os.getenv("COST_RATE", 10))
+#Estimated start and finish times of the jobs, from timings learned from finished
+#jobs. They are recomputed when the queue changes, or after eta_refresh seconds.
+eta = EtaModel()
+eta_refresh = float(os.getenv("ETA_REFRESH", 1))
+eta_cache = {"at": 0, "order": None, "estimates": {}}
+submitted_at = {} #Request id -> when it was submitted, for measuring queue wait.
+claimed_at = {} #Request id -> when a worker claimed it, for measuring run time and cost_rate.
+versions = {} #Bumped every time the status of a request changes.
+change_seq = 0 #Bumped on every status change of any request.
+changed_at = {} #Request id -> change_seq of its last status change.
+
+#Status polls are answered without the lock from a snapshot of the request's status,
+#taken under the lock whenever the status changes or the snapshot is older than
+#status_snapshot_age seconds (for the queue position and estimates of other jobs).
+#0 turns the snapshots off, so every poll takes the lock.
+status_snapshot_age = float(os.getenv("STATUS_SNAPSHOT_AGE", 0.1))
+status_snapshots = {} #Request id -> (version, when taken, id of the job it shows, status).
+
+#Job store limits. Finished jobs are forgotten job_ttl seconds after they finish.
+#If the images held by the jobs exceed max_job_bytes, the oldest finished jobs are
+#forgotten early, and new jobs are refused while only pending jobs remain.
+max_job_bytes = int(os.getenv("JOB_STORE_BYTES", 1024 * 1024 * 1024))
+job_ttl = float(os.getenv("JOB_TTL", 3600))
+job_bytes = {} #Estimated size of the images held by each job.
+job_store_bytes = 0
+finished = OrderedDict() #Finish time of each finished job, oldest first.
+
+#Encoded images of finished jobs, bounded by size. Results that don't fit in
+#memory are spilled to disk, which has its own budget.
+max_result_bytes = int(os.getenv("RESULT_STORE_BYTES", 512 * 1024 * 1024))
+result_spill_dir = os.getenv("RESULT_SPILL_DIR", "result_spill")
+max_result_spill_bytes = int(os.getenv("RESULT_SPILL_BYTES", 4 * 1024 * 1024 * 1024))
+results = ResultStore(max_result_bytes, result_spill_dir, max_result_spill_bytes)
+
+#Uploads and results are written to files in the image spool by the API servers and
+#workers on this host, so only small handles pass through the queue. Set to "" to
+#send the images themselves, as remote API servers and workers always do.
+image_spool_dir = os.getenv("IMAGE_SPOOL_DIR", f"/dev/shm/sdapi-{port}" if os.path.isdir("/dev/shm") else "")
+image_spool = None #Created when the queue starts.
+worker_spool = None #The queue's spool, if this worker shares it.
+
+#Requests with a fixed seed are deterministic, so an identical request (same type,
+#model and params) gets a copy of the result of one that already finished, or waits
+#for one that is still running, instead of running again. The results of the last
+#result_cache_size successful requests are remembered (0 only keeps the waiting).
+#DEDUP_REQUESTS=0 turns both off, and a request can opt out with "cache": false.
+dedup_requests = os.getenv("DEDUP_REQUESTS", "1") != "0"
+result_cache_size = int(os.getenv("RESULT_CACHE_SIZE", 256))
+result_cache = ResultCache(result_cache_size)
+
 
 #Represent the available model options
 models = []
 default_models = [{"name": "stable_diffusion", "path": "models/ldm/stable-diffusion-v1/model.ckpt"}]
 loaded_model = None
+loaded_model_key = None #checkpoint_key of loaded_model's file when it was loaded.
 mixed_model = None
 previous_mix = None
 
+#The mix currently applied in memory to webui's model, so the next mix of the same
+#checkpoints can be applied as a delta. Every remix_refresh deltas the weights are
+#recomputed from scratch, so rounding errors can't accumulate.
+applied_mix = None
+remix_refresh = int(os.getenv("REMIX_REFRESH", 8))
+
+#Checkpoints kept resident in host RAM for fast model switching.
+max_model_cache_bytes = int(os.getenv("MODEL_CACHE_BYTES", 8 * 1024 * 1024 * 1024))
+model_cache = ModelCache(max_model_cache_bytes)
+
+#Mixed checkpoints on disk, so a repeated mix doesn't have to be merged again.
+#Created when the first mix is requested.
+mix_cache_dir = os.getenv("MIX_CACHE_DIR", "mixed_models")
+max_mix_cache_bytes = int(os.getenv("MIX_CACHE_BYTES", 32 * 1024 * 1024 * 1024))
+mix_cache = None
+
 server_version = "0.0.2"
 samplers = ["DDIM",
             "PLMS",
@@ -52,11 +177,137 @@ def get_info():
     return json.dumps({"version": f"{server_version}", "models": [m["name"] for m in models], "samplers": samplers})
 
 
+#Get the model cache's hit, miss and load time counters.
+def get_model_stats():
+    stats = model_cache.stats()
+    if mix_cache is not None:
+        stats["mix_cache"] = mix_cache.stats()
+    return stats
+
+
+#Get the model inside the running webui whose weights can be swapped, or None.
+def get_pipeline_model():
+    model = getattr(sys.modules.get("webui"), "model", None)
+    if not hasattr(model, "load_state_dict") or not hasattr(model, "state_dict"):
+        return None
+    return model
+
+
+#Read a checkpoint into host RAM, keeping only the weights the running model uses,
+#converted to the model's dtypes (e.g. fp16) so they take as little room as possible.
+def read_checkpoint(path, model):
+    import torch
+    start = time.perf_counter()
+    checkpoint = torch.load(path, map_location="cpu")
+    state_dict = checkpoint.get("state_dict", checkpoint)
+    current = model.state_dict()
+    state_dict = {k: v.to(current[k].dtype) for k, v in state_dict.items() if k in current}
+    model_cache.record_load(time.perf_counter() - start)
+    del torch
+    return state_dict
+
+
+#Switch the running webui to another checkpoint by copying the checkpoint's weights
+#into its model, from the model cache if possible. Returns False if that can't be
+#done, in which case webui has to be reloaded instead.
+def swap_model(m):
+    model = get_pipeline_model()
+    if model is None or loaded_model is None:
+        return False
+    try:
+        key = checkpoint_key(m["path"])
+        state_dict = model_cache.get(key)
+        if state_dict is None:
+            state_dict = read_checkpoint(m["path"], model)
+
+        #Keep the outgoing weights too, so switching back is also a cache hit.
+        #Skip this if the outgoing file has since been replaced (like the mixed model).
+        if loaded_model_key is not None and not model_cache.contains(loaded_model_key) \
+                and os.path.exists(loaded_model["path"]) and checkpoint_key(loaded_model["path"]) == loaded_model_key:
+            model_cache.put(loaded_model_key, {k: v.detach().to("cpu", copy=True) for k, v in model.state_dict().items()})
+        model_cache.put(key, state_dict)
+
+        start = time.perf_counter()
+        model.load_state_dict(state_dict, strict=False)
+        model_cache.record_swap(time.perf_counter() - start)
+        return True
+    except Exception as err:
+        print(f'Unable to swap in model "{m["name"]}", reloading webui instead: {err}')
+        return False
+
+
+#Scale mix weights to sum to 1, as generate_mixed_model does, so equivalent mixes
+#like [0.5, 0.5] and [1, 1] compare equal. All zeros means the first model.
+def normalise_mix(mix):
+    mix = [float(x) for x in mix]
+    magnitude = sum(mix)
+    if magnitude == 0:
+        return [1.0] + [0.0] * (len(mix) - 1)
+    return [round(x / magnitude, 6) for x in mix]
+
+
+#Split a requested mix into its weights and whether it is linear. A mix is either a
+#list of weights, which are normalised, or {"mix": [weights], "linear": true}, whose
+#weights are used as they are (see generate_linear_mix).
+def parse_mix(model):
+    if isinstance(model, dict):
+        return [float(x) for x in model["mix"]], bool(model.get("linear", False))
+    return [float(x) for x in model], False
+
+
+#Identify the model a request needs, so jobs that can share a loaded model run together.
+def model_key(model):
+    if isinstance(model, str):
+        if model == "" and len(models) > 0:
+            return models[0]["name"]
+        return model
+    try:
+        weights, linear = parse_mix(model)
+        if linear:
+            return json.dumps({"linear": weights})
+        return json.dumps(normalise_mix(weights))
+    except (TypeError, ValueError, KeyError):
+        return json.dumps(model)
+
+
+#Identify the currently loaded model in the same way as model_key.
+def loaded_model_name():
+    if loaded_model is None:
+        return None
+    if loaded_model is mixed_model:
+        return model_key(previous_mix)
+    return loaded_model["name"]
+
+
+#Name a mix by its (normalised, unless linear) weights and the identity (path, size
+#and modification time) of every source checkpoint it draws from.
+def mix_cache_key(weights, linear):
+    if not linear:
+        weights = normalise_mix(weights)
+    sources = [list(checkpoint_key(m["path"])) if w != 0 else None for m, w in zip(models, weights)]
+    return hashlib.sha256(json.dumps([weights, sources, linear]).encode()).hexdigest()[:32]
+
+
 #Replace the currently loaded model (if any) with a new one.
 def load_model(m):
     global webui
     global loaded_model
+    global loaded_model_key
     print(f'Loading model "{m["name"]}')
+    start = time.perf_counter()
+
+    #Whatever mix was applied in memory is about to be overwritten.
+    global applied_mix
+    applied_mix = None
+
+    #Once webui is running, swap the weights in rather than reloading all of webui.
+    if "webui" in sys.modules and swap_model(m):
+        loaded_model = m
+        loaded_model_key = checkpoint_key(m["path"])
+        print(f"Model cache: {model_cache.stats()}")
+        metrics.observe("sdapi_model_load_seconds", time.perf_counter() - start, method="swap")
+        return
+
     try:
         i = sys.argv.index("--ckpt")
         try:
@@ -74,6 +325,61 @@ def load_model(m):
     else:
         importlib.reload(webui)
     loaded_model = m
+    metrics.observe("sdapi_model_load_seconds", time.perf_counter() - start, method="reload")
+    try:
+        loaded_model_key = checkpoint_key(m["path"])
+    except OSError:
+        loaded_model_key = None
+
+
+#Load a checkpoint with its tensors memory-mapped instead of read into RAM, so that
+#mixing only pages in the tensors it's working on. Falls back to a normal load for
+#PyTorch versions or checkpoint formats that can't be memory-mapped.
+def load_checkpoint_lazily(path):
+    import torch
+    try:
+        return torch.load(path, map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError) as err:
+        print(f"Unable to memory-map {path}, loading it into RAM instead: {err}")
+        return torch.load(path, map_location="cpu")
+    finally:
+        del torch
+
+
+#Whether a tensor holds floating point (or complex) values.
+def is_floating_type(tensor):
+    return tensor.is_floating_point() or tensor.is_complex()
+
+
+#Mix one key of the checkpoints' state dicts: a weighted sum over the models that
+#have the key (skipping any whose floating-pointness differs from the first
+#model's), divided by the sum of their weights. The first weighted term becomes the
+#output and the rest are added into it in place, so only the output and one
+#temporary tensor are ever allocated. Returns None if no model contributes.
+def mix_tensor(k, theta, mix):
+    count = 0
+    total = 0
+    temptheta = None
+    for i in range(0, len(theta)):
+        if k in theta[i]:
+            if k in theta[0] and is_floating_type(theta[0][k]) != is_floating_type(theta[i][k]):
+                continue
+            count += 1
+            total += mix[i]
+            term = mix[i] * theta[i][k]
+            if temptheta is None:
+                #Matches the old "0 + term" exactly (it turns -0.0 into 0.0).
+                temptheta = term.add_(0)
+            else:
+                temptheta += term
+            del term
+
+    if count == 0:
+        return None
+
+    assert total != 0, "Invalid total"
+    #Ensure that the sum of mixes for this key is 1.
+    return temptheta.div_(total)
 
 
 #Generate a mixed model
@@ -81,6 +387,10 @@ def load_model(m):
 #      of indeterminate origin. I don't know if the original
 #      worked "correctly", or whether I correctly generalized
 #      it to N models. However, empirically it seems to work.
+#
+#The checkpoints are memory-mapped and mixed one key at a time into the first
+#model's state dict, so peak memory stays near the size of one model rather than
+#the sum of all of them. See bench/mix_checkpoints.py.
 def generate_mixed_model(in_mix, path):
     try:
         global models
@@ -112,7 +422,7 @@ def generate_mixed_model(in_mix, path):
                     break
 
             print(f'No mix required. Using model {i}: {models[i]["name"]}')
-            os.symlink(models[i]["path"], path)
+            os.symlink(os.path.abspath(models[i]["path"]), path)
             del torch
             return
 
@@ -122,25 +432,11 @@ def generate_mixed_model(in_mix, path):
             in_mix[i] /= magnitude
 
 
-        j = 0
-
         for i in range(0, len(models)):
             if in_mix[i] != 0:
-                models_to_mix.append(torch.load(models[i]["path"]))
-
-                theta.append(models_to_mix[j]['state_dict'])
-
+                models_to_mix.append(load_checkpoint_lazily(models[i]["path"]))
+                theta.append(models_to_mix[-1]['state_dict'])
                 mix.append(in_mix[i])
-                j += 1
-
-        def isFloatingType(tensor):
-            return tensor.dtype in [
-                    torch.float, torch.float32, 
-                    torch.float64, torch.double,
-                    torch.float16, torch.half,
-                    torch.bfloat16,
-                    torch.cfloat,
-                    torch.cdouble]
 
 
         #Get a list of all the keys with no duplicates.
@@ -151,23 +447,9 @@ def generate_mixed_model(in_mix, path):
         
         for k in allkeys:
             if 'model' in k:
-                count = 0
-                total = 0
-                temptheta = 0
-                for i in range(0, len(models_to_mix)):
-                    if k in theta[i]:
-                        if k in theta[0] and isFloatingType(theta[0][k]) != isFloatingType(theta[i][k]):
-                            continue
-                        count += 1
-                        total += mix[i]
-                        temptheta += mix[i] * theta[i][k]
-
-                if count > 0:
-                    assert total != 0, "Invalid total"
-                    #assert math.isfinite(temptheta), "Non-finite temptheta"
-
-                    #Ensure that the sum of mixes for this key is 1.
-                    theta[0][k] = temptheta / total
+                mixed = mix_tensor(k, theta, mix)
+                if mixed is not None:
+                    theta[0][k] = mixed
 
 
         mixed_model = models_to_mix[0]
@@ -179,9 +461,10 @@ def generate_mixed_model(in_mix, path):
 
 
 
-#Currently unused. This would allow a direct, linear mix rather than
-#one that adjusts weights in cases where a key is not in all source models.
+#This allows a direct, linear mix rather than one that adjusts
+#weights in cases where a key is not in all source models.
 #Might be useful for interpolation animations, (needs experimentation)
+#Used for {"linear": true} mixes when they can't be applied in memory.
 def generate_linear_mix(in_mix, path):
     try:
         global models
@@ -193,7 +476,7 @@ def generate_linear_mix(in_mix, path):
         j = 0
         for i in range(0, len(models)):
             if in_mix[i] != 0:
-                models_to_mix.append(torch.load(models[i]["path"]))
+                models_to_mix.append(load_checkpoint_lazily(models[i]["path"]))
                 theta.append(models_to_mix[j]['state_dict'])
                 mix.append(in_mix[i])
                 j += 1
@@ -220,32 +503,606 @@ def generate_linear_mix(in_mix, path):
 
 
 
+#Get the weights of a checkpoint to mix from: from the model cache if it holds them,
+#or else memory-mapped from the file, like generate_mixed_model does. The mix then
+#only pages in one key of each source at a time, and those pages can be dropped
+#again, so a mix never needs more RAM than the cache's budget and the running model.
+def get_mix_weights(m):
+    state_dict = model_cache.get(checkpoint_key(m["path"]))
+    if state_dict is None:
+        checkpoint = load_checkpoint_lazily(m["path"])
+        state_dict = checkpoint.get("state_dict", checkpoint)
+    return state_dict
+
+
+#The models contributing to one key of a mix and the sum of their weights, following
+#the same rules as mix_tensor (normal mixes) or generate_linear_mix (linear ones).
+def mix_contributors(k, theta, weights, linear):
+    contributors = []
+    for i in range(0, len(theta)):
+        if k in theta[i]:
+            if not linear and k in theta[0] and is_floating_type(theta[0][k]) != is_floating_type(theta[i][k]):
+                continue
+            contributors.append(i)
+    return contributors, sum(weights[i] for i in contributors)
+
+
+#Apply a mix directly to the weights of webui's running model, instead of writing a
+#checkpoint and reloading it. If the previous in-memory mix used the same source
+#checkpoints, only the change is applied: each tensor is rescaled for its new total
+#weight and the sources whose weights changed are added in. Returns False if webui
+#has no model that can be updated in place.
+def apply_mix_in_memory(weights, linear):
+    global applied_mix
+    model = get_pipeline_model()
+    if model is None:
+        return False
+
+    import torch
+    try:
+        used = [i for i in range(0, len(models)) if weights[i] != 0]
+        if not linear and len(used) == 0:
+            weights = normalise_mix(weights)
+            used = [0]
+        sources = [checkpoint_key(models[i]["path"]) for i in used]
+        theta = [get_mix_weights(models[i]) for i in used]
+        mix = [weights[i] for i in used]
+        current = model.state_dict()
+
+        previous = applied_mix
+        incremental = previous is not None and previous["sources"] == sources \
+                      and previous["linear"] == linear and previous["deltas"] < remix_refresh
+        applied_mix = None #In case this fails halfway through.
+
+        with torch.no_grad():
+            for k, param in current.items():
+                if 'model' not in k:
+                    #Like a file mix, everything else comes from the first model.
+                    if not incremental and k in theta[0]:
+                        param.copy_(theta[0][k])
+                    continue
+
+                contributors, total = mix_contributors(k, theta, mix, linear)
+                if len(contributors) == 0:
+                    continue
+
+                #Integer buffers (like position ids) can't be rescaled in place, and
+                #are small, so they are always mixed from scratch.
+                if not incremental or not is_floating_type(param):
+                    if linear:
+                        mixed = sum(mix[i] * theta[i][k] for i in contributors)
+                    else:
+                        mixed = mix_tensor(k, theta, mix)
+                    param.copy_(mixed)
+                    del mixed
+                    continue
+
+                old_total = sum(previous["mix"][i] for i in contributors)
+                scale = 1 if linear else total
+                if not linear and old_total != total:
+                    param.mul_(old_total / total)
+                for i in contributors:
+                    if mix[i] != previous["mix"][i]:
+                        param.add_(theta[i][k] * ((mix[i] - previous["mix"][i]) / scale))
+
+        applied_mix = {"sources": sources, "linear": linear, "mix": mix,
+                       "deltas": previous["deltas"] + 1 if incremental else 0}
+        print(f'Applied mix {weights} in memory{" incrementally" if incremental else ""}.')
+        return True
+    finally:
+        del torch
+
+
 #Generate a mixed model and load it.
+#The mix is applied to the running model in memory if possible. Otherwise mixes are
+#kept in the mix cache, so a mix that was used before is just loaded.
 def load_mixed_model(mix):
     global models
     global mixed_model
     global previous_mix
+    global mix_cache
+    global loaded_model
+    global loaded_model_key
+    weights, linear = parse_mix(mix)
+    assert len(weights) == len(models), "Wrong number of mix scalars"
+
+    try:
+        start = time.perf_counter()
+        if loaded_model is not None and apply_mix_in_memory(weights, linear):
+            metrics.observe("sdapi_model_mix_seconds", time.perf_counter() - start, method="memory")
+            previous_mix = copy.deepcopy(mix)
+            mixed_model = {"name": "mixed_model", "path": None}
+            loaded_model = mixed_model
+            loaded_model_key = None
+            return
+    except Exception as err:
+        print(f"Unable to apply mix in memory, generating a checkpoint instead: {err}")
+        print(traceback.format_exc())
+
+    if mix_cache is None:
+        mix_cache = MixCache(mix_cache_dir, max_mix_cache_bytes)
+
+    key = mix_cache_key(weights, linear)
+    mixed_model_path = mix_cache.get(key)
+    if mixed_model_path is None:
+        print(f"Mix {mix} is not cached. Generating it.")
+        generated_path = f"{mix_cache.path(key)}.tmp"
+        start = time.perf_counter()
+        if linear:
+            generate_linear_mix(list(weights), generated_path)
+        else:
+            generate_mixed_model(list(weights), generated_path)
+        metrics.observe("sdapi_model_mix_seconds", time.perf_counter() - start, method="linear" if linear else "stream")
+        assert os.path.lexists(generated_path), "Mixed model was not generated"
+        mixed_model_path = mix_cache.add(key, generated_path)
+    else:
+        print(f"Using cached mix {mix}.")
+
     previous_mix = copy.deepcopy(mix)
-    mixed_model_path = "mixed_model.ckpt"
-    generate_mixed_model(mix, mixed_model_path)
     mixed_model = {"name": "mixed_model", "path": mixed_model_path}
     load_model(mixed_model)
 
 
+#Record that the status of a request (and of the requests waiting for its result)
+#changed and wake anyone waiting on it. Must be called with the lock held.
+def touch(request_id):
+    global change_seq
+    change_seq += 1
+    for i in [request_id] + result_cache.followers.get(request_id, []):
+        versions[i] = versions.get(i, 0) + 1
+        changed_at[i] = change_seq
+    status_changed.notify_all()
+
+
+#Record that every pending request changed, e.g. because the queue moved forward.
+#Must be called with the lock held.
+def touch_pending():
+    global change_seq
+    change_seq += 1
+    for i in scheduler.pending + list(result_cache.leaders):
+        versions[i] = versions.get(i, 0) + 1
+        changed_at[i] = change_seq
+    status_changed.notify_all()
+
+
+#Add the queue position and the progress of the running job to a status dict.
+def add_progress(status, request_id, done):
+    #Let the requester know their current position in the queue.
+    try:
+        if done:
+            status["jobs_ahead"] = 0
+        elif request_id in scheduler:
+            #Count the running jobs too, then the jobs scheduled to run first.
+            status["jobs_ahead"] = scheduler.position(request_id, workers.next_model()) + len(workers.running())
+            status["cur_task"] = "waiting"
+        else:
+            status["jobs_ahead"] = 0
+
+    except Exception as err:
+        print(f"Unable to get number of jobs ahead: {err}. Using 999.")
+        status["jobs_ahead"] = 999
+
+
+    #Get the percentage of the job itself if it's running, or else of the running
+    #job closest to finishing.
+    try:
+        if done:
+            status["cur_job_progress"] = 1
+            status["cur_task"] = "done"
+        else:
+            running = [request_id] if request_id in workers else workers.running()
+            status["cur_job_progress"] = max([job_progress(i) for i in running] + [0])
+    except Exception as err:
+        print(f"Unable to get job progress: {err}. Using 0.")
+        status["cur_job_progress"] = 0
+
+
+    #Estimate when the job starts and finishes (as Unix times), and suggest how
+    #long to wait before polling again: until about when it starts, or a tenth of
+    #what's left of it once it runs.
+    try:
+        estimate = None if done else job_eta(request_id)
+        if estimate is not None:
+            start, finish = estimate
+            now = time.time()
+            status["estimated_start"] = round(now + max(0, start), 2)
+            status["estimated_finish"] = round(now + finish, 2)
+            wait = start if start > 0 else (finish - max(0, start)) / 10
+            status["poll_after"] = round(min(max(wait, 0.5), 30), 2)
+    except Exception as err:
+        print(f"Unable to estimate when request {request_id} finishes: {err}")
+
+
+#The latest counters of a running job from its worker's progress block, or None.
+#Only reads the block and looks up dicts, so it's safe to call without the lock.
+def block_progress(request_id):
+    worker_id = workers.owner(request_id)
+    block = progress_blocks.get(worker_id)
+    if block is None:
+        return None
+    #The block holds the first job of the worker's current claim, or else an old job.
+    progress = block.read()
+    if progress is None or workers.owner(progress[0]) != worker_id:
+        return None
+    return {"step": progress[1], "iter": progress[2], "total_steps": progress[3], "total_iters": progress[4]}
+
+
+#The status of a request, with the latest counters from its worker's progress block,
+#which are newer than the ones it last reported. Must be called with the lock held.
+def live_status(request_id):
+    status = requests[request_id]["status"]
+    if not isinstance(status, dict):
+        return status
+    progress = block_progress(request_id)
+    if progress is None:
+        return status
+    return dict(status, **progress)
+
+
+#Get the fraction of a running job's sampling steps that are done.
+def job_progress(request_id):
+    try:
+        return progress_fraction(live_status(request_id))
+    except Exception:
+        return 0
+
+
+#Get the fraction of the sampling steps done from a job's status.
+def progress_fraction(current_processing_status):
+    try:
+        cur_step = current_processing_status["step"]
+        cur_iter = current_processing_status["iter"]
+        total_steps = current_processing_status["total_steps"]
+        total_iters = current_processing_status["total_iters"]
+        return (cur_iter * total_steps + cur_step) / (total_iters * total_steps)
+    except Exception:
+        return 0
+
+
+#Estimate the memory held by the images (PIL images or encoded bytes) in an object.
+def image_bytes(obj):
+    if isinstance(obj, dict):
+        return sum(image_bytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(image_bytes(v) for v in obj)
+    if isinstance(obj, (bytes, bytearray)):
+        return len(obj)
+    if isinstance(obj, SpooledImages):
+        return obj.size
+    if hasattr(obj, "size") and hasattr(obj, "mode"):
+        return obj.size[0] * obj.size[1] * max(1, len(obj.mode))
+    return 0
+
+
+#Update the job store's accounting for a request. Must be called with the lock held.
+def account(request_id, size):
+    global job_store_bytes
+    job_store_bytes += size - job_bytes.get(request_id, 0)
+    job_bytes[request_id] = size
+
+
+#Forget a finished request and its results. Must be called with the lock held.
+def forget(request_id):
+    global job_store_bytes
+    requests.pop(request_id, None)
+    versions.pop(request_id, None)
+    changed_at.pop(request_id, None)
+    status_snapshots.pop(request_id, None)
+    finished.pop(request_id, None)
+    job_store_bytes -= job_bytes.pop(request_id, 0)
+    results.discard(request_id)
+    result_cache.discard(request_id)
+
+
+#Forget expired finished jobs, then the oldest finished jobs until the store has
+#room for `count` more jobs holding `size` bytes. Must be called with the lock held.
+def evict_requests(size=0, count=0):
+    expiry = time.time() - job_ttl
+    while finished and next(iter(finished.values())) < expiry:
+        forget(next(iter(finished)))
+
+    while finished and (job_store_bytes + size > max_job_bytes or len(requests) + count > max_requests):
+        forget(next(iter(finished)))
+
+
+#Mark a request as finished, dropping the input images that are no longer needed.
+#Must be called with the lock held.
+def retire_request(request):
+    request["done"] = True
+    params = request.get("params")
+    if isinstance(params, dict):
+        #The API never returns these, so keep the keys but free the images.
+        for k in ("init_info_mask", "image"):
+            if k in params:
+                remove_spooled(params[k])
+                params[k] = None
+
+    requests[request["id"]] = request
+    scheduler.forget(request["id"])
+    submitted_at.pop(request["id"], None)
+    touch(request["id"])
+    account(request["id"], image_bytes(request))
+    finished[request["id"]] = time.time()
+    settle_followers(request)
+    evict_requests()
+
+
+#Identify the result of a request by a digest of its type, model and params, if it
+#is reproducible: it has a fixed seed and doesn't ask for logs. None for requests
+#that have to run on their own, including those that opt out of the cache.
+def result_digest(request):
+    params = request.get("params")
+    if not dedup_requests or request.get("cache") is False or request.get("include_logs") or not isinstance(params, dict):
+        return None
+    seed = params.get("seed")
+    if seed in (None, "", -1, "-1") or resolve_seed(seed) is None:
+        return None
+    return request_digest([request["type"], model_key(request["model"]), params])
+
+
+#Get a finished request with the given digest whose results are still held, and
+#its images, or None. Must be called with the lock held.
+def cached_result(digest):
+    source = result_cache.finished(digest)
+    if source is None:
+        return None
+    images = results.get(source, spooled=True) if source in requests else None
+    if images is None:
+        result_cache.discard(source)
+        return None
+    return requests[source], images
+
+
+#Give a request a copy of the result of an identical request that finished.
+#The encoded images are shared, not copied: a spooled file gets a second name.
+#Must be called with the lock held.
+def copy_result(request, source, images):
+    for k in ("success", "retval", "log_out", "log_err"):
+        if k in source:
+            request[k] = source[k]
+    request["status"] = dict(source["status"]) if isinstance(source["status"], dict) else source["status"]
+    request["cached"] = True
+    if isinstance(images, SpooledImages):
+        images = link_images(images)
+    if images is not None:
+        results.put(request["id"], images)
+
+
+#Finish the requests that waited for the result of one that just finished, with a
+#copy of its result. If it was cancelled, the first of them runs in its place.
+#Must be called with the lock held.
+def settle_followers(request):
+    if "cancel" in request:
+        leader_id = result_cache.hand_over(request["id"])
+        if leader_id is not None:
+            leader = requests[leader_id]
+            scheduler.add(leader_id, model_key(leader["model"]), leader.get("key", ""), leader["priority"], job_cost(leader))
+            submitted_at[leader_id] = time.monotonic()
+            touch(leader_id)
+            job_added.notify_all()
+
+    followers = result_cache.finish(request["id"], request.get("success") is True)
+    if followers:
+        images = results.get(request["id"], spooled=True) if request.get("success") else None
+        for i in followers:
+            copy_result(requests[i], request, images)
+            retire_request(requests[i])
+
+
+#Estimate the work a job needs, in units of one sampling step of a 512x512 image.
+def job_cost(request):
+    cost = work_cost(request)
+    if model_key(request["model"]) not in workers.loaded_models():
+        cost += model_switch_cost
+    return cost
+
+
+#The cost of a job without any model switch.
+def work_cost(request):
+    params = request.get("params") or {}
+    try:
+        if request["type"] == "imgproc":
+            return imgproc_cost
+        pixels = int(params.get("width") or 512) * int(params.get("height") or 512)
+        return pixels / (512 * 512) * job_steps(request) * int(params.get("batch_size") or 1)
+    except (TypeError, ValueError):
+        return 50
+
+
+#The number of sampling steps (of each image in the batch) a job runs.
+def job_steps(request):
+    params = request["params"]
+    return int(params.get("ddim_steps") or 50) * int(params.get("n_iter") or 1)
+
+
+#What a job's sampling speed is learned under.
+def eta_key(request):
+    params = request["params"]
+    return (model_key(request["model"]), params.get("sampler_name"), params.get("width"), params.get("height"))
+
+
+#Estimate how many seconds a job takes to run once its model is loaded, from the
+#learned timings, or else from its cost.
+def estimate_run(request):
+    try:
+        if request["type"] == "imgproc":
+            seconds = eta.job_time(request["type"])
+        else:
+            step = eta.step_time(eta_key(request))
+            seconds = None if step is None else step * job_steps(request) * int(request["params"].get("batch_size") or 1)
+    except (TypeError, ValueError):
+        seconds = None
+    return seconds if seconds is not None else work_cost(request) / cost_rate
+
+
+def estimate_switch(model):
+    seconds = eta.switch_time(model)
+    return seconds if seconds is not None else model_switch_cost / cost_rate
+
+
+#Estimate how many more seconds a running job needs.
+def estimate_remaining(request_id, now):
+    request = requests[request_id]
+    run = estimate_run(request)
+    progress = job_progress(request_id)
+    if progress > 0:
+        return run * (1 - progress)
+    remaining = run - (now - claimed_at.get(request_id, now))
+    if isinstance(request["status"], dict) and request["status"].get("cur_task") == "model_load":
+        remaining += estimate_switch(model_key(request["model"]))
+    return max(0, remaining)
+
+
+#Estimate when every job starts and finishes, in seconds from now, by handing the
+#jobs in scheduled order to whichever worker is free first, adding a model switch
+#whenever a worker's model changes. Pending jobs get no estimate without workers.
+#Must be called with the lock held.
+def estimate_times():
+    now = time.monotonic()
+    estimates = {}
+    free = [] #[seconds until free, model] of each worker.
+    for worker in workers.workers.values():
+        busy = 0
+        for i in worker["jobs"]:
+            remaining = estimate_remaining(i, now)
+            estimates[i] = (claimed_at.get(i, now) - now, remaining)
+            busy = max(busy, remaining)
+        free.append([busy, worker["model"]])
+    if not free:
+        return estimates
+
+    for i in scheduler.schedule(workers.next_model()):
+        slot = min(free, key=lambda f: f[0])
+        model = scheduler.models[i]
+        start = slot[0] if slot[1] == model else slot[0] + estimate_switch(model)
+        finish = start + estimate_run(requests[i])
+        estimates[i] = (start, finish)
+        slot[0] = finish
+        slot[1] = model
+    return estimates
+
+
+#Get the estimated (start, finish) of a job in seconds from now, or None. Uses the
+#cached estimates unless the queue changed or they are getting old.
+#Must be called with the lock held.
+def job_eta(request_id):
+    order = scheduler.schedule(workers.next_model())
+    now = time.monotonic()
+    if eta_cache["order"] is not order or now - eta_cache["at"] > eta_refresh:
+        eta_cache["estimates"] = estimate_times()
+        eta_cache["order"] = order
+        eta_cache["at"] = now
+    estimate = eta_cache["estimates"].get(request_id)
+    if estimate is None:
+        return None
+    age = now - eta_cache["at"]
+    return estimate[0] - age, max(0, estimate[1] - age)
+
+
+#Learn from the timings a worker measured for a finished job.
+#Must be called with the lock held.
+def record_timings(request, timings):
+    try:
+        if timings.get("switch") is not None:
+            eta.record_switch(model_key(request["model"]), timings["switch"])
+        if request["type"] == "imgproc":
+            eta.record_job(request["type"], timings["sampling"])
+        else:
+            eta.record_sampling(eta_key(request), timings["steps"], timings["images"], timings["sampling"])
+    except (KeyError, TypeError, ValueError) as err:
+        print(f"Unable to learn from the timings of request {request['id']}: {err}")
+
+
+#How many seconds until a job of the given cost from the given key would fit in the
+#queued cost budgets, or None if it fits now. A job that is over budget on its own
+#is still let in when nothing else is queued. Must be called with the lock held.
+def admission_delay(key, cost):
+    excess = 0
+    if max_queued_cost > 0 and scheduler.queued_cost > 0:
+        excess = max(excess, scheduler.queued_cost + cost - max_queued_cost)
+    if max_key_queued_cost > 0 and scheduler.key_costs[key] > 0:
+        excess = max(excess, scheduler.key_costs[key] + cost - max_key_queued_cost)
+    if excess <= 0:
+        return None
+    return max(1, math.ceil(excess / (cost_rate * max(1, len(workers.workers)))))
+
+
+#Learn how fast the workers get through queued work from a job that took the given
+#number of seconds to run. Must be called with the lock held.
+def record_cost_rate(request_id, seconds):
+    global cost_rate
+    job = scheduler.jobs.get(request_id)
+    if job is not None and seconds > 0:
+        cost_rate = 0.8 * cost_rate + 0.2 * (job[2] / seconds)
+
+
 #Add a new request
 def add_request(request):
     global next_id
     global requests
     global max_requests
+
+    #Hash the request before taking the lock, as its params may hold large images.
+    try:
+        digest = result_digest(request)
+    except Exception as err:
+        print(f"Unable to hash request, so it can't share results: {err}")
+        digest = None
+
     with lock:
         try:
+            priority = request.setdefault("priority", priorities[0])
+            if priority not in priorities:
+                msg = f'{{"error": "Unknown priority {priority}. Use one of: {", ".join(priorities)}."}}'
+                print(msg)
+                metrics.inc("sdapi_jobs_rejected_total", reason="priority")
+                return msg
+
+            #An identical request may already have the result, or be computing it.
+            cached = None if digest is None else cached_result(digest)
+            leader_id = None if digest is None or cached is not None else result_cache.computing.get(digest)
+
+            #Refuse the request if there is already too much work queued.
+            cost = job_cost(request)
+            retry_after = None if cached is not None or leader_id is not None else admission_delay(request.get("key", ""), cost)
+            if retry_after is not None:
+                msg = f'{{"error": "Too much work is queued. Try again in {retry_after} seconds.", "retry_after": {retry_after}}}'
+                print(msg)
+                metrics.inc("sdapi_jobs_rejected_total", reason="cost")
+                return msg
+
+            #Make room for the new request, or refuse it if only pending jobs are left.
+            size = image_bytes(request)
+            evict_requests(size, 1)
+            if job_store_bytes + size > max_job_bytes or len(requests) + 1 > max_requests:
+                #A finished job makes room, so come back after about one job's worth of work.
+                retry_after = max(1, math.ceil(cost / (cost_rate * max(1, len(workers.workers)))))
+                msg = f'{{"error": "The job queue is full. Try again in {retry_after} seconds.", "retry_after": {retry_after}}}'
+                print(msg)
+                metrics.inc("sdapi_jobs_rejected_total", reason="full")
+                return msg
+
             request["id"] = next_id
             requests[next_id] = request
+            account(next_id, size)
+            metrics.inc("sdapi_jobs_submitted_total", type=request["type"])
             next_id = next_id + 1
-
-            #Clear old requests so we don't run out of memory.
-            if next_id > max_requests:
-                requests[next_id - max_requests] = {} 
+            if cached is not None:
+                source, images = cached
+                copy_result(request, source, images)
+                retire_request(request)
+                metrics.inc("sdapi_jobs_deduplicated_total", outcome="cached")
+            elif leader_id is not None:
+                result_cache.follow(request["id"], leader_id)
+                touch(request["id"])
+                metrics.inc("sdapi_jobs_deduplicated_total", outcome="joined")
+            else:
+                if digest is not None:
+                    result_cache.add(digest, request["id"])
+                scheduler.add(request["id"], model_key(request["model"]), request.get("key", ""), priority, cost)
+                submitted_at[request["id"]] = time.monotonic()
+                touch(request["id"])
+                job_added.notify_all()
             return request
         except Exception as err:
             msg = f'{{"error": "Error adding request: {err}"}}'
@@ -255,48 +1112,20 @@ def add_request(request):
 
 #Get the shared state of the request object.
 def get_request(request_id):
-    global processing_id
     global next_id
     global requests
     try:
-        #Make a copy so nothing can accidentally change the state while we work.
+        #Copy only the top level and the status so nothing can change them while
+        #we work. The images in params and retval are never modified in place, so
+        #they can be shared instead of deep-copied, which keeps the lock hold short.
         with lock:
-            r = copy.deepcopy(requests[request_id])
-
-
-        #Let the requester know their current position in the queue.
-        try:
-            if r["done"]:
-                r["status"]["jobs_ahead"] = 0
-            else:
-                r["status"]["jobs_ahead"] = max(0, request_id - processing_id)
-                if r["status"]["jobs_ahead"] != 0:
-                    r["status"]["cur_task"] = "waiting"
-
-        except Exception as err:
-            print(f"Unable to get number of jobs ahead: {err}. Using 999.")
-            r["status"]["jobs_ahead"] = 999
-
-
-        #Get the percentage of the currently running job.
-        #Maybe eventually we provide a proper estimate of the time until completion?
-        try:
-            if r["done"]:
-                r["status"]["cur_job_progress"] = 1
-                r["status"]["cur_task"] = "done"
-            else:
-                current_processing_request = requests[processing_id]
-                current_processing_status = current_processing_request["status"]
-                cur_step = current_processing_status["step"]
-                cur_iter = current_processing_status["iter"]
-                total_steps = current_processing_status["total_steps"]
-                total_iters = current_processing_status["total_iters"]
-                progress = (cur_iter * total_steps + cur_step) / (total_iters * total_steps)
-                r["status"]["cur_job_progress"] = progress
-        except Exception as err:
-            print(f"Unable to get current job progress: {err}. Assuming 0.")
-            r["status"]["cur_job_progress"] = 0
-
+            r = dict(requests[request_id])
+            #A request waiting for an identical one shows that one's progress.
+            source = result_cache.leader(request_id) or request_id
+            r["status"] = live_status(source)
+            if isinstance(r["status"], dict):
+                r["status"] = dict(r["status"])
+                add_progress(r["status"], source, r["done"])
         return r
     except Exception as err:
         msg = f'{{"error": "Error getting request {request_id}: {err}"}}'
@@ -311,11 +1140,262 @@ def set_request(request):
     with lock:
         try:
             requests[request["id"]] = request
+            touch(request["id"])
         except Exception as err:
             msg = f'{{"error": "Error setting request: {err}"}}'
             print(msg)
 
 
+#Update fields of a request. Only the given fields (and the id) are sent and changed.
+def update_request(request):
+    global requests
+    with lock:
+        try:
+            requests[request["id"]].update(request)
+            touch(request["id"])
+        except Exception as err:
+            msg = f'{{"error": "Error updating request: {err}"}}'
+            print(msg)
+
+
+#Get just the small status fields of a request, without any of its images.
+#Must be called with the lock held.
+def project_status(request_id):
+    r = requests[request_id]
+    #A request waiting for an identical one shows that one's progress.
+    source = result_cache.leader(request_id) or request_id
+    status = live_status(source)
+    s = {"id": request_id, "type": r["type"], "key": r.get("key", ""), "done": r["done"],
+         "version": versions.get(request_id, 0)}
+    for k in ("success", "cancel", "cached"):
+        if k in r:
+            s[k] = r[k]
+
+    #A failed request has an error message instead of a status.
+    if not isinstance(status, dict):
+        s["error"] = status
+        s["status"] = {}
+        return s
+
+    s["status"] = dict(status)
+    add_progress(s["status"], source, r["done"])
+    return s
+
+
+#Project the status of a request and keep it as the request's snapshot. Must be
+#called with the lock held.
+def take_snapshot(request_id):
+    s = project_status(request_id)
+    source = result_cache.leader(request_id) or request_id
+    status_snapshots[request_id] = (s["version"], time.monotonic(), source, s)
+    return s
+
+
+#Get the status of a request from its snapshot, without the lock, or None if there
+#is no snapshot or it's out of date. The sampling progress of a running job is read
+#from its worker's progress block, so it's as current as with the lock.
+def read_snapshot(request_id):
+    snapshot = status_snapshots.get(request_id)
+    if snapshot is None:
+        return None
+    version, taken, source, s = snapshot
+    if version != versions.get(request_id, 0) or time.monotonic() - taken > status_snapshot_age:
+        return None
+    if s["done"]:
+        return s
+    try:
+        progress = block_progress(source)
+    except Exception:
+        #E.g. the block was replaced and closed while reading it.
+        return None
+    if progress is None:
+        return s
+    status = dict(s["status"], **progress)
+    status["cur_job_progress"] = progress_fraction(status)
+    return dict(s, status=status)
+
+
+#Take the lock for one of the calls that contend for it most, recording whether it
+#was free and, if not, how long the call waited for it.
+@contextmanager
+def contended_lock(call):
+    waited = None
+    if not lock.acquire(False):
+        start = time.perf_counter()
+        lock.acquire()
+        waited = time.perf_counter() - start
+    try:
+        yield
+    finally:
+        lock.release()
+        metrics.inc("sdapi_queue_lock_acquires_total", call=call, contended="no" if waited is None else "yes")
+        if waited is not None:
+            metrics.observe("sdapi_queue_lock_wait_seconds", waited, call=call)
+
+
+#Get the current status of a request.
+def get_status(request_id):
+    try:
+        s = read_snapshot(request_id) if status_snapshot_age > 0 else None
+        if s is not None:
+            metrics.inc("sdapi_status_reads_total", source="snapshot")
+            return s
+        metrics.inc("sdapi_status_reads_total", source="lock")
+        with contended_lock("get_status"):
+            if status_snapshot_age > 0:
+                return take_snapshot(request_id)
+            return project_status(request_id)
+    except Exception as err:
+        msg = f'{{"error": "Error getting status of request {request_id}: {err}"}}'
+        print(msg)
+        return msg
+
+
+#Wait until the status of a request differs from the given version, or until the
+#timeout expires, then return the current status. Finished requests never change,
+#so they return immediately.
+def wait_for_status(request_id, version, timeout):
+    try:
+        with lock:
+            status_changed.wait_for(lambda: versions.get(request_id, 0) != version or requests[request_id]["done"], timeout)
+            return project_status(request_id)
+    except Exception as err:
+        msg = f'{{"error": "Error waiting for status of request {request_id}: {err}"}}'
+        print(msg)
+        return msg
+
+
+#Wait until the status of any request changes after the given change sequence
+#number, or until the timeout expires. Returns the current sequence number and the
+#ids of the requests that changed since seq (all of them if seq is from before the
+#queue restarted). A seq of None returns right away, to get the current number.
+#This lets a server wait on behalf of all its clients with a single call.
+def wait_for_changes(seq, timeout):
+    with lock:
+        if seq is None:
+            return change_seq, []
+        status_changed.wait_for(lambda: change_seq != seq, timeout)
+        return change_seq, [i for i, at in changed_at.items() if at > seq or seq > change_seq]
+
+
+#Get the statuses of several requests, skipping those that no longer exist.
+def get_statuses(request_ids):
+    with lock:
+        return {i: project_status(i) for i in request_ids if i in requests}
+
+
+#Get the encoded images of a finished request (a list of PNG bytes), or None.
+#Callers that share the image spool may pass spooled to get the handle of a file
+#holding them instead, and read it themselves.
+def get_result(request_id, spooled=False):
+    return results.get(request_id, spooled)
+
+
+#Get one encoded image (PNG bytes) of a finished request, or None. With spooled,
+#an image held in a file comes as the handle of the file.
+def get_result_image(request_id, index, spooled=False):
+    return results.get_image(request_id, index, spooled)
+
+
+#Where the image spool is, for API servers and workers to attach to, or None.
+def get_spool():
+    if image_spool is None:
+        return None
+    return image_spool.directory, image_spool.spool_id
+
+
+#Get one image of a spooled upload, for a worker that doesn't share the spool.
+def get_spooled_image(handle, index):
+    if image_spool is None or not image_spool.contains(handle):
+        return None
+    return read_images(handle, index)
+
+
+#Remove the spool file of an upload in a request's params, if it has one.
+def remove_spooled(value):
+    if isinstance(value, dict):
+        for v in value.values():
+            remove_spooled(v)
+    elif isinstance(value, SpooledImages):
+        remove_images(value)
+
+
+#Get the number of encoded images of a finished request, or None.
+def get_result_count(request_id):
+    return results.count(request_id)
+
+
+#Split a webui return value into its list of images and everything else.
+#txt2img and img2img return (images, ...), while imgproc returns just the images.
+def split_retval(retval):
+    try:
+        return list(retval[0]), tuple(retval[1:])
+    except TypeError:
+        return list(retval), ()
+
+
+#Uploaded images come from the API still compressed, possibly as a file in the image
+#spool. Decode them into PIL images just before the job runs, so each is decoded
+#once, here in the worker.
+def decode_images(queue, request):
+    params = request["params"]
+    if request["type"] == "img2img":
+        #The queue may share this dict with us, and keeps the images it holds.
+        mask = dict(params.get("init_info_mask") or {})
+        params["init_info_mask"] = mask
+        params = mask
+        keys = ("image", "mask")
+    elif request["type"] == "imgproc":
+        keys = ("image",)
+    else:
+        return
+    for k in keys:
+        data = params.get(k)
+        if isinstance(data, SpooledImages):
+            #A worker on another host asks the queue for the bytes instead.
+            if worker_spool is not None or queue is sys.modules[__name__]:
+                data = read_images(data, 0)
+            else:
+                data = queue.get_spooled_image(data, 0)
+        if isinstance(data, (bytes, bytearray)):
+            from PIL import Image
+            image = Image.open(io.BytesIO(data))
+            image.load()
+            params[k] = image
+
+
+#Encode a PIL image as PNG bytes.
+def encode_image(image):
+    byte_arr = io.BytesIO()
+    image.save(byte_arr, format='PNG')
+    return byte_arr.getvalue()
+
+
+#Hand the encoded images of a job to the queue as a file in the image spool, if
+#this worker shares it, so that only the handle goes through the queue.
+def spool_results(images):
+    if images is None or worker_spool is None:
+        return images
+    try:
+        return worker_spool.write(images)
+    except OSError as err:
+        print(f"Unable to spool results, sending them instead: {err}")
+        return images
+
+
+#Encode the generated images once, when the job finishes, for the result store.
+#The request keeps only the non-image part of the return value.
+def encode_results(request):
+    if request["retval"] is None:
+        return None
+    start = time.perf_counter()
+    images, rest = split_retval(request["retval"])
+    request["retval"] = (None,) + rest
+    encoded = [encode_image(i) for i in images]
+    metrics.observe("sdapi_encode_seconds", time.perf_counter() - start, stage="png")
+    return encoded
+
+
 #Get the next unassigned request ID.
 def get_next_id():
     global next_id
@@ -326,29 +1406,266 @@ def get_next_id():
 
 #Cancel one job.
 def cancel(request_id):
-    global processing_id
     with lock:
         try:
             if not requests[request_id]["done"]:
                 requests[request_id]["cancel"] = True
-            return requests[request_id]
+                touch(request_id)
+
+                #A job that hasn't started yet, or only waits for an identical one,
+                #can be finished right away.
+                if request_id in scheduler or result_cache.leader(request_id) is not None:
+                    scheduler.remove(request_id)
+                    requests[request_id]["success"] = False
+                    retire_request(requests[request_id])
+                    touch_pending()
+            return project_status(request_id)
         except Exception as err:
             msg = f'{{"error": "Error cancelling request: {err}"}}'
             print(msg)
             return msg
 
 
+#Hand the next job (or batch of compatible txt2img jobs) to a worker, waiting up
+#to timeout seconds for one. model is the model the worker has loaded, and
+#prompt_lists whether its webui takes a prompt and seed per image. Returns a list of
+#requests, empty if no job came. The worker must report back through
+#report_progress and finish_job.
+def claim_jobs(worker_id, model, prompt_lists=False, timeout=0):
+    with lock:
+        try:
+            workers.heartbeat(worker_id, model)
+            deadline = time.monotonic() + timeout
+            while True:
+                request_id = None
+                if len(scheduler) > 0:
+                    request_id = scheduler.pop_next(model, workers.idle_models(worker_id))
+                if request_id is not None:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                job_added.wait(remaining)
+
+            ids = [request_id] + take_batch(requests[request_id], model, prompt_lists)
+
+            claimed = []
+            for i in ids:
+                #Jobs cancelled while a batch was being gathered are finished right away.
+                if "cancel" in requests[i]:
+                    requests[i]["success"] = False
+                    retire_request(requests[i])
+                    continue
+                workers.claim(worker_id, i)
+                claimed_at[i] = time.monotonic()
+                if i in submitted_at:
+                    metrics.observe("sdapi_queue_wait_seconds", claimed_at[i] - submitted_at.pop(i), type=requests[i]["type"])
+                requests[i]["status"] = {"cur_task": "model_load"}
+                touch(i)
+
+                #The worker changes its copy as it goes; the images are shared, not copied.
+                job = Job(requests[i])
+                job.params = dict(job.params)
+                claimed.append(job)
+            touch_pending()
+            return claimed
+        except Exception as err:
+            print(f"Error claiming a job for worker {worker_id}: {err}")
+            return []
+
+
+#Record a worker's progress on jobs (a delta from JobProgress.update, the same for
+#every job of a batch), renewing its lease. Returns the ids of the jobs the worker
+#should stop, because they were cancelled or were requeued after the lease expired.
+def report_progress(worker_id, request_ids, delta):
+    with contended_lock("report_progress"):
+        workers.heartbeat(worker_id)
+        stop = []
+        for i in request_ids:
+            if workers.owner(i) != worker_id:
+                stop.append(i)
+                continue
+            request = requests[i]
+            if not isinstance(request["status"], dict):
+                request["status"] = {}
+            apply_progress(request["status"], delta)
+            touch(i)
+            if "cancel" in request:
+                stop.append(i)
+        return stop
+
+
+#Map the progress block of a worker, to read its sampling progress from. A worker in
+#this process passes the block itself, and one on this host the path of its file in
+#the image spool, which is removed once mapped. Returns whether the block is used.
+def attach_progress(worker_id, block):
+    if isinstance(block, str):
+        if image_spool is None or os.path.dirname(block) != image_spool.directory:
+            return False
+        path = block
+        block = ProgressBlock(path)
+        os.remove(path)
+    with lock:
+        previous = progress_blocks.get(worker_id)
+        progress_blocks[worker_id] = block
+        if previous is not None and previous is not block:
+            previous.close()
+    return True
+
+
+#Renew a worker's lease and record its loaded model, and the metrics samples it
+#recorded since its last heartbeat. Returns the ids of the given jobs it holds
+#that it should stop.
+def worker_heartbeat(worker_id, model, request_ids, samples=()):
+    metrics.apply(samples)
+    with lock:
+        workers.heartbeat(worker_id, model)
+        return [i for i in request_ids if workers.owner(i) != worker_id or "cancel" in requests.get(i, {})]
+
+
+#Accept the result of a job from a worker: the request without its params, and
+#the encoded images (or None). Returns False if the worker's lease had expired,
+#in which case the job was requeued and the result is dropped.
+def finish_job(worker_id, result, images):
+    request_id = result["id"]
+    with lock:
+        if not workers.release(worker_id, request_id):
+            print(f"Worker {worker_id} finished request {request_id} after losing it. Dropping the result.")
+            if isinstance(images, SpooledImages):
+                remove_images(images)
+            return False
+
+    #Store the images without holding the lock, as they may be spilled to disk.
+    if images is not None:
+        results.put(request_id, images)
+
+    with lock:
+        request = requests[request_id]
+        cancelled = "cancel" in request
+        timings = result.pop("timings", None)
+        request.update(result)
+        if cancelled:
+            request["cancel"] = True
+
+        seconds = time.monotonic() - claimed_at.pop(request_id, time.monotonic())
+        outcome = "cancelled" if "cancel" in request else "success" if request.get("success") else "failed"
+        if outcome == "success":
+            record_cost_rate(request_id, seconds)
+            if timings is not None:
+                record_timings(request, timings)
+        metrics.observe("sdapi_run_seconds", seconds, type=request["type"])
+        metrics.inc("sdapi_jobs_finished_total", type=request["type"], outcome=outcome)
+        retire_request(request)
+        touch_pending()
+    return True
+
+
+#Put the job of a worker that was dropped back in the queue.
+#Must be called with the lock held.
+def requeue(request_id):
+    request = requests.get(request_id)
+    claimed_at.pop(request_id, None)
+    if request is None or request["done"]:
+        return
+    metrics.inc("sdapi_jobs_requeued_total")
+    if "cancel" in request:
+        request["success"] = False
+        retire_request(request)
+        return
+    request["status"] = {}
+    scheduler.add(request_id, model_key(request["model"]), request.get("key", ""), request["priority"])
+    touch(request_id)
+
+
+#Periodically drop the workers that stopped sending heartbeats and requeue their jobs,
+#and forget the expired finished jobs, even while the queue is idle.
+def reap_workers():
+    while True:
+        time.sleep(min(1, heartbeat_interval))
+        with lock:
+            evict_requests()
+            orphans = workers.expire()
+            for request_id in orphans:
+                requeue(request_id)
+            if len(orphans) > 0:
+                touch_pending()
+                job_added.notify_all()
+
+
+#Add the metrics samples recorded by an API server process.
+def record_metrics(samples):
+    metrics.apply(samples)
+
+
+#Get the metrics of the whole service in the Prometheus text format.
+def get_metrics():
+    with lock:
+        depth = {p: 0 for p in priorities}
+        for i in scheduler.pending:
+            depth[priorities[scheduler.jobs[i][1]]] += 1
+        for p, n in depth.items():
+            metrics.set("sdapi_queue_depth", n, priority=p)
+        metrics.set("sdapi_running_jobs", len(workers.running()))
+        metrics.set("sdapi_workers", len(workers.workers))
+        metrics.set("sdapi_queued_cost", scheduler.queued_cost)
+        metrics.set("sdapi_jobs", len(requests))
+        metrics.set("sdapi_job_store_bytes", job_store_bytes)
+        metrics.set("sdapi_result_cache_entries", len(result_cache.results))
+    metrics.set("sdapi_result_store_bytes", results.size, location="memory")
+    metrics.set("sdapi_result_store_bytes", results.spill_size, location="disk")
+    return metrics.render()
+
+
+#Get the workers, their loaded models and the jobs they hold.
+def get_workers():
+    with lock:
+        return workers.stats()
+
+
+#Get the fair queuing weight of each API key that has one set.
+def get_weights():
+    with lock:
+        return dict(scheduler.weights)
+
+
+#Set the fair queuing weight of an API key. A key with weight 2 gets twice the
+#share of the workers of a key with weight 1 when both have jobs waiting.
+def set_weight(key, weight):
+    with lock:
+        try:
+            scheduler.set_weight(key, float(weight))
+            touch_pending()
+            return dict(scheduler.weights)
+        except Exception as err:
+            msg = f'{{"error": "Error setting weight: {err}"}}'
+            print(msg)
+            return msg
+
+
 #Cancel all jobs.
 def cancel_all():
-    global next_id
-    global processing_id
-    old_id = processing_id
-    processing_id = next_id
-    for i in range(old_id, next_id):
-        print(f"old_id: {old_id}, i: {i}, next_id: {next_id}")
+    #Every unfinished job: the pending ones plus those running, alone or in a batch.
+    with lock:
+        ids = [i for i, r in requests.items() if not r["done"]]
+    for i in ids:
+        print(f"Cancelling request {i}")
         cancel(i)
 
 
+#The queue functions that can be called through the proxy returned by get_queue.
+queue_methods = ['get_info', 'cancel', 'cancel_all', 'add_request', 'get_request', 'get_next_id', 'set_request', 'update_request', 'get_result',
+                 'get_status', 'wait_for_status', 'get_result_image', 'get_result_count', 'get_model_stats',
+                 'claim_jobs', 'report_progress', 'attach_progress', 'worker_heartbeat', 'finish_job', 'get_workers', 'get_weights', 'set_weight',
+                 'record_metrics', 'get_metrics', 'wait_for_changes', 'get_statuses', 'get_spool', 'get_spooled_image']
+
+
+#Return the object behind the persistent queue proxy. Calls made through the
+#proxy reuse one connection per client thread, whereas each of the individually
+#registered functions below opens and authenticates a new connection per call.
+def get_queue():
+    return sys.modules[__name__]
+
+
 #Get the BaseManager object that shares the state between the workers.
 def get_manager():
     manager = BaseManager((url, port), authkey=auth)
@@ -359,6 +1676,19 @@ def get_manager():
     manager.register('get_request', get_request)
     manager.register('get_next_id', get_next_id)
     manager.register('set_request', set_request)
+    manager.register('update_request', update_request)
+    manager.register('get_result', get_result)
+    manager.register('get_status', get_status)
+    manager.register('wait_for_status', wait_for_status)
+    manager.register('get_result_image', get_result_image)
+    manager.register('get_result_count', get_result_count)
+    manager.register('get_model_stats', get_model_stats)
+    manager.register('get_workers', get_workers)
+    manager.register('get_weights', get_weights)
+    manager.register('set_weight', set_weight)
+    manager.register('get_metrics', get_metrics)
+    manager.register('record_metrics', record_metrics)
+    manager.register('get_queue', get_queue, exposed=queue_methods)
     return manager
 
 
@@ -369,187 +1699,534 @@ class JobInfo:
     job_status = ""
 
 
-#This processes each of the requests in the order received.
-def process_queue():
-    global next_id
-    global requests
-    global processing_id
-    global loaded_model
-    global models
-    global previous_mix
+#Load the model a request asks for, unless it's already loaded.
+def prepare_model(model):
+    if isinstance(model, str):
+        if loaded_model["name"] != model:
+            if model == "" and loaded_model != models[0]:
+                load_model(models[0])
+            else:
+                for m in models:
+                    if m["name"] == model:
+                        load_model(m)
+                        break
+    else:
+        #A mixed model was selected. This takes a list of weights for the models
+        #The weights should add up to 1. Or {"mix": [weights], "linear": true}.
+        mix = model
+        try:
+            if model_key(mix) != loaded_model_name():
+                print(f'Mix: {mix}, Previous mix: {previous_mix}, Loaded model: {loaded_model}')
+                print("Loading new mixed model")
+                load_mixed_model(mix)
+        except:
+            msg = '{"error": "Invalid mix specified"}'
+            print(msg)
+
+
+#Run a webui call (given the JobInfo to use) in a worker thread, stopping it as
+#soon as is_cancelled() says so. Returns whatever the call returned.
+def call_cancellable(fn, is_cancelled):
+    ji = JobInfo()
+    ji.images = []
+    ji.should_stop = threading.Event()
+    ji.job_status = ""
+
+    result = {}
+    t = threading.Thread(target=lambda: result.update(value=fn(ji)))
+    t.start()
+    while t.is_alive():
+        if is_cancelled():
+            ji.should_stop.set()
+            t.join()
+        else:
+            t.join(1)
+    return result.get("value")
+
+
+#Which txt2img jobs can share a single sampler call: everything but the seed and
+#batch size must match (and the prompt, if webui takes a prompt per image), and each
+#job must be a single iteration. Returns None for jobs that can't be batched.
+def batch_key(request, prompt_lists=False):
+    params = request["params"]
+    if request["type"] != "txt2img" or request.get("include_logs") or not isinstance(params.get("prompt", ""), str):
+        return None
+    if params.get("n_iter", 1) not in (None, 1) or resolve_seed(params.get("seed")) is None:
+        return None
+    shared = {k: v for k, v in params.items() if k not in ("seed", "batch_size") and (k != "prompt" or not prompt_lists)}
+    return json.dumps([model_key(request["model"]), shared], sort_keys=True, default=str)
+
+
+#Whether a requested seed asks webui to pick one.
+def random_seed(seed):
+    return seed in (None, "", -1, "-1")
+
+
+#Turn a requested seed into the number webui will use, picking one for random seeds
+#so each job in a batch can be told its seed. None if it isn't a number.
+def resolve_seed(seed):
+    if random_seed(seed):
+        return random.randrange(2 ** 32)
+    try:
+        return int(seed)
+    except (TypeError, ValueError):
+        return None
+
+
+#Number of images (and pixels) a txt2img job adds to a batch.
+def batch_images(request):
+    return int(request["params"].get("batch_size") or 1)
+
+
+def batch_pixels(request):
+    params = request["params"]
+    return batch_images(request) * int(params.get("width") or 512) * int(params.get("height") or 512)
+
+
+#Take pending jobs that can run in one batch with the given request on a worker
+#with the given model loaded, within the batch size and pixel limits. Waits up to
+#batch_wait seconds for more to arrive. Must be called with the lock held.
+#
+#Stock webui seeds the images of a call consecutively from a single seed, so unless
+#the worker's webui takes a seed per image, a job with a fixed seed only fits where
+#its seed comes next. "first" is the seed of the batch's first image, once a job
+#with a fixed seed has set it.
+def take_batch(request, model, prompt_lists=False):
+    if max_batch_images <= 1:
+        return []
+    key = batch_key(request, prompt_lists)
+    if key is None:
+        return []
+
+    totals = {"images": 0, "pixels": 0, "first": None}
+    def fits(r):
+        if batch_key(r, prompt_lists) != key or totals["images"] + batch_images(r) > max_batch_images \
+           or totals["pixels"] + batch_pixels(r) > max_batch_pixels:
+            return False
+        seed = r["params"].get("seed")
+        if not prompt_lists and not random_seed(seed):
+            first = resolve_seed(seed) - totals["images"]
+            if first < 0 or totals["first"] not in (None, first):
+                return False
+            totals["first"] = first
+        totals["images"] += batch_images(r)
+        totals["pixels"] += batch_pixels(r)
+        return True
+
+    if not fits(request):
+        return []
+    batch = []
+    deadline = time.monotonic() + batch_wait
+    while True:
+        batch += scheduler.take_matching(lambda i: fits(requests[i]), model)
+        remaining = deadline - time.monotonic()
+        if totals["images"] >= max_batch_images or remaining <= 0:
+            return batch
+        job_added.wait(remaining)
+
+
+#Record the sampling speed of a webui call that took the given number of seconds,
+#from the last progress status it reported. Returns the number of steps done.
+def record_sampling_rate(request_type, status, seconds):
+    try:
+        steps = status["iter"] * status["total_steps"] + status["step"] + 1
+        if seconds > 0:
+            metrics.observe("sdapi_sampling_steps_per_second", steps / seconds, type=request_type)
+        return steps
+    except (KeyError, TypeError):
+        return None
+
+
+#Load the model a request asks for, returning how long it took if it was switched.
+def timed_prepare_model(model):
+    before = loaded_model_name()
+    start = time.perf_counter()
+    prepare_model(model)
+    if loaded_model_name() != before:
+        return time.perf_counter() - start
+    return None
+
+
+#Whether this process's webui takes a list of prompts and seeds (one per image) in a
+#txt2img call, so jobs with different prompts and seeds can share it. Stock webui
+#takes one prompt and seed per call, seeding the images consecutively.
+def supports_prompt_lists():
+    return getattr(sys.modules.get("webui"), "supports_prompt_batches", False)
+
+
+#The part of a finished request a worker sends back: only the fields it sets. The
+#queue still has the rest, like the params with their (possibly large) input images.
+def job_result(request):
+    return {k: request[k] for k in result_fields if k in request}
+
+
+#Run a single job on this worker and hand its result to the queue. stopped holds
+#the ids of the jobs the queue has asked this worker to stop.
+def run_job(queue, worker_id, request, stopped):
+    request_id = request["id"]
+    print(f'Processing {request["type"]} request {request_id}...')
+    request["success"] = True
+    images = None
+    timings = {"images": int(request["params"].get("batch_size") or 1)}
+
+    #Send what changed of the status to the queue, which also tells us if the job should stop.
+    progress = JobProgress()
+    def report(**fields):
+        try:
+            stopped.update(queue.report_progress(worker_id, [request_id], progress.update(**fields)))
+        except Exception:
+            progress.resend()
+            raise
+        request["status"] = progress.as_dict()
 
-    load_model(models[0])
-    print("Starting process queue")
-    processing_id = 1
 
+    def set_task(task):
+        report(cur_task=task)
 
-    #Helper function to add progress status to returned object
+
+    #Helper function to add progress status to returned object. Every step goes to
+    #the progress block, but the queue only hears of one every progress_interval.
+    last_report = [0]
     def add_status(i):
-        with lock:
+        try:
+            progress.set(cur_task="model_eval", step=i['i'], iter=i['iter'], total_steps=i['total_steps'], total_iters=i['total_iters'])
+            if progress_block is not None:
+                progress_block.write(request_id, i['i'], i['iter'], i['total_steps'], i['total_iters'])
+            now = time.monotonic()
+            if now - last_report[0] >= progress_interval:
+                last_report[0] = now
+                report()
+        except Exception as err:
+            print(f"Failed to add status to output: {err}")
+
+
+    #Call the relevant generation function.
+    def call_webui_impl(ji):
+        if request["type"] == "txt2img":
+            return webui.txt2img(**request["params"], job_info=ji, callback=add_status)
+        elif request["type"] == "img2img":
+            return webui.img2img(**request["params"], job_info=ji, callback=add_status)
+        elif request["type"] == "imgproc":
+            return webui.imgproc(**request["params"], callback=add_status)
+        else:
+            request["success"] = False
+            print("ERROR: Unknown request type!")
+
+
+    #Helper function to handle the worker thread and permit cancellation.
+    def call_webui():
+        try:
+            start = time.perf_counter()
+            request["retval"] = call_cancellable(call_webui_impl, lambda: request_id in stopped)
+            timings["sampling"] = time.perf_counter() - start
+            request["status"] = progress.as_dict()
+            timings["steps"] = record_sampling_rate(request["type"], request["status"], timings["sampling"])
+            if request_id in stopped:
+                print(f"Request {request_id} was cancelled.")
+                request["cancel"] = True
+                request["success"] = False
+        except Exception as err:
+            print(f"Error in call_webui: {err}")
+
+
+    try:
+        #Load the specified model. If none specified, use first option.
+        set_task("model_load")
+        timings["switch"] = timed_prepare_model(request["model"])
+        set_task("decoding")
+        decode_images(queue, request)
+
+
+        #Determine whether to include logs of the process.
+        include_logs = False
+        if "include_logs" in request:
             try:
-                status = {
-                    "jobs_ahead": 0,
-                    "cur_task": "model_eval",
-                    "step": i['i'], 
-                    "iter": i['iter'],
-                    "total_steps": i['total_steps'],
-                    "total_iters": i['total_iters']
-                }
-
-                request["status"] = status
-                requests[processing_id] = request
-            except Exception as err:
-                msg = '{"error": "Error: Failed to add status to output: {err}"}}'
-                print(f"Failed to add status to output: {err}")
+                include_logs = request["include_logs"] != False
+            except:
+                pass
+
+
+        #Call webui, forwarding the logs into the returned request if enabled.
+        set_task("model_eval")
+        if include_logs:
+            out = io.StringIO()
+            err = io.StringIO()
+            with redirect_stdout(out):
+                with redirect_stderr(err):
+                    call_webui()
+            request["log_out"] = out.getvalue()
+            request["log_err"] = err.getvalue()
+        else:
+            call_webui()
+
+        #Encode the images now so GET requests can serve them as they are.
+        set_task("encoding")
+        images = encode_results(request)
+
+    #Return an error message if something went wrong.
+    except Exception as err:
+        print(traceback.format_exc())
+        request["success"] = False
+        request["status"] = str(err)
+
+    #Return the request to client (when they do a GET request), with the timings
+    #the queue learns its estimates from.
+    print("Setting request as done.")
+    request["timings"] = timings
+    queue.finish_job(worker_id, job_result(request), spool_results(images))
+
+
+#Run compatible txt2img jobs as a single batched generation: one sampler call
+#whose images are then split back into the jobs. Where webui takes one seed per
+#call, the jobs get consecutive seeds from the one take_batch lined them up on.
+def run_batch(queue, worker_id, batch, stopped):
+    ids = [request["id"] for request in batch]
+    print(f'Processing txt2img requests {ids} as one batch...')
+    prompt_lists = supports_prompt_lists()
+    first = None
+    offset = 0
+    for request in batch:
+        seed = request["params"].get("seed")
+        if first is None and not random_seed(seed):
+            first = resolve_seed(seed) - offset
+        offset += batch_images(request)
+    if first is None:
+        first = resolve_seed(None)
+
+    offset = 0
+    for request in batch:
+        request["success"] = True
+        seed = request["params"].get("seed")
+        request["params"]["seed"] = resolve_seed(seed) if prompt_lists else first + offset
+        offset += batch_images(request)
+
+    #Send what changed of the status to the queue, in one call for every job in the batch.
+    progress = JobProgress()
+    def report(**fields):
+        try:
+            stopped.update(queue.report_progress(worker_id, ids, progress.update(**fields)))
+        except Exception:
+            progress.resend()
+            raise
+        for request in batch:
+            request["status"] = progress.as_dict()
 
-    while True:
+
+    #Every job in the batch shows the progress of the shared sampler call.
+    last_report = [0]
+    def add_status(i):
         try:
-            if processing_id == next_id:
-                #Only check ten times per second to avoid wasting CPU cycles.
-                time.sleep(0.1)
+            progress.set(cur_task="model_eval", step=i['i'], iter=i['iter'], total_steps=i['total_steps'], total_iters=i['total_iters'])
+            if progress_block is not None:
+                progress_block.write(ids[0], i['i'], i['iter'], i['total_steps'], i['total_iters'])
+            now = time.monotonic()
+            if now - last_report[0] >= progress_interval:
+                last_report[0] = now
+                report()
+        except Exception as err:
+            print(f"Failed to add status to output: {err}")
+
+    images = {}
+    timings = {}
+    try:
+        report(cur_task="model_load")
+        timings["switch"] = timed_prepare_model(batch[0]["model"])
+
+        prompts = []
+        seeds = []
+        for request in batch:
+            prompts += [request["params"].get("prompt", "")] * batch_images(request)
+            seeds += [request["params"]["seed"] + j for j in range(batch_images(request))]
+        params = dict(batch[0]["params"])
+        if prompt_lists:
+            params.update(prompt=prompts, seed=seeds)
+        else:
+            params.update(seed=first)
+        params.update(batch_size=len(prompts), n_iter=1)
+
+        #Stop the sampler only if every job in the batch was cancelled.
+        report(cur_task="model_eval")
+        start = time.perf_counter()
+        retval = call_cancellable(lambda ji: webui.txt2img(**params, job_info=ji, callback=add_status),
+                                  lambda: all(i in stopped for i in ids))
+        timings["sampling"] = time.perf_counter() - start
+        for request in batch:
+            request["status"] = progress.as_dict()
+        timings["steps"] = record_sampling_rate("txt2img", batch[0]["status"], timings["sampling"])
+        timings["images"] = len(prompts)
+
+        generated, rest = split_retval(retval)
+        offset = 0
+        for request in batch:
+            count = batch_images(request)
+            if request["id"] in stopped:
+                request["cancel"] = True
+                request["success"] = False
             else:
-                #TODO P1 (plugin): better progress display
-                #TODO P2 (plugin): expose relevant advanced settings
-                #TODO P2 (plugin): img2img UI
-                #TODO P2 (plugin): imgproc UI
-                #TODO P3 (plugin): selection-based img2img 
-                #TODO P3 Merge latest from upstream
-                #TODO P4 (plugin): task-based grouping
-                #TODO P4 (plugin): proper mask layers? Alpha-based? needs experimentation
-                #TODO P5 (plugin): outpainting -- defered
-                #TODO P5 (plugin): inpainting -- deferred
-                #TODO P5 (plugin): blend layers -- deferred
-                #TODO P5 (plugin): "AI brush" -- deferred
-
-                #TODO: Code review
-                #TODO: Documentation
-
-                #TODO: Workflow 1: Request a generated image and insert it into image (almost done except for plugin, needs checkboxes, progress, etc.)
-                #TODO: Workflow 2: Make a selection (or layer, or visible) for img2img. Maybe also mask? Force mask layer or let it be specified separately?
-                #TODO: Workflow 3: Upload selection (or layer, or visible) for image processing (GFPGAN, GoBIG, RealESRGAN, etc)
-
-
-                try:
-                    #Previously I did this with a lock instead, but it still seems to get altered somehow.
-                    #I think it happens after the lock exits but before the function returns the object.
-                    #Whatever, now I just make a copy of the request instead so it can't get corrupted.
-                    request = copy.deepcopy(requests[processing_id])
-                    print(f'Processing {request["type"]} request {processing_id}...')
-                    request["success"] = True
-
-
-                    #Call the relevant generation function.
-                    def call_webui_impl(request, ji):
-                        if request["type"] == "txt2img":
-                            request["retval"] = webui.txt2img(**request["params"], job_info=ji, callback=add_status)
-                        elif request["type"] == "img2img":
-                            request["retval"] = webui.img2img(**request["params"], job_info=ji, callback=add_status)
-                        elif request["type"] == "imgproc":
-                            request["retval"] = webui.imgproc(**request["params"], callback=add_status)
-                        else:
-                            request["success"] = False
-                            print("ERROR: Unknown request type!")
-                    
-
-                    #Helper function to handle the worker thread and permit cancellation.
-                    def call_webui():
-                        try:
-                            ji = JobInfo()
-                            ji.images = []
-                            ji.should_stop = threading.Event()
-                            ji.job_status = ""
-
-                            t = threading.Thread(target=call_webui_impl, args=(request,ji))
-                            t.start()
-
-                            while t.is_alive():
-                                if("cancel" in request):
-                                    ji.should_stop.set()
-                                    t.join()
-                                    msg = f"Request {processing_id} was cancelled."
-                                    print(msg)
-                                    request["cancel"] = True
-                                    request["success"] = False
-                                else:
-                                    t.join(1)
-                        except Exception as err:
-                            print(f"Error in call_webui: {err}")
-                        return request
-
-
-                    
-                    #Load the specified model. If none specified, use first option.
-                    request["status"]["cur_task"] = "model_load"
-                    set_request(request)
-                    if isinstance(request["model"], str):
-                        if loaded_model["name"] != request["model"]:
-                            if request["model"] == "" and loaded_model != models[0]:
-                                load_model(models[0])
-                            else:
-                                for m in models:
-                                    if m["name"] == request["model"]:
-                                        load_model(m)
-                                        break
-                    else:
-                        #A mixed model was selected. This takes a list of weights for the models
-                        #The weights should add up to 1.
-                        mix = request["model"]
-                        try:
-                            if mix != previous_mix or loaded_model is not None and loaded_model["name"] != "mixed_model":
-                                print(f'Mix: {mix}, Previous mix: {previous_mix}, Loaded model: {loaded_model}')
-                                print("Loading new mixed model")
-                                load_mixed_model(mix)
-                        except:
-                            msg = f'{{"error": "Invalid mix specified"}}'
-                            print(msg)
-                            
-
-
-                    #Determine whether to include logs of the process.
-                    include_logs = False
-                    if "include_logs" in request:
-                        try:
-                            include_logs = request["include_logs"] != False
-                        except:
-                            pass
-
-
-                    #Call webui, forwarding the logs into the returned request if enabled.
-                    request["status"]["cur_task"] = "model_eval"
-                    set_request(request)
-                    if include_logs:
-                        out = io.StringIO()
-                        err = io.StringIO()
-                        with redirect_stdout(out):
-                            with redirect_stderr(err):
-                                call_webui()
-                        request["log_out"] = out.getvalue()
-                        request["log_err"] = err.getvalue()
-                    else:
-                        call_webui()
+                request["retval"] = (generated[offset:offset + count], request["params"]["seed"]) + rest[1:]
+                request["status"] = dict(request["status"], cur_task="encoding")
+                images[request["id"]] = encode_results(request)
+            offset += count
+
+    #Return an error message if something went wrong.
+    except Exception as err:
+        print(traceback.format_exc())
+        for request in batch:
+            request["success"] = False
+            request["status"] = str(err)
+
+    print("Setting batch as done.")
+    for request in batch:
+        request["timings"] = timings
+        queue.finish_job(worker_id, job_result(request), spool_results(images.get(request["id"])))
+
+
+#Connect to the job queue, for a worker running in another process.
+def connect_queue():
+    manager = get_manager()
+    manager.connect()
+    return manager.get_queue()
+
+
+#Attach a worker to the queue's image spool, if it runs on the queue's host. A
+#worker inside the queue's process hands over its images as they are.
+def attach_spool(queue):
+    if queue is sys.modules[__name__]:
+        return None
+    spool = queue.get_spool()
+    return None if spool is None else ImageSpool.attach(*spool)
+
+
+#Give the queue a progress block to read this worker's sampling progress from: in
+#memory for a worker in the queue's process, or else a file in the image spool.
+#Returns None if the queue can't map one, and only gets the reported progress.
+def open_progress_block(queue, worker_id):
+    try:
+        if queue is sys.modules[__name__]:
+            block = ProgressBlock()
+            attach_progress(worker_id, block)
+            return block
+        if worker_spool is not None:
+            block = ProgressBlock(os.path.join(worker_spool.directory, f"progress-{os.getpid()}"), create=True)
+            if queue.attach_progress(worker_id, block.path):
+                return block
+            block.close()
+            os.remove(block.path)
+    except OSError as err:
+        print(f"Unable to share a progress block with the queue: {err}")
+    return None
+
+
+#Claim and process jobs until the process exits. Each worker loads its own copy of
+#webui. connect returns the queue to work for: by default this module, when the
+#worker runs inside the job queue's process, or else a proxy from connect_queue.
+#The worker heartbeats from a separate thread, so its lease on a job outlives long
+#model loads, and learns from the heartbeat when a job is cancelled.
+def process_queue(connect=None, worker_id=None):
+    global loaded_model
+    global models
+    global previous_mix
+    global worker_spool
+    global progress_block
+
+    if connect is None:
+        connect = lambda: sys.modules[__name__]
+    if worker_id is None:
+        worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+    load_model(models[0])
+    queue = None #Connected in the loop below, which retries until the job queue is up.
+    print(f"Starting worker {worker_id}")
 
-                #Return an error message if something went wrong.
-                except Exception as err:
-                    print(traceback.format_exc())
-                    request["success"] = False
-                    request["status"] = str(err)
+    held = set() #Ids of the jobs this worker is running.
+    stopped = set() #Ids of the jobs the queue asked this worker to stop.
+
+
+    def heartbeat():
+        while True:
+            time.sleep(heartbeat_interval)
+            if queue is None:
+                continue
+            try:
+                stopped.update(queue.worker_heartbeat(worker_id, loaded_model_name(), list(held), metrics.take_pending()))
+            except Exception as err:
+                print(f"Worker {worker_id} failed to send a heartbeat: {err}")
 
-                #Return the request to client (when they do a GET request)
-                print("Setting request as done.")
-                request["done"] = True
-                set_request(request)
+    threading.Thread(target=heartbeat, daemon=True).start()
 
-                #Move on to the next request
-                processing_id = min(next_id, processing_id + 1)
+    while True:
+        #Connect to the job queue, or reconnect after losing it. A worker started
+        #before the job queue is listening keeps trying until it is.
+        if queue is None:
+            try:
+                queue = connect()
+                worker_spool = attach_spool(queue)
+                progress_block = open_progress_block(queue, worker_id)
+            except Exception as err:
+                queue = None
+                print(f"Worker {worker_id} is unable to connect to the job queue ({err}). Retrying.")
+                time.sleep(1)
+                continue
 
+        try:
+            #Block until the queue has a job for us. The queue waits on a condition,
+            #so an idle worker costs no CPU and starts new jobs immediately.
+            jobs = queue.claim_jobs(worker_id, loaded_model_name(), supports_prompt_lists(), heartbeat_interval)
+            if len(jobs) == 0:
+                continue
+
+            #TODO P1 (plugin): better progress display
+            #TODO P2 (plugin): expose relevant advanced settings
+            #TODO P2 (plugin): img2img UI
+            #TODO P2 (plugin): imgproc UI
+            #TODO P3 (plugin): selection-based img2img 
+            #TODO P3 Merge latest from upstream
+            #TODO P4 (plugin): task-based grouping
+            #TODO P4 (plugin): proper mask layers? Alpha-based? needs experimentation
+            #TODO P5 (plugin): outpainting -- defered
+            #TODO P5 (plugin): inpainting -- deferred
+            #TODO P5 (plugin): blend layers -- deferred
+            #TODO P5 (plugin): "AI brush" -- deferred
+
+            #TODO: Code review
+            #TODO: Documentation
+
+            #TODO: Workflow 1: Request a generated image and insert it into image (almost done except for plugin, needs checkboxes, progress, etc.)
+            #TODO: Workflow 2: Make a selection (or layer, or visible) for img2img. Maybe also mask? Force mask layer or let it be specified separately?
+            #TODO: Workflow 3: Upload selection (or layer, or visible) for image processing (GFPGAN, GoBIG, RealESRGAN, etc)
+
+
+            held.update(request["id"] for request in jobs)
+            try:
+                #Compatible txt2img jobs share one sampler call.
+                if len(jobs) > 1:
+                    run_batch(queue, worker_id, jobs, stopped)
+                else:
+                    run_job(queue, worker_id, jobs[0], stopped)
+            finally:
+                for request in jobs:
+                    held.discard(request["id"])
+                    stopped.discard(request["id"])
+
+        #If the job queue went away, keep trying to reconnect. Any job we held will
+        #have been requeued once our lease ran out.
+        except (EOFError, OSError) as err:
+            print(f"Worker {worker_id} lost its connection to the job queue ({err}). Reconnecting.")
+            queue = None
+            time.sleep(1)
 
         except Exception as err:
-            #If there is an uncaught failure, do a soft restart.
-            msg = f'{{"error": "Fatal error while processing requests:{err}.\nCancelling all pending requests."}}'
+            msg = f'{{"error": "Fatal error while processing requests:{err}."}}'
             print(msg)
-            requests = {}
-            processing_id = 1
-            next_id = 1
+            print(traceback.format_exc())
+
+
+#Remove the image spool when the job queue is terminated, then terminate as usual.
+def stop_on_sigterm(signum, frame):
+    if image_spool is not None:
+        image_spool.remove()
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
 
 
 #Start the server for the job queue.
@@ -560,7 +2237,8 @@ def start_server():
         server.serve_forever()
 
 
-#Start server and start processing queue.
+#Start server and start processing queue. With --worker, only run a worker for
+#a job queue that is already running (at JOBQUEUE_URL and JOBQUEUE_PORT).
 if __name__ == '__main__':
     sys.path.insert(0, './scripts') 
 
@@ -571,5 +2249,19 @@ if __name__ == '__main__':
         print("Couldn't load models. Using defaults.")
         models = default_models
 
-    threading.Thread(target=start_server).start()
-    process_queue()
+    if "--worker" in sys.argv[1:]:
+        #This worker's metrics are sent to the job queue with its heartbeats.
+        metrics.forward = True
+        process_queue(connect_queue)
+    else:
+        if image_spool_dir:
+            ImageSpool.sweep(os.path.dirname(os.path.abspath(image_spool_dir)), "sdapi-")
+            image_spool = ImageSpool.create(image_spool_dir)
+            print(f"Using image spool: {image_spool_dir}")
+            #The spool is in memory by default, so don't leave it behind.
+            atexit.register(image_spool.remove)
+            signal.signal(signal.SIGTERM, stop_on_sigterm)
+        threading.Thread(target=start_server).start()
+        threading.Thread(target=reap_workers, daemon=True).start()
+        if local_worker:
+            process_queue()
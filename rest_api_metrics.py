@@ -0,0 +1,168 @@
+import math
+import threading
+
+#Histogram buckets, in seconds unless noted.
+fast_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+slow_buckets = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+rate_buckets = (0.5, 1, 2, 5, 10, 20, 50, 100, 200) #Steps per second.
+lock_buckets = (0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05)
+
+
+#Counters, gauges and histograms kept in memory and rendered in the Prometheus
+#text format.
+#
+#The job queue process holds the registry that /metrics shows. Other processes
+#(API server processes and remote workers) set forward, so their counter and
+#histogram updates are also kept as pending samples, which they hand to the job
+#queue with take_pending. The job queue adds them to its registry with apply.
+class Metrics:
+    def __init__(self):
+        self.specs = {} #Name -> (type, help, buckets).
+        self.values = {} #Name -> {labels: value, or [bucket counts, sum, count] for histograms}.
+        self.forward = False
+        self.pending = []
+        self.lock = threading.Lock()
+
+
+    def counter(self, name, help):
+        self._declare(name, "counter", help, None)
+
+
+    def gauge(self, name, help):
+        self._declare(name, "gauge", help, None)
+
+
+    def histogram(self, name, help, buckets=fast_buckets):
+        self._declare(name, "histogram", help, tuple(buckets))
+
+
+    def _declare(self, name, kind, help, buckets):
+        self.specs[name] = (kind, help, buckets)
+        self.values[name] = {}
+
+
+    #Add to a counter.
+    def inc(self, name, value=1, **labels):
+        self._record(name, value, labels)
+
+
+    #Record one observation in a histogram.
+    def observe(self, name, value, **labels):
+        self._record(name, value, labels)
+
+
+    #Set a gauge. Gauges describe the state of one process, so they aren't forwarded.
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[name][tuple(sorted(labels.items()))] = value
+
+
+    def _record(self, name, value, labels):
+        labels = tuple(sorted(labels.items()))
+        with self.lock:
+            self._apply(name, labels, value)
+            if self.forward:
+                self.pending.append((name, labels, value))
+
+
+    def _apply(self, name, labels, value):
+        kind, _, buckets = self.specs[name]
+        values = self.values[name]
+        if kind == "histogram":
+            entry = values.get(labels)
+            if entry is None:
+                entry = values[labels] = [[0] * len(buckets), 0.0, 0]
+            for n, bound in enumerate(buckets):
+                if value <= bound:
+                    entry[0][n] += 1
+            entry[1] += value
+            entry[2] += 1
+        else:
+            values[labels] = values.get(labels, 0) + value
+
+
+    #Take the samples recorded since the last call, to send them to the job queue.
+    def take_pending(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+            return pending
+
+
+    #Add samples forwarded by another process. Unknown metrics are skipped, in
+    #case that process runs a different version.
+    def apply(self, samples):
+        with self.lock:
+            for name, labels, value in samples:
+                if name in self.specs:
+                    self._apply(name, tuple(tuple(l) for l in labels), value)
+
+
+    #Render every metric in the Prometheus text exposition format.
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (kind, help, buckets) in self.specs.items():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in sorted(self.values[name].items()):
+                    if kind == "histogram":
+                        counts, total, count = value
+                        for bound, bucket_count in zip(buckets, counts):
+                            lines.append(f"{name}_bucket{format_labels(labels + (('le', format_value(bound)),))} {bucket_count}")
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+                        lines.append(f"{name}_sum{format_labels(labels)} {format_value(total)}")
+                        lines.append(f"{name}_count{format_labels(labels)} {count}")
+                    else:
+                        lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+def format_value(value):
+    if isinstance(value, float) and math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+#The metrics of every process. Declared here so they all agree on the names.
+metrics = Metrics()
+
+#Job queue.
+metrics.gauge("sdapi_queue_depth", "Jobs waiting for a worker, by priority class.")
+metrics.gauge("sdapi_running_jobs", "Jobs being run by a worker.")
+metrics.gauge("sdapi_workers", "Workers holding a lease.")
+metrics.gauge("sdapi_queued_cost", "Estimated cost of the waiting and running jobs.")
+metrics.gauge("sdapi_jobs", "Jobs held by the job store, finished or not.")
+metrics.gauge("sdapi_job_store_bytes", "Estimated size of the images held by the job store.")
+metrics.gauge("sdapi_result_store_bytes", "Size of the encoded results, by where they are held.")
+metrics.counter("sdapi_jobs_submitted_total", "Jobs accepted into the queue, by type.")
+metrics.counter("sdapi_jobs_rejected_total", "Jobs refused, by reason.")
+metrics.counter("sdapi_jobs_finished_total", "Jobs finished, by type and outcome.")
+metrics.counter("sdapi_jobs_requeued_total", "Jobs requeued after their worker's lease expired.")
+metrics.counter("sdapi_jobs_deduplicated_total", "Jobs that copied the result of an identical one, by whether it had finished (cached) or was still running (joined).")
+metrics.gauge("sdapi_result_cache_entries", "Finished results remembered for identical requests.")
+metrics.histogram("sdapi_queue_wait_seconds", "Time from submission until a worker claimed the job, by type.", slow_buckets)
+metrics.histogram("sdapi_run_seconds", "Time from claim until the worker returned the result, by type.", slow_buckets)
+metrics.counter("sdapi_status_reads_total", "Status polls, by whether they were answered from a snapshot or under the job queue's lock.")
+metrics.counter("sdapi_queue_lock_acquires_total", "Acquires of the job queue's lock by status polls and progress reports, by call and whether it was held.")
+metrics.histogram("sdapi_queue_lock_wait_seconds", "Time status polls and progress reports waited for the job queue's lock, by call.", lock_buckets)
+
+#Workers.
+metrics.histogram("sdapi_model_load_seconds", "Time to load a model, by method (swap or reload).", slow_buckets)
+metrics.histogram("sdapi_model_mix_seconds", "Time to mix a model, by method.", slow_buckets)
+metrics.histogram("sdapi_sampling_steps_per_second", "Sampling steps per second of each job (or batch), by type.", rate_buckets)
+metrics.histogram("sdapi_encode_seconds", "Time to encode the images of a job, by stage (png or base64).")
+
+#API server.
+metrics.histogram("sdapi_rpc_seconds", "Latency of calls from the API server to the job queue, by method.")
+metrics.histogram("sdapi_http_request_seconds", "Time to handle an HTTP request, by endpoint and method.")
+metrics.counter("sdapi_http_responses_total", "HTTP responses, by endpoint and status code.")
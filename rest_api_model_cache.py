@@ -0,0 +1,184 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+
+
+#Size in bytes of the tensors in a state dict.
+def state_dict_bytes(state_dict):
+    return sum(t.numel() * t.element_size() for t in state_dict.values() if hasattr(t, "element_size"))
+
+
+#Identify a checkpoint file by its path, size and modification time, so a file that
+#is rewritten in place (like the mixed model) is never served from a stale entry.
+def checkpoint_key(path):
+    st = os.stat(path)
+    return (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+
+
+#Keeps the weights of recently used checkpoints resident in host RAM, up to
+#max_bytes, evicting the least recently used. Switching to a cached checkpoint
+#then only has to copy its weights into the running model.
+class ModelCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.load_time = 0.0
+        self.swaps = 0
+        self.swap_time = 0.0
+
+
+    #Get a cached state dict, or None.
+    def get(self, key):
+        with self.lock:
+            state_dict = self.entries.get(key)
+            if state_dict is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return state_dict
+
+
+    #Whether a checkpoint is cached, without counting a hit or miss.
+    def contains(self, key):
+        with self.lock:
+            return key in self.entries
+
+
+    #Cache a state dict, evicting the least recently used ones to make room.
+    #Returns False if it could never fit in the budget.
+    def put(self, key, state_dict):
+        size = state_dict_bytes(state_dict)
+        with self.lock:
+            if size > self.max_bytes:
+                return False
+
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= state_dict_bytes(old)
+
+            while self.entries and self.size + size > self.max_bytes:
+                evicted_key, evicted = self.entries.popitem(last=False)
+                self.size -= state_dict_bytes(evicted)
+                print(f"Evicted {evicted_key[0]} from the model cache.")
+
+            self.entries[key] = state_dict
+            self.size += size
+            return True
+
+
+    def record_load(self, seconds):
+        with self.lock:
+            self.loads += 1
+            self.load_time += seconds
+
+
+    def record_swap(self, seconds):
+        with self.lock:
+            self.swaps += 1
+            self.swap_time += seconds
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": [k[0] for k in self.entries],
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "loads": self.loads,
+                "load_seconds": self.load_time,
+                "swaps": self.swaps,
+                "swap_seconds": self.swap_time,
+            }
+
+
+#The names of the files MixCache creates: a mix, keyed by a 32 digit hex digest, and
+#the partial output of a mix being generated. Nothing else in its directory is touched.
+mix_name = re.compile(r"[0-9a-f]{32}\.ckpt")
+partial_mix_name = re.compile(r"[0-9a-f]{32}\.ckpt\.tmp")
+
+
+#Mixed checkpoints on disk, content-addressed by the key the job queue builds from
+#the normalised mix and the identities of the source checkpoints. The directory is
+#limited to max_bytes, evicting the least recently used mixes first. Files are never
+#touched on a hit, so a cached mix keeps the same checkpoint_key in the ModelCache.
+class MixCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict() #file name -> size, least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        #Pick up the mixes left by a previous run, oldest first.
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for name in os.listdir(self.directory):
+            if mix_name.fullmatch(name):
+                st = os.lstat(os.path.join(self.directory, name))
+                found.append((st.st_mtime, name, st.st_size))
+            elif partial_mix_name.fullmatch(name):
+                #Partial output of an interrupted mix.
+                os.remove(os.path.join(self.directory, name))
+        for _, name, size in sorted(found):
+            self.entries[name] = size
+            self.size += size
+
+
+    #The path a mix with this key is stored at.
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.ckpt")
+
+
+    #Get the path of a cached mix, or None.
+    def get(self, key):
+        name = f"{key}.ckpt"
+        with self.lock:
+            if name in self.entries and os.path.lexists(self.path(key)):
+                self.entries.move_to_end(name)
+                self.hits += 1
+                return self.path(key)
+            self.size -= self.entries.pop(name, 0)
+            self.misses += 1
+            return None
+
+
+    #Move a freshly generated checkpoint into the cache and return its path.
+    #Older mixes are evicted to stay within budget; the new one is always kept.
+    def add(self, key, generated_path):
+        name = f"{key}.ckpt"
+        path = self.path(key)
+        os.replace(generated_path, path)
+        size = os.lstat(path).st_size
+        with self.lock:
+            self.size -= self.entries.pop(name, 0)
+            self.entries[name] = size
+            self.size += size
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                evicted, evicted_size = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                if not mix_name.fullmatch(evicted):
+                    continue
+                try:
+                    os.remove(os.path.join(self.directory, evicted))
+                    print(f"Evicted {evicted} from the mixed model cache.")
+                except OSError as err:
+                    print(f"Unable to evict {evicted} from the mixed model cache: {err}")
+        return path
+
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.size, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses}
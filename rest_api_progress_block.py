@@ -0,0 +1,61 @@
+import mmap
+
+#Layout of a block, in 64-bit integers: a sequence number, the id of the job, the
+#sampler's counters, and padding to a 64 byte cache line.
+fields = ("seq", "job_id", "step", "iter", "total_steps", "total_iters")
+block_size = 64
+
+
+#A small block of shared memory holding a worker's latest sampling progress, so that
+#the job queue can read it without the worker reporting every step. It has a single
+#writer, the worker, and is written without locks: the sequence number is odd while
+#a write is in progress, and a reader retries until it reads the same even number
+#before and after the counters.
+#
+#A worker in the job queue's process uses anonymous memory; one on the same host a
+#file in the image spool, which the queue maps and then removes.
+class ProgressBlock:
+    def __init__(self, path=None, create=False):
+        self.path = path
+        if path is None:
+            self.mmap = mmap.mmap(-1, block_size)
+        else:
+            with open(path, "w+b" if create else "r+b") as f:
+                if create:
+                    f.write(bytes(block_size))
+                    f.flush()
+                self.mmap = mmap.mmap(f.fileno(), block_size)
+        self.values = memoryview(self.mmap).cast("q")
+
+
+    #Write the progress of a job (the first job, for a batch).
+    def write(self, job_id, step, iteration, total_steps, total_iters):
+        values = self.values
+        seq = values[0] + 1
+        values[0] = seq
+        values[1] = job_id
+        values[2] = step
+        values[3] = iteration
+        values[4] = total_steps
+        values[5] = total_iters
+        values[0] = seq + 1
+
+
+    #Read the latest progress as a (job_id, step, iter, total_steps, total_iters)
+    #tuple, or None if nothing was written yet, or a write never completed (the
+    #worker died halfway through one).
+    def read(self, attempts=1000):
+        values = self.values
+        for _ in range(attempts):
+            seq = values[0]
+            if seq & 1:
+                continue
+            progress = tuple(values[1:len(fields)])
+            if values[0] == seq:
+                return progress if seq > 0 else None
+        return None
+
+
+    def close(self):
+        self.values.release()
+        self.mmap.close()
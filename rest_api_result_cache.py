@@ -0,0 +1,140 @@
+import json
+import hashlib
+from collections import OrderedDict
+
+from rest_api_image_spool import SpooledImages
+
+
+#Tracks which requests produce the same result, so identical requests only run once.
+#
+#A request is identified by a digest of everything that determines its images. The
+#first request with a digest computes it, and identical requests that arrive while
+#it runs follow it: they get a copy of its result when it finishes. The digests of
+#the last max_entries requests that succeeded are remembered, so a later identical
+#request can copy the finished result right away.
+#
+#This isn't thread-safe on its own; the job queue calls it with its lock held.
+class ResultCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.results = OrderedDict() #Digest -> id of a request that finished with it, least recently used first.
+        self.computing = {} #Digest -> id of the unfinished request computing it.
+        self.digests = {} #Id of a request in results or computing -> its digest.
+        self.followers = {} #Id of a computing request -> ids of the identical requests waiting for it.
+        self.leaders = {} #Id of a following request -> id of the request it waits for.
+
+
+    #The id of a finished request with the given digest, or None.
+    def finished(self, digest):
+        request_id = self.results.get(digest)
+        if request_id is not None:
+            self.results.move_to_end(digest)
+        return request_id
+
+
+    #Record that a request computes the given digest.
+    def add(self, digest, request_id):
+        self.computing[digest] = request_id
+        self.digests[request_id] = digest
+        self.followers[request_id] = []
+
+
+    #Make a request wait for the result of an identical one that is computing it.
+    def follow(self, request_id, leader_id):
+        self.followers[leader_id].append(request_id)
+        self.leaders[request_id] = leader_id
+
+
+    #The id of the request that a request waits for, or None.
+    def leader(self, request_id):
+        return self.leaders.get(request_id)
+
+
+    #Record that a request finished. A request that computed its digest is remembered
+    #if it succeeded, and the ids of the requests that waited for it are returned, to
+    #be given a copy of its result. A request that was waiting just stops waiting.
+    def finish(self, request_id, success):
+        leader_id = self.leaders.pop(request_id, None)
+        if leader_id is not None:
+            self.followers[leader_id].remove(request_id)
+            return []
+
+        digest = self.digests.get(request_id)
+        if digest is None or self.computing.get(digest) != request_id:
+            return []
+        del self.computing[digest]
+        followers = self.followers.pop(request_id)
+        for i in followers:
+            del self.leaders[i]
+
+        if not success or self.max_entries <= 0:
+            del self.digests[request_id]
+            return followers
+        previous = self.results.pop(digest, None)
+        if previous is not None:
+            del self.digests[previous]
+        self.results[digest] = request_id
+        while len(self.results) > self.max_entries:
+            _, oldest = self.results.popitem(last=False)
+            del self.digests[oldest]
+        return followers
+
+
+    #Hand the digest of a cancelled request over to the first request waiting for it,
+    #which has to compute it instead. Returns that request's id, or None.
+    def hand_over(self, request_id):
+        followers = self.followers.get(request_id)
+        if not followers:
+            return None
+        digest = self.digests[request_id]
+        del self.followers[request_id]
+        del self.digests[request_id]
+        leader_id = followers[0]
+        del self.leaders[leader_id]
+        self.add(digest, leader_id)
+        for i in followers[1:]:
+            self.follow(i, leader_id)
+        return leader_id
+
+
+    #Forget the finished result of a request, e.g. because its images were dropped.
+    def discard(self, request_id):
+        digest = self.digests.get(request_id)
+        if digest is not None and self.results.get(digest) == request_id:
+            del self.results[digest]
+            del self.digests[request_id]
+
+
+#Hash a request's type, model and params in a canonical form: dict keys are sorted,
+#and images (bytes, or PIL images by their pixels) are hashed by their content.
+#Spooled uploads are hashed by the digest of their bytes, taken when they were spooled.
+def request_digest(obj):
+    h = hashlib.sha256()
+    feed(h, obj)
+    return h.hexdigest()
+
+
+def feed(h, obj):
+    if isinstance(obj, dict):
+        h.update(b"{")
+        for k in sorted(obj, key=str):
+            feed(h, str(k))
+            feed(h, obj[k])
+        h.update(b"}")
+    elif isinstance(obj, (list, tuple)):
+        h.update(b"[")
+        for v in obj:
+            feed(h, v)
+        h.update(b"]")
+    elif isinstance(obj, SpooledImages):
+        h.update(f"s{obj.digest or obj.path}:".encode())
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        h.update(b"b%d:" % len(obj))
+        h.update(obj)
+    elif hasattr(obj, "tobytes") and hasattr(obj, "mode") and hasattr(obj, "size"):
+        data = obj.tobytes()
+        h.update(f"i{obj.mode}{tuple(obj.size)}{len(data)}:".encode())
+        h.update(data)
+    else:
+        s = json.dumps(obj, default=str)
+        h.update(f"v{len(s)}:{s}".encode())
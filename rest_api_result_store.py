@@ -0,0 +1,156 @@
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+from rest_api_image_spool import SpooledImages, write_images, read_images, move_images, remove_images
+
+
+#Holds the encoded (PNG) images of finished jobs, keyed by request id.
+#Images are encoded once when the job finishes, so every later GET can
+#serve the stored bytes as they are. When the total size exceeds max_bytes,
+#the least recently fetched results are spilled to files in spill_dir (if
+#given), which is itself limited to max_spill_bytes. Spilled results are
+#memory-mapped on read, so fetching one image only pages in that image.
+#The images are PNGs, which are already compressed, so the files hold them as they are.
+#
+#Workers on the job queue's host hand over their images as a file in the image
+#spool (SpooledImages) instead. Those count against max_bytes like images in memory,
+#are spilled by moving the file, and callers that can read the files themselves may
+#ask for the handle of a result rather than its images.
+class ResultStore:
+    def __init__(self, max_bytes, spill_dir=None, max_spill_bytes=0):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.results = OrderedDict()
+
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+        self.spill_size = 0
+        self.spilled = OrderedDict() #request id -> SpooledImages of the spill file
+        self.spill_ready = False
+        self.lock = threading.Lock()
+
+
+    #Store the encoded images (or SpooledImages, whose file the store then owns) for
+    #a request, evicting older results if needed.
+    def put(self, request_id, images):
+        with self.lock:
+            self._discard(request_id)
+            self.results[request_id] = images
+            self.size += stored_size(images)
+            self._evict()
+
+
+    #Get the encoded images for a request, or None if there are none (or they were evicted).
+    #With spooled, images held in a file are returned as its SpooledImages. The file
+    #still belongs to the store, and may be removed or moved at any time.
+    def get(self, request_id, spooled=False):
+        with self.lock:
+            images = self._find(request_id)
+            if isinstance(images, SpooledImages) and not spooled:
+                return read_images(images)
+            return images
+
+
+    #Get one encoded image of a request, or None. With spooled, an image held in a
+    #file is returned as the SpooledImages of the file, to read it from.
+    def get_image(self, request_id, index, spooled=False):
+        with self.lock:
+            images = self._find(request_id)
+            if images is None or not 0 <= index < len(images):
+                return None
+            if isinstance(images, SpooledImages):
+                return images if spooled else read_images(images, index)
+            return images[index]
+
+
+    #Get the number of images stored for a request, or None.
+    def count(self, request_id):
+        with self.lock:
+            images = self._find(request_id)
+            return None if images is None else len(images)
+
+
+    def _find(self, request_id):
+        if request_id in self.results:
+            self.results.move_to_end(request_id)
+            return self.results[request_id]
+        if request_id in self.spilled:
+            self.spilled.move_to_end(request_id)
+            return self.spilled[request_id]
+        return None
+
+
+    #Drop the stored images for a request, if any.
+    def discard(self, request_id):
+        with self.lock:
+            self._discard(request_id)
+
+
+    def _discard(self, request_id):
+        images = self.results.pop(request_id, None)
+        if images is not None:
+            self.size -= stored_size(images)
+            if isinstance(images, SpooledImages):
+                remove_images(images)
+
+        spilled = self.spilled.pop(request_id, None)
+        if spilled is not None:
+            self.spill_size -= spilled.size
+            remove_images(spilled)
+
+
+    #Move least recently fetched results to disk until we fit in the budget.
+    #The newest result is always kept, even if it alone is over budget.
+    def _evict(self):
+        while self.size > self.max_bytes and len(self.results) > 1:
+            request_id, images = self.results.popitem(last=False)
+            self.size -= stored_size(images)
+            if self.spill_dir is not None and self.max_spill_bytes > 0:
+                self._spill(request_id, images)
+            else:
+                if isinstance(images, SpooledImages):
+                    remove_images(images)
+                print(f"Evicted results of request {request_id} from the result store.")
+
+        while self.spill_size > self.max_spill_bytes and self.spilled:
+            request_id = next(iter(self.spilled))
+            self._discard(request_id)
+            print(f"Evicted spilled results of request {request_id} from the result store.")
+
+
+    def _spill_path(self, request_id):
+        return os.path.join(self.spill_dir, f"{request_id}.results")
+
+
+    #Spooled images are moved as they are; the spool files have the same layout.
+    def _spill(self, request_id, images):
+        #Request ids restart with the queue, so anything left on disk is stale.
+        #This is done on first use so that merely importing the queue is harmless.
+        if not self.spill_ready:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            os.makedirs(self.spill_dir, exist_ok=True)
+            self.spill_ready = True
+
+        path = self._spill_path(request_id)
+        try:
+            if isinstance(images, SpooledImages):
+                spilled = move_images(images, path)
+            else:
+                write_images(path, images)
+                spilled = SpooledImages(path, [len(i) for i in images])
+        except OSError as err:
+            print(f"Unable to spill results of request {request_id}, dropping them: {err}")
+            if isinstance(images, SpooledImages):
+                remove_images(images)
+            return
+        self.spilled[request_id] = spilled
+        self.spill_size += spilled.size
+
+
+#The bytes a stored result takes.
+def stored_size(images):
+    if isinstance(images, SpooledImages):
+        return images.size
+    return sum(len(i) for i in images)
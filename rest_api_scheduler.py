@@ -0,0 +1,218 @@
+import bisect
+from collections import Counter
+
+#Priority classes, highest first. A job of a lower class only runs when no job
+#of a higher class is waiting.
+priorities = ("interactive", "batch")
+
+
+#Decides which pending job runs next.
+#
+#Within a priority class, the API keys share the workers by weighted fair queuing
+#(start-time fair queuing): each job is tagged with a virtual start time, which for
+#a key's next job is where its previous job's share ends, cost / weight later. A key
+#that submits 200 jobs at once only gets its share, and a key that submits a single
+#job runs next. The jobs are ordered by class, then tag.
+#
+#On top of that order, a later job needing the model that is already loaded may
+#run first, to avoid a slow checkpoint switch. No job can be overtaken more than
+#max_reorder times, so nothing starves.
+#
+#This isn't thread-safe on its own; the job queue calls it with its lock held.
+class Scheduler:
+    def __init__(self, max_reorder):
+        self.max_reorder = max_reorder
+        self.pending = [] #Request ids, in fair queuing order.
+        self.tags = [] #(class, start tag, id) of each pending job, in the same order.
+        self.models = {} #Request id -> model key.
+        self.overtaken = Counter() #Request id -> times a later job ran first.
+
+        self.weights = {} #API key -> weight, 1 if not set.
+        self.jobs = {} #Request id -> (API key, class, cost, start tag), until it finishes.
+        self.finish_tags = {} #(API key, class) -> where the key's last job's share ends.
+        self.virtual_time = [0.0] * len(priorities) #Start tag of the last job started, per class.
+
+        #Estimated cost of the jobs waiting or running, in total and per API key.
+        self.queued_cost = 0
+        self.key_costs = Counter()
+
+        #The simulated run order is cached until the queue or the loaded model changes.
+        self.order = None
+        self.order_model = None
+        self.positions = {}
+
+
+    def __len__(self):
+        return len(self.pending)
+
+
+    def __contains__(self, request_id):
+        return request_id in self.models
+
+
+    #Add a job needing the model identified by model_key, submitted with the given
+    #API key and priority class. Its share of the workers is its estimated cost. A job
+    #handed back by a failed worker keeps its tag, so it goes back to its original place.
+    def add(self, request_id, model_key, key="", priority=priorities[0], cost=1):
+        if request_id not in self.jobs:
+            rank = priorities.index(priority)
+            start = max(self.virtual_time[rank], self.finish_tags.get((key, rank), 0))
+            self.finish_tags[(key, rank)] = start + cost / self.weight(key)
+            self.jobs[request_id] = (key, rank, cost, start)
+            self.queued_cost += cost
+            self.key_costs[key] += cost
+        self._insert(request_id)
+        self.models[request_id] = model_key
+        self.order = None
+
+
+    def _insert(self, request_id):
+        key, rank, cost, start = self.jobs[request_id]
+        tag = (rank, start, request_id)
+        index = bisect.bisect(self.tags, tag)
+        self.tags.insert(index, tag)
+        self.pending.insert(index, request_id)
+
+
+    #Remove a pending job (e.g. because it was cancelled).
+    def remove(self, request_id):
+        if request_id in self.models:
+            index = self.pending.index(request_id)
+            del self.pending[index]
+            del self.tags[index]
+            del self.models[request_id]
+            del self.overtaken[request_id]
+            self.order = None
+
+
+    #Forget a job that finished. Until then, a job that was taken can be added back.
+    def forget(self, request_id):
+        self.remove(request_id)
+        job = self.jobs.pop(request_id, None)
+        if job is not None:
+            key, rank, cost, start = job
+            self.queued_cost -= cost
+            self.key_costs[key] -= cost
+            if self.key_costs[key] <= 0:
+                del self.key_costs[key]
+
+
+    def weight(self, key):
+        return self.weights.get(key, 1)
+
+
+    #Change the share of an API key. Its waiting jobs are retagged, keeping the tag
+    #of its first one, so the change takes effect right away.
+    def set_weight(self, key, weight):
+        if not weight > 0:
+            raise ValueError("The weight must be positive.")
+        self.weights[key] = weight
+
+        ids = [i for i in self.pending if self.jobs[i][0] == key]
+        for i in ids:
+            index = self.pending.index(i)
+            del self.pending[index]
+            del self.tags[index]
+        finish = {}
+        for i in ids:
+            _, rank, cost, start = self.jobs[i]
+            start = finish.get(rank, start)
+            finish[rank] = start + cost / weight
+            self.jobs[i] = (key, rank, cost, start)
+        for rank, tag in finish.items():
+            self.finish_tags[(key, rank)] = tag
+
+        for i in ids:
+            self._insert(i)
+        self.order = None
+
+
+    #Advance the virtual time of a job's class when it starts. Finish tags that are
+    #now in the past no longer matter, so they're dropped.
+    def _started(self, request_id):
+        key, rank, cost, start = self.jobs[request_id]
+        if start > self.virtual_time[rank]:
+            self.virtual_time[rank] = start
+            if len(self.finish_tags) > 2 * len(self.pending) + 100:
+                self.finish_tags = {k: t for k, t in self.finish_tags.items() if t > self.virtual_time[k[1]]}
+
+
+    #Take the job that should run next on a worker with the given model loaded.
+    #Jobs needing one of the reserved models are left for the (idle) workers that
+    #have them loaded. Returns None if there is nothing for this worker.
+    def pop_next(self, loaded_key, reserved=()):
+        i = self._choose(self.pending, self.overtaken, loaded_key, reserved)
+        if i is None:
+            return None
+        index = self.pending.index(i)
+        for j in self.pending[:index]:
+            self.overtaken[j] += 1
+        self._started(i)
+        self.remove(i)
+        return i
+
+
+    #Take the pending jobs, in expected run order, for which match(id) is true. Jobs
+    #that would overtake one already overtaken max_reorder times are skipped without
+    #asking, so every job match accepts is taken and it can keep a running total.
+    def take_matching(self, match, loaded_key):
+        taken = []
+        for i in list(self.schedule(loaded_key)):
+            behind = self.pending[:self.pending.index(i)]
+            if any(self.overtaken[j] >= self.max_reorder for j in behind) or not match(i):
+                continue
+            for j in behind:
+                self.overtaken[j] += 1
+            self._started(i)
+            self.remove(i)
+            taken.append(i)
+        return taken
+
+
+    #The pending jobs in the order they are expected to run, given the loaded model.
+    def schedule(self, loaded_key):
+        if self.order is None or self.order_model != loaded_key:
+            self.order = self._simulate(loaded_key)
+            self.order_model = loaded_key
+            self.positions = {i: n for n, i in enumerate(self.order)}
+        return self.order
+
+
+    #How many pending jobs are expected to run before this one, or None if it isn't pending.
+    def position(self, request_id, loaded_key):
+        self.schedule(loaded_key)
+        return self.positions.get(request_id)
+
+
+    #Run the selection repeatedly on a copy of the queue to predict the full order.
+    def _simulate(self, loaded_key):
+        remaining = list(self.pending)
+        overtaken = Counter(self.overtaken)
+        order = []
+        while remaining:
+            i = self._choose(remaining, overtaken, loaded_key)
+            index = remaining.index(i)
+            for j in remaining[:index]:
+                overtaken[j] += 1
+            del remaining[index]
+            order.append(i)
+            loaded_key = self.models[i]
+        return order
+
+
+    #Pick the first job of the highest waiting class that uses the loaded model,
+    #unless that would overtake a job that has already been overtaken max_reorder
+    #times. Otherwise, the first in fair queuing order. Jobs for reserved models are
+    #skipped.
+    def _choose(self, pending, overtaken, loaded_key, reserved=()):
+        if reserved:
+            pending = [i for i in pending if self.models[i] == loaded_key or self.models[i] not in reserved]
+        if not pending:
+            return None
+        rank = self.jobs[pending[0]][1]
+        for i in pending:
+            if self.jobs[i][1] != rank:
+                break
+            if self.models[i] == loaded_key or overtaken[i] >= self.max_reorder:
+                return i
+        return pending[0]
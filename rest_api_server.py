@@ -1,110 +1,116 @@
-#For environment variables
-import os
+#For timing requests
+import time
 
-#For base64 conversion
-import io
-from base64 import b64encode, b64decode
+#For image download ETags
+import hashlib
 
 #For the flask API server
-from flask import Flask, json, request
+from flask import Flask, Response, json, request, g
 
-#For the multiprocessing shared state
-import rest_api_job_queue
-
-from PIL import Image
-
-max_resolution = os.getenv("MAX_RESOLUTION", 720896)
-print(f"Using max resolution: {max_resolution}")
-
-admin_key = os.getenv("API_ADMIN_KEY", "admin")
-print(f"Using admin key: {admin_key}")
+#For the job queue connection, settings and helpers shared with the ASGI server
+from rest_api_common import admin_key, max_status_wait, request_types, image_mimetypes, \
+    call_queue, check_status, add_job, handle_get, get_image
 
+#For the /metrics endpoint. The job queue keeps the metrics of the whole service.
+from rest_api_metrics import metrics
 
-#Convert the image into a base64 encoding for transmission via JSON.
-def get_response_image(pil_img):
-    byte_arr = io.BytesIO()
-    pil_img.save(byte_arr, format='PNG') # convert the PIL image to byte array
-    encoded_img = b64encode(byte_arr.getvalue()).decode('ascii') # encode as base64
-    return f'data:image/png;base64,{encoded_img}'
-
-
-#Convert the base64 encoding into an image for transmission to img2img or imgproc.
-def get_param_image(image):
-    header = f'data:image/png;base64,'
-    assert image.startswith(header), "Image data not recognized."
-    image = image[len(header):]
-    test = Image.open(io.BytesIO(b64decode(image)))
-    test.save("test_out.png")
-    return test
+#For the legacy model and sampler list handlers
+import rest_api_job_queue
 
 
-#Get the request containing the status and/or the generated images
-def handle_get(request_type, path, key):
-    try:         
+#Get only the progress of a request. If a version is given, wait up to `wait`
+#seconds for the status to move past it first (long-polling).
+def handle_status(request_type, path, key, wait, version):
+    try:
         request_id = int(path)
+        if wait > 0 and version is not None:
+            status = call_queue("wait_for_status", request_id, version, min(wait, max_status_wait))
+        else:
+            status = call_queue("get_status", request_id)
 
-        manager = rest_api_job_queue.get_manager()
-        manager.connect()
-
-        if request_id == 0 and key == admin_key:
-            manager.cancel_all()
-            return f'{{"status" : "All requests cancelled."}}'
-
-        request = manager.get_request(request_id)._getvalue()
-
-
-        r_key = ""
-        try:
-            r_key = request["key"]
-        except:
-            pass
+        error = check_status(status, request_type, request_id, key)
+        if error is not None:
+            return error
+        return json.dumps(status)
 
+    except Exception as err:
+        msg = f'{{"error": "Could not get status of {request_type}/{path}: {err}"}}'
+        print(msg)
+        return msg
 
-        if key != r_key and key != admin_key:
-            msg = f'{{"error": "Authorization denied -- key does not match"}}'
-            print(msg)
-            return msg
-
-        
-        if request_type == "cancel":
-            return json.dumps(manager.cancel(request_id)._getvalue())
 
+#Stream the progress of a request as Server-Sent Events until it is done.
+#Each event carries the status version as its id, so a reconnecting client
+#that sends Last-Event-ID only receives changes it hasn't seen.
+def handle_events(request_type, path, key, version):
+    try:
+        request_id = int(path)
+        status = call_queue("get_status", request_id)
+        error = check_status(status, request_type, request_id, key)
+        if error is not None:
+            return error
+    except Exception as err:
+        msg = f'{{"error": "Could not get status of {request_type}/{path}: {err}"}}'
+        print(msg)
+        return msg
 
+    def stream(status, last):
+        while True:
+            if status["version"] != last:
+                last = status["version"]
+                yield f'id: {last}\ndata: {json.dumps(status)}\n\n'
+            else:
+                #Nothing changed before the timeout; keep the connection alive.
+                yield ': keep-alive\n\n'
 
+            if status["done"]:
+                return
 
-        if request["type"] != request_type:
-            msg = f'{{"error": "Request type {request_id} is {request["type"]}, not {request_type}."}}'
+            try:
+                status = call_queue("wait_for_status", request_id, last, max_status_wait)
+                error = check_status(status, request_type, request_id, key)
+            except Exception as err:
+                error = f'{{"error": "Lost status of {request_type}/{path}: {err}"}}'
+            if error is not None:
+                yield f'event: error\ndata: {error}\n\n'
+                return
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream(status, version), mimetype="text/event-stream", headers=headers)
+
+
+#Return one generated image as raw bytes (PNG as stored, or converted to WebP).
+#Supports conditional and Range requests so large downloads can be resumed.
+def handle_get_image(request_type, path, index, key, image_format, quality):
+    data, error_status = get_image(request_type, path, index, key, image_format, quality)
+    if error_status is not None:
+        return data, error_status
+
+    request_id = int(path)
+    response = Response(data, mimetype=image_mimetypes[image_format])
+    response.headers["Content-Disposition"] = f'inline; filename="{request_type}_{request_id}_{index}.{image_format}"'
+    response.set_etag(hashlib.sha1(data).hexdigest())
+    return response.make_conditional(request, accept_ranges=True, complete_length=len(data))
+
+
+#Get or set the fair queuing weights of the API keys. Only the admin key may.
+def handle_weights(key):
+    try:
+        if key != admin_key:
+            msg = '{"error": "Authorization denied -- admin key required"}'
             print(msg)
             return msg
 
-
-        newlist = []
-        try:
-            try:
-                for i in request["retval"][0]:
-                    newlist.append(get_response_image(i))
-            except:
-                for i in request["retval"]:
-                    newlist.append(get_response_image(i))
-
-            lret = list(request["retval"])
-            lret[0] = newlist
-            request["retval"] = tuple(lret)
-            manager.set_request(request)
-        except:
-            pass
-            
-        #Remove the rather large images from the request object before sending it back.
-        if request_type == "img2img":
-            del request["params"]["init_info_mask"]
-
-        if request_type == "imgproc":
-            del request["params"]["image"]
-
-        return json.dumps(request)
+        if request.method == "POST":
+            weights = call_queue("set_weight", request.json["key"], request.json["weight"])
+        else:
+            weights = call_queue("get_weights")
+        if isinstance(weights, str):
+            return weights
+        return json.dumps({"weights": weights})
 
     except Exception as err:
-        msg = f'{{"error": "Could not get request {request_type}/{path} from queue: {err}"}}'
+        msg = f'{{"error": "Could not access weights: {err}"}}'
         print(msg)
         return msg
 
@@ -132,42 +138,20 @@ def handle_get_samplers():
 
 
 #Allocate the request and start the process
-def handle_post(request_type, key, include_logs, model):
+def handle_post(request_type, key, include_logs, model, priority, cache):
     try:
-        manager = rest_api_job_queue.get_manager()
-        manager.connect()
-
-        params=request.json
-        for k in params:
-            if params[k] == "null":
-                params[k] = None
-
-
-        if "width" in params and "height" in params:
-            if params["width"] * params["height"] > max_resolution:
-                return '{"error": "Not enough VRAM to process request."}'
-
-        #Convert any base64 pngs into PIL images before sending them to the manager
-        if request_type == "img2img":
-            params["init_info_mask"]["image"] = get_param_image(params["init_info_mask"]["image"])
-            params["init_info_mask"]["mask"] = get_param_image(params["init_info_mask"]["mask"])
-        
-        if request_type == "imgproc":
-            params["image"] = get_param_image(params["image"])
-
-        ret = manager.add_request({"done": False, "key": key, "model": model, "include_logs": include_logs, "type": request_type, "params": params, "retval": None, "status": {}})._getvalue()
-
-        #Remove the rather large images from the request object before sending it back.
-        if request_type == "img2img":
-            del ret["params"]["init_info_mask"]
-        if request_type == "imgproc":
-            del ret["params"]["image"]
-
-        return json.dumps(ret)
+        #Multipart uploads carry the JSON params in a form field and the images as raw files.
+        if request.files:
+            params = json.loads(request.form.get("params", "{}"))
+            files = {k: f.read() for k, f in request.files.items()}
+        else:
+            params = request.json
+            files = {}
     except Exception as err:
         msg = f'{{"error": "Could not add request {request_type} to queue: {err}"}}'
         print(msg)
         return msg
+    return add_job(request_type, key, include_logs, model, priority, cache, params, files)
 
 
 
@@ -177,6 +161,21 @@ def handle_post(request_type, key, include_logs, model):
 api = Flask(__name__)
 
 
+#Time every request, labelled by its route rather than its URL to keep the
+#number of label values small.
+@api.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+@api.after_request
+def record_request(response):
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    if "start" in g:
+        metrics.observe("sdapi_http_request_seconds", time.perf_counter() - g.start, endpoint=endpoint, method=request.method)
+    metrics.inc("sdapi_http_responses_total", endpoint=endpoint, status=response.status_code)
+    return response
+
+
 
 
 #All of the methods have a POST function to declare the request.
@@ -191,7 +190,9 @@ def post_txt2img():
         pass
     
     include_logs = request.args.get('include_logs', default=False, type = bool)
-    return handle_post("txt2img", key, include_logs, model)
+    priority = request.args.get('priority', default="interactive", type = str)
+    cache = request.args.get('cache', default="true", type = str).lower() not in ("0", "false", "no")
+    return handle_post("txt2img", key, include_logs, model, priority, cache)
 
 @api.route('/img2img', methods=['POST'])
 def post_img2img():
@@ -202,7 +203,9 @@ def post_img2img():
     except:
         pass
     include_logs = request.args.get('include_logs', default=False, type = bool)
-    return handle_post("img2img", key, include_logs, model)
+    priority = request.args.get('priority', default="interactive", type = str)
+    cache = request.args.get('cache', default="true", type = str).lower() not in ("0", "false", "no")
+    return handle_post("img2img", key, include_logs, model, priority, cache)
 
 @api.route('/imgproc', methods=['POST'])
 def post_imgproc():
@@ -213,7 +216,9 @@ def post_imgproc():
     except:
         pass
     include_logs = request.args.get('include_logs', default=False, type = bool)
-    return handle_post("imgproc", key, include_logs, model)
+    priority = request.args.get('priority', default="interactive", type = str)
+    cache = request.args.get('cache', default="true", type = str).lower() not in ("0", "false", "no")
+    return handle_post("imgproc", key, include_logs, model, priority, cache)
 
 
 
@@ -223,28 +228,79 @@ def post_imgproc():
 @api.route('/txt2img/<path>', methods=['GET'])
 def get_txt2img(path):
     key = request.args.get('key', default="", type = str)
-    return handle_get("txt2img", path, key)
+    images = request.args.get('images', default="data", type = str)
+    return handle_get("txt2img", path, key, images)
 
 @api.route('/img2img/<path>', methods=['GET'])
 def get_img2img(path):
     key = request.args.get('key', default="", type = str)
-    return handle_get("img2img", path, key)
+    images = request.args.get('images', default="data", type = str)
+    return handle_get("img2img", path, key, images)
 
 @api.route('/imgproc/<path>', methods=['GET'])
 def get_imgproc(path):
     key = request.args.get('key', default="", type = str)
-    return handle_get("imgproc", path, key)
+    images = request.args.get('images', default="data", type = str)
+    return handle_get("imgproc", path, key, images)
+
+#Progress can be polled, long-polled (with version and wait), or streamed.
+
+@api.route('/<request_type>/<path>/status', methods=['GET'])
+def get_status(request_type, path):
+    if request_type not in request_types:
+        return f'{{"error": "Unknown request type {request_type}."}}', 404
+    key = request.args.get('key', default="", type = str)
+    wait = request.args.get('wait', default=0, type = float)
+    version = request.args.get('version', default=None, type = int)
+    return handle_status(request_type, path, key, wait, version)
+
+@api.route('/<request_type>/<path>/events', methods=['GET'])
+def get_events(request_type, path):
+    if request_type not in request_types:
+        return f'{{"error": "Unknown request type {request_type}."}}', 404
+    key = request.args.get('key', default="", type = str)
+    version = request.headers.get('Last-Event-ID', default=None, type = int)
+    return handle_events(request_type, path, key, version)
+
+#Generated images can also be downloaded one at a time as raw bytes.
+
+@api.route('/<request_type>/<path>/image/<int:index>', methods=['GET'])
+def get_image_file(request_type, path, index):
+    if request_type not in request_types:
+        return f'{{"error": "Unknown request type {request_type}."}}', 404
+    key = request.args.get('key', default="", type = str)
+    image_format = request.args.get('format', default="png", type = str).lower()
+    quality = request.args.get('quality', default=None, type = int)
+    return handle_get_image(request_type, path, index, key, image_format, quality)
 
 @api.route('/cancel/<path>', methods=['GET'])
 def get_cancel(path):
     key = request.args.get('key', default="", type = str)
     return handle_get("cancel", path, key)
 
+#The admin key can give API keys a bigger or smaller share of the workers.
+
+@api.route('/weights', methods=['GET', 'POST'])
+def weights():
+    key = request.args.get('key', default="", type = str)
+    return handle_weights(key)
+
+#Metrics of the whole service, in the Prometheus text format.
+
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    try:
+        #Include what this process recorded since it last sent its metrics.
+        call_queue("record_metrics", metrics.take_pending())
+        return Response(call_queue("get_metrics"), mimetype="text/plain; version=0.0.4")
+    except Exception as err:
+        msg = f'{{"error": "Could not get metrics: {err}"}}'
+        print(msg)
+        return msg, 500
+
 @api.route('/info', methods=['GET'])
 def get_info():
-    manager = rest_api_job_queue.get_manager()
-    manager.connect()
-    return manager.get_info()._getvalue()
+    return call_queue("get_info")
 
 
 
@@ -0,0 +1,108 @@
+import time
+
+
+#Tracks the workers processing jobs: the model each one has loaded and the jobs
+#each one has claimed. A worker holds a lease on its jobs, renewed by every
+#heartbeat and status report. If a worker stops renewing it (because it crashed,
+#hung or lost its connection), expire() hands its jobs back to be requeued.
+#
+#This isn't thread-safe on its own; the job queue calls it with its lock held.
+class WorkerPool:
+    def __init__(self, lease_seconds):
+        self.lease_seconds = lease_seconds
+        self.workers = {} #Worker id -> {"model", "jobs", "expires", "claimed"}.
+        self.owners = {} #Request id -> id of the worker running it.
+        self.expired = 0
+
+
+    def __contains__(self, request_id):
+        return request_id in self.owners
+
+
+    #Register a worker, or renew its lease, and record the model it has loaded.
+    def heartbeat(self, worker_id, model=None):
+        worker = self.workers.get(worker_id)
+        if worker is None:
+            print(f"Worker {worker_id} joined.")
+            worker = self.workers[worker_id] = {"model": None, "jobs": set(), "claimed": 0}
+        if model is not None:
+            worker["model"] = model
+        worker["expires"] = time.monotonic() + self.lease_seconds
+        return worker
+
+
+    #Give a job to a worker.
+    def claim(self, worker_id, request_id):
+        worker = self.heartbeat(worker_id)
+        worker["jobs"].add(request_id)
+        worker["claimed"] += 1
+        self.owners[request_id] = worker_id
+
+
+    #Take a finished job off its worker. Returns False if the worker no longer held
+    #it, because its lease expired and the job went back to the queue.
+    def release(self, worker_id, request_id):
+        if self.owners.get(request_id) != worker_id:
+            return False
+        del self.owners[request_id]
+        self.workers[worker_id]["jobs"].discard(request_id)
+        return True
+
+
+    #The worker running a job, or None.
+    def owner(self, request_id):
+        return self.owners.get(request_id)
+
+
+    #The jobs a worker holds.
+    def jobs(self, worker_id):
+        worker = self.workers.get(worker_id)
+        return set(worker["jobs"]) if worker is not None else set()
+
+
+    #The ids of the running jobs.
+    def running(self):
+        return list(self.owners)
+
+
+    #The models loaded by idle workers other than the given one. Jobs needing one of
+    #those are left for that worker rather than forcing another model switch.
+    def idle_models(self, exclude=None):
+        return {w["model"] for i, w in self.workers.items() if i != exclude and not w["jobs"]}
+
+
+    #The models loaded by any worker.
+    def loaded_models(self):
+        return {w["model"] for w in self.workers.values()}
+
+
+    #The model to predict the queue order for: that of an idle worker (which runs
+    #the next job), or else that of any worker.
+    def next_model(self):
+        models = [w["model"] for w in self.workers.values() if not w["jobs"]]
+        models += [w["model"] for w in self.workers.values()]
+        return models[0] if models else None
+
+
+    #Drop the workers whose lease ran out. Returns the ids of the jobs they held.
+    def expire(self):
+        now = time.monotonic()
+        orphans = []
+        for worker_id, worker in list(self.workers.items()):
+            if worker["expires"] < now:
+                print(f"Worker {worker_id} missed its heartbeat. Requeueing jobs {sorted(worker['jobs'])}.")
+                for request_id in worker["jobs"]:
+                    del self.owners[request_id]
+                    orphans.append(request_id)
+                del self.workers[worker_id]
+                self.expired += 1
+        return orphans
+
+
+    def stats(self):
+        return {
+            "lease_seconds": self.lease_seconds,
+            "expired": self.expired,
+            "workers": {i: {"model": w["model"], "jobs": sorted(w["jobs"]), "claimed": w["claimed"]}
+                        for i, w in self.workers.items()},
+        }
@@ -35,13 +35,19 @@ echo "JOB_LOOP_PID: ${JOB_LOOP_PID}"
 API_ADMIN_KEY="admin"
 API_URL="0.0.0.0"
 API_PORT="5000"
+API_THREADS="8" #Per process. Long-polls and event streams each hold a thread.
+API_SERVER="uwsgi" #Or "asgi" to serve rest_api_asgi with uvicorn (pip3 install uvicorn), for many waiting clients.
 JOBQUEUE_URL="127.0.0.1"
 JOBQUEUE_PORT="37844"
 JOBQUEUE_AUTH="this_is_insecure."
 
 #Start the API server
 echo "Using API URL: ${API_URL}, port: ${API_PORT}"
-uwsgi --http "${API_URL}:${API_PORT}" --master -p 4 -w rest_api_server:api --enable-threads
+if [ "${API_SERVER}" = "asgi" ]; then
+    uvicorn rest_api_asgi:app --host "${API_URL}" --port "${API_PORT}" --workers 4
+else
+    uwsgi --http "${API_URL}:${API_PORT}" --master -p 4 --threads "${API_THREADS}" -w rest_api_server:api --enable-threads
+fi
 
 #Make double sure the job queue is not still running.
 clean_up